@@ -2,7 +2,8 @@
 import argparse
 import logging
 
-from php2py.main import compile_file, compile_dir
+from php2py.main import compile_file, compile_dir, check_file
+from php2py.clib import trace
 
 
 ap = argparse.ArgumentParser()
@@ -12,6 +13,12 @@ ap.add_argument("-c", "--compile", action="store_false", help="Compile to file.p
 ap.add_argument("--tree", action="store_true", help="Display the parse tree.")
 ap.add_argument("file", help="file to compile")
 ap.add_argument("--search", action="store_true", help="Search for php files in a given directory")
+ap.add_argument("--trace", help="Write tokenizer, parser and transformer events to this file as json lines")
+ap.add_argument("--cache", help="Cache parse trees in this directory so unchanged files aren't parsed again")
+ap.add_argument("--parallel", action="store_true", help="Tokenize large files using several processes")
+ap.add_argument("--check", action="store_true", help="Report every syntax error instead of compiling")
+ap.add_argument("--warn-unreachable", action="store_true", help="Warn about code dropped because it can never run")
+ap.add_argument("--bind-builtins", action="store_true", help="Look up the builtins a module calls once per request")
 args = ap.parse_args()
 
 print_tree = False
@@ -27,7 +34,17 @@ levels = {
 }
 logging.basicConfig(level=levels[args.debug], format=None)
 
+if args.trace:
+    trace.enable(args.trace)
+
 if args.search:
-    compile_dir(args.file, args.compile, args.strip)
+    compile_dir(args.file, args.compile, args.strip, args.cache, args.parallel, args.check, args.warn_unreachable,
+                args.bind_builtins)
+elif args.check:
+    check_file(args.file)
 else:
-    parser = compile_file(args.file, args.compile, args.strip, print_tree)
+    parser = compile_file(args.file, args.compile, args.strip, print_tree, args.cache, args.parallel,
+                          args.warn_unreachable, args.bind_builtins)
+
+if args.trace:
+    trace.disable()
@@ -0,0 +1,49 @@
+""" Binding the builtins a module calls to names of its own
+
+Every call to a builtin compiles to _f_.name(...), which looks the function up through PhpVars.__getattribute__ and
+makes a new bound method every time. Once bound, each builtin the module calls is looked up just once, into a
+module level name such as _f_strlen, and the calls use that instead. The lookups run with the rest of the module,
+which include runs afresh for every request.
+
+Only the methods of Functions and Specials are bound. Calls to the functions php code defines, and to anything
+which doesn't exist, still go through _f_.
+
+"""
+from .clib import visitor
+from .intermediate import *
+from .phpbaselib.functions import Functions
+from .phpbaselib.specials import Specials
+from . import folding
+from . import scopes
+
+
+BUILTINS = {n for c in (Functions, Specials) for n in dir(c) if not n.startswith("_") and callable(getattr(c, n))}
+
+
+def bind(root: RootNode):
+    """ Make the calls to builtins in every function and method use names bound at the top of the module
+
+    Has to run last, as the other passes look for builtins by their calls through _f_.
+
+    """
+    defined = {f.value for f in root.functions}
+    bound = set()
+
+    def pre(node, depth):
+        if node.kind == "CALL" and node.callee.kind == "OPERATOR2" and node.callee.rhs.kind in ("IDENT", "VAR"):
+            name = node.callee.rhs.value
+            if folding.is_f_call(node, name) and name in BUILTINS and name not in defined:
+                node.callee = VariableNode(bound_name(name))
+                bound.add(name)
+        elif node.kind == "CONCAT" and node.converts():
+            node.strval = bound_name("strval")
+            bound.add("strval")
+
+    visitor.walk(root, pre=pre)
+    for name in sorted(bound):
+        root.constants.assignments.append(scopes.assignment(VariableNode(bound_name(name)),
+                                                            Operator2Node(".", VariableNode("_f_"), IdentNode(name))))
+
+
+def bound_name(name: str) -> str:
+    return "_f_" + name
@@ -0,0 +1,114 @@
+import hashlib
+import marshal
+import os
+
+from .parsetree import ParseNode, ParseTree
+
+
+# Bump this when the format written by dump changes. Changes to the tokenizer and parser are picked up by
+# parser_digest without needing this to change.
+CACHE_VERSION = 3
+
+# The modules whose behaviour decides what tree a source file parses to
+PARSER_MODULES = ("tokeniser.py", "parser.py", "clib/parsetree.py")
+
+_parser_digest = None
+
+
+def parser_digest() -> bytes:
+    """ A digest of the tokenizer and parser source, so that editing them makes old cache entries miss
+
+    """
+    global _parser_digest
+    if _parser_digest is None:
+        package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        h = hashlib.sha256(str(CACHE_VERSION).encode())
+        for name in PARSER_MODULES:
+            with open(os.path.join(package_dir, name), "rb") as f:
+                h.update(f.read())
+        _parser_digest = h.digest()
+    return _parser_digest
+
+
+def cache_key(source: str) -> str:
+    h = hashlib.sha256(parser_digest())
+    h.update(source.encode("utf-8", "surrogatepass"))
+    return h.hexdigest()
+
+
+def dump(tree: ParseTree) -> bytes:
+    """ Serialize a parse tree using marshal
+
+    The nodes are stored in a flat tuple in pre-order as (kind, value, id, line, column, number of
+    children).
+
+    """
+    nodes = []
+    stack = [tree.root_node]
+    while stack:
+        node = stack.pop()
+        nodes.append((node.kind, node.value, node.id_, node.line, node.col, len(node.children)))
+        stack.extend(reversed(node.children))
+    return marshal.dumps((CACHE_VERSION, tuple(nodes)))
+
+
+def load(data: bytes) -> ParseTree:
+    """ Rebuild a parse tree from what dump made
+
+    Raises ValueError if the data can't be used.
+
+    """
+    try:
+        version, nodes = marshal.loads(data)
+    except (EOFError, TypeError, ValueError):
+        raise ValueError("Cache entry is corrupt")
+    if version != CACHE_VERSION:
+        raise ValueError("Cache entry is from version {}".format(version))
+
+    tree = ParseTree(nodes[0][1])
+    root = tree.root_node
+    # Each entry is a node still waiting for children, and how many more it needs
+    stack = [[root, nodes[0][5]]]
+    for kind, value, id_, line, col, child_count in nodes[1:]:
+        while stack[-1][1] == 0:
+            stack.pop()
+        parent = stack[-1]
+        parent[1] -= 1
+        node = parent[0].append(ParseNode(kind, None, value=value, id_=id_))
+        node.line = line
+        node.col = col
+        if child_count > 0:
+            stack.append([node, child_count])
+    # Carry on numbering where the parser left off
+    tree.next_id = max(n[2] for n in nodes) + 1
+    return tree
+
+
+class ParseCache(object):
+    """ Parse trees stored on disk, keyed by a hash of the php source and of the parser itself
+
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + ".marshal")
+
+    def get(self, source: str):
+        """ Get the parse tree for source, or None if it isn't cached
+
+        """
+        try:
+            with open(self.path(cache_key(source)), "rb") as f:
+                return load(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def put(self, source: str, tree: ParseTree):
+        path = self.path(cache_key(source))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so that a run which dies part way through can't leave half an entry behind
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp_path, "wb") as f:
+            f.write(dump(tree))
+        os.replace(temp_path, path)
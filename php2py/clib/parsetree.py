@@ -1,6 +1,11 @@
 from __future__ import absolute_import, unicode_literals
+import functools
+import weakref
 from builtins import str
 
+from . import trace
+from . import visitor
+
 
 class ParseTreeError(Exception):
     pass
@@ -10,17 +15,60 @@ class NoMatchesError(ParseTreeError):
     pass
 
 
-next_id = 0
-def get_next_id():
-    global next_id
-    next_id += 1
-    return next_id - 1
+class Selector(object):
+    """ A compiled match string, see MatchableNode.match
+
+    Each step is a (kind, value, single) tuple. Use compile_selector rather than making these directly so that
+    they get reused.
+
+    """
+    __slots__ = ("match_str", "steps")
+
+    def __init__(self, match_str: str):
+        self.match_str = match_str
+        steps = []
+        for step in match_str.split("/"):
+            single = step[-1] != "*"
+            if not single:
+                step = step[:-1]
+            kind, sep, value = step.partition("|")
+            steps.append((kind, value if sep else None, single))
+        self.steps = tuple(steps)
+
+    def match(self, node, step=0):
+        kind, value, single = self.steps[step]
+        last = step == len(self.steps) - 1
+        matches = []
+        for c in node.get_all(kind, value):
+            child_matched = c
+            if not last:
+                # Look deeper
+                try:
+                    child_matched = self.match(c, step + 1)
+                except NoMatchesError:
+                    continue
+            if single:
+                return child_matched
+            matches.append(child_matched)
+        if len(matches) == 0:
+            raise NoMatchesError()
+        return matches
+
+    def __repr__(self):
+        return "Selector({!r})".format(self.match_str)
+
+
+@functools.lru_cache(maxsize=512)
+def compile_selector(match_str: str) -> Selector:
+    return Selector(match_str)
 
 
 class MatchableNode(object):
     """ Mixin to provide matching functionality to nodes
 
     """
+    __slots__ = ()
+
     def __iter__(self):
         raise NotImplementedError("MatchableNodeClasses must implement __iter__")
 
@@ -34,57 +82,37 @@ class MatchableNode(object):
             match("FUNCTION|body/BLOCK") - Tries to return the BLOCK of the function which is a child
                                            of this node and is called "body"
 
+        Match strings are compiled once and cached, see compile_selector.
+
         Returns:
             Either a single ParseNode object if no * is specified or a list if * is.
         """
-        next_match = None
-        this_match = match_str
-        try:
-            this_match, next_match = match_str.split("/", 1)
-        except ValueError:
-            pass
-        child_name = None
-        single = this_match[-1] != "*"
-        if not single:
-            this_match = this_match[:-1]
-        try:
-            this_match, child_name = this_match.split("|")
-        except ValueError:
-            pass
-        # print("Matching {},{} {} times.".format(this_match, child_name, "one" if single else "many"))
-        matches = []
-        for c in self.get_all(this_match, child_name):
-            child_matched = c
-            if next_match is not None:
-                # Look deeper
-                try:
-                    child_matched = c.match(next_match)
-                except NoMatchesError:
-                    child_matched = None
-            if child_matched is not None:
-                if single:
-                    return child_matched
-                else:
-                    matches.append(child_matched)
-        if len(matches) == 0:
-            raise NoMatchesError()
-        return matches
+        return compile_selector(match_str).match(self)
+
+    def kind_index(self):
+        """ A dict of kind to the children of that kind, or None if the children should just be searched in order
+
+        """
+        return None
 
     def get_all(self, kind: str, node_name: str = None):
-        for c in self:
-            if node_name is None:
-                if c.kind == kind:
-                    yield c
-            else:
-                if c.kind == kind and str(c.value) == node_name:
-                    yield c
+        index = self.kind_index()
+        children = self if index is None else index.get(kind, ())
+        for c in children:
+            if c.kind == kind and (node_name is None or str(c.value) == node_name):
+                yield c
 
     def get(self, kind):
         """ Returns the first instance of a node kind which is a child of this node
         """
-        for c in self:
-            if c.kind == kind:
-                return c
+        index = self.kind_index()
+        if index is not None:
+            if kind in index:
+                return index[kind][0]
+        else:
+            for c in self:
+                if c.kind == kind:
+                    return c
         raise KeyError("No node of type {} is a child of {}".format(kind, self))
 
     def __getitem__(self, item):
@@ -93,29 +121,146 @@ class MatchableNode(object):
         return self.get(item)
 
 
+# Nodes with fewer children than this are searched in order rather than building an index
+INDEX_MIN_CHILDREN = 8
+
+# The biggest subtree, in nodes, which ParseTree.intern_subtrees will share
+INTERN_MAX_SIZE = 16
+
+
 class ParseNode(MatchableNode):
-    def __init__(self, kind, token, value=None, parent=None):
+    """ A node in the parse tree
+
+    There's one of these for nearly every token, so they're kept small. They have slots, keep only the line and
+    column of the token they were made from rather than the token itself, and have no link to their parent
+    (see ParseTree.parent_of), so a tree has no reference cycles and is freed as soon as it's finished with.
+    Leaves share the empty tuple as their children.
+
+    Nodes with many children keep an index of them by kind so get and match don't have to search them all. Change
+    children through the methods here so that the index is kept up to date, and rename nodes before adding them
+    to a parent, or use rename.
+
+    Once their tree has a kind index (see ParseTree.nodes_of_kind) the nodes in it keep a weak reference to the
+    tree, so that the same methods can keep that index up to date too.
+
+    """
+    __slots__ = ("kind", "value", "children", "index", "tree", "id_", "line", "col")
+
+    def __init__(self, kind, token, value=None, id_=-1):
+        """ token can be anything with a position, such as a token or another node, or None
+
+        Ids are handed out by ParseTree.new, so nodes made directly have an id of -1.
+
+        """
         if not isinstance(kind, str):
             raise ParseTreeError("kind must be a string, not {}".format(kind))
         self.kind = kind
-        self.parent = parent
         self.value = value
-        self.children = []
-        self.id_ = get_next_id()
-        self.token = token
+        self.children = ()
+        self.index = None
+        self.tree = None
+        self.id_ = id_
+        if token is None:
+            self.line = -1
+            self.col = -1
+        else:
+            self.line, self.col = token.position
+
+    @property
+    def position(self):
+        return self.line, self.col
+
+    def thaw(self):
+        """ Make the children a list again if they have been frozen, so they can be changed
+
+        Drops the kind index, as the caller is assumed to be about to change the children.
+
+        """
+        self.index = None
+        if type(self.children) is tuple:
+            self.children = list(self.children)
+        return self.children
+
+    def freeze(self):
+        """ Store the children of this node and all its descendants in tuples, which take less space
+
+        Nodes can still be changed afterwards, they just thaw out again.
+
+        """
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            node.children = tuple(node.children)
+            stack.extend(node.children)
 
     def append(self, node):
         # if not isinstance(node, ParseNode):
         #     raise ParseTreeError("Expected a node, saw a {} as a child of {}".format(type(node), self))
-        self.children.append(node)
-        node.parent = self
+        index = self.index
+        self.thaw().append(node)
+        if index is not None:
+            index.setdefault(node.kind, []).append(node)
+            self.index = index
+        if self.tree is not None:
+            self.attached(node)
         return node
 
+    def insert(self, i, node):
+        self.thaw().insert(i, node)
+        if self.tree is not None:
+            self.attached(node)
+        return node
+
+    def attached(self, node):
+        tree = self.tree()
+        if tree is not None:
+            tree.index_add(node)
+
+    def detached(self, node):
+        tree = self.tree()
+        if tree is not None:
+            tree.index_remove(node)
+
+    def rename(self, kind):
+        """ Change the kind of this node, keeping the tree's kind index up to date
+
+        The kind index of this node's parent isn't updated, so only rename nodes with few siblings.
+
+        """
+        if self.tree is not None:
+            tree = self.tree()
+            if tree is not None:
+                tree.index_remove(self, recurse=False)
+                self.kind = kind
+                tree.index_add(self, recurse=False)
+                return
+        self.kind = kind
+
+    def kind_index(self):
+        if self.index is None:
+            if len(self.children) < INDEX_MIN_CHILDREN:
+                return None
+            index = {}
+            for c in self.children:
+                index.setdefault(c.kind, []).append(c)
+            self.index = index
+        return self.index
+
+    def structural_hash(self) -> int:
+        """ A hash of the kinds and values of this node and everything under it, ignoring positions and ids
+
+        Subtrees which are structurally the same have the same hash. It's worked out afresh each time.
+
+        """
+        return visitor.walk(self, post=lambda node, results: hash((node.kind, node.value, tuple(results))))
+
     def to_list(self):
-        if len(self.children) > 0:
-            return self.kind, self.value, [c.to_list() for c in self.children]
-        else:
-            return self.kind, self.value
+        def post(node, children):
+            if len(children) > 0:
+                return node.kind, node.value, children
+            else:
+                return node.kind, node.value
+        return visitor.walk(self, post=post)
 
     def __getitem__(self, key):
         if isinstance(key, int):
@@ -123,18 +268,27 @@ class ParseNode(MatchableNode):
         return self.get(key)
 
     def __setitem__(self, key, value):
-        if isinstance(key, int):
-            self.children[key] = value
-            return
-        i = 0
-        while i < len(self.children):
-            if self.children[i].kind == key:
-                self.children[i] = value
+        children = self.thaw()
+        if not isinstance(key, int):
+            for i, c in enumerate(children):
+                if c.kind == key:
+                    key = i
+                    break
+            else:
+                self.append(value)
                 return
-        self.append(value)
+        if self.tree is not None:
+            self.detached(children[key])
+            self.attached(value)
+        children[key] = value
 
     def __delitem__(self, key):
-        del(self.children[key])
+        children = self.thaw()
+        if self.tree is not None:
+            removed = children[key]
+            for c in removed if isinstance(key, slice) else [removed]:
+                self.detached(c)
+        del(children[key])
 
     def __str__(self):
         if self.value is not None:
@@ -157,42 +311,142 @@ class ParseNode(MatchableNode):
 
     def insert_after(self, search, new_node):
         i = self.children.index(search) + 1
-        self.children.insert(i, new_node)
+        self.insert(i, new_node)
 
     def insert_before(self, search, new_node):
         i = self.children.index(search)
         print("inserting {} in {} before {}".format(new_node, self, self[i]))
-        self.children.insert(i, new_node)
+        self.insert(i, new_node)
 
     def trim_childless_children(self, kind):
         new_children = []
         for i in range(0, len(self.children)):
             if self.children[i].kind == kind and len(self.children[i].children) == 0:
-                pass
+                if self.tree is not None:
+                    self.detached(self.children[i])
             else:
                 new_children.append(self.children[i])
         self.children = new_children
+        self.index = None
 
 
 class ParseTree(object):
     def __init__(self, name):
-        self.root_node = ParseNode("ROOT", None, value=name)
+        # Ids are counted per tree, so that they're the same each time a file is parsed wherever it's done
+        self.next_id = 0
+        self.root_node = ParseNode("ROOT", None, value=name, id_=self.new_id())
+        self.tracer = trace.tracer
+        # kind -> the nodes of that kind in the tree, as dict keys so they keep their order and can be removed
+        self.kinds = None
+        self.ref = weakref.ref(self)
+
+    def nodes_of_kind(self, kind: str):
+        """ All the nodes of a kind anywhere in the tree, in the order they were added to it
+
+        The first call walks the whole tree to build an index of every node by kind. After that the index is kept
+        up to date as nodes are added, removed or renamed through ParseNode's methods.
+
+        """
+        if self.kinds is None:
+            self.kinds = {}
+            self.index_add(self.root_node)
+        return list(self.kinds.get(kind, ()))
+
+    def index_add(self, node: ParseNode, recurse=True):
+        if self.kinds is None:
+            return
+        stack = [node]
+        while stack:
+            n = stack.pop()
+            n.tree = self.ref
+            nodes = self.kinds.get(n.kind)
+            if nodes is None:
+                nodes = self.kinds[n.kind] = {}
+            nodes[n] = None
+            if recurse:
+                stack.extend(reversed(n.children))
+
+    def index_remove(self, node: ParseNode, recurse=True):
+        if self.kinds is None:
+            return
+        stack = [node]
+        while stack:
+            n = stack.pop()
+            n.tree = None
+            self.kinds.get(n.kind, {}).pop(n, None)
+            if recurse:
+                stack.extend(n.children)
 
     def print_(self, node=None):
         if node is None:
             node = self.root_node
 
-        def print_tree(tree, indent):
-            s = str(tree)
+        def print_node(n, depth):
+            s = str(n)
             if len(s) > 50:
                 s = s[0:51]
-            print(indent * " " + s)
-            for c in tree:
-                if indent > 50:
-                    print_tree(c, indent)
-                else:
-                    print_tree(c, indent + 4)
-        print_tree(node, 0)
+            # Stop indenting at some point so deep trees stay readable
+            print(min(depth * 4, 52) * " " + s)
+        visitor.walk(node, pre=print_node)
+
+    def parent_of(self, node: ParseNode):
+        """ Find the parent of node, or None if it's the root or isn't in this tree
+
+        Nodes don't keep a link to their parent, so this searches the tree.
+
+        """
+        stack = [self.root_node]
+        while stack:
+            n = stack.pop()
+            for c in n.children:
+                if c is node:
+                    return n
+            stack.extend(n.children)
+        return None
+
+    def freeze(self):
+        self.root_node.freeze()
+
+    def intern_subtrees(self, max_size=INTERN_MAX_SIZE) -> int:
+        """ Make structurally identical subtrees of up to max_size nodes into one shared subtree
+
+        Generated php, such as language files and config arrays, repeats the same strings, constants and
+        $this->foo lookups thousands of times, and they only need storing once. A shared subtree has the position
+        and id of its first appearance, and parent_of finds only one of its parents, so this is for trees which
+        are going to be read rather than changed. Returns how many nodes were dropped.
+
+        """
+        # (kind, value, ids of the shared children) -> the shared node. The shared nodes are kept alive by being
+        # in here, so their ids can't be reused while it's in use.
+        shared = {}
+        dropped = 0
+
+        def post(node, results):
+            nonlocal dropped
+            size = 1
+            changed = False
+            for c, (s, c_size) in zip(node.children, results):
+                size += c_size
+                if s is not c:
+                    changed = True
+            if changed:
+                node.children = type(node.children)(s for s, _ in results)
+                node.index = None
+            if size > max_size:
+                return node, size
+            s = shared.setdefault((node.kind, node.value, tuple(id(s) for s, _ in results)), node)
+            if s is not node:
+                dropped += 1
+            return s, size
+
+        visitor.walk(self.root_node, post=post)
+        # Shared nodes would be in the kind index once however many places they're used in
+        self.kinds = None
+        return dropped
+
+    def new_id(self) -> int:
+        self.next_id += 1
+        return self.next_id - 1
 
     def new(self, kind: str, token, value=None) -> ParseNode:
         """ Create a new ParseNode
@@ -202,8 +456,9 @@ class ParseTree(object):
         """
         if value is None:
             value = token.val
-        n = ParseNode(kind, token, value=value)
-        # print("New node: {}".format(n))
+        n = ParseNode(kind, token, value=value, id_=self.new_id())
+        if self.tracer is not None:
+            self.tracer.node(n)
         return n
 
 
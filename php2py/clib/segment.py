@@ -49,15 +49,15 @@ class CompiledSegment(object):
         self.lines.insert(0, (line, 0))
 
     def __str__(self):
-        out = ""
+        out = []
         for l, i in self.lines:
             try:
-                out += "    " * i + l + "\n"
+                out.append("    " * i + l + "\n")
             except TypeError:
                 print("BAD SEGMENT WAS: ")
                 print(str(l))
                 raise
-        return out
+        return "".join(out)
 
     def __iter__(self):
         return iter(self.lines)
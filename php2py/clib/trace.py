@@ -0,0 +1,87 @@
+import json
+
+
+class Tracer(object):
+    """ Writes structured trace events as json lines
+
+    Each line is one event, a json object with an "event" key saying what kind of event it is. The events are:
+
+        token:      The tokenizer produced a token
+        node:       A parse node was created
+        enter:      The parser started parsing a rule, such as a statement or block
+        leave:      The parser finished the last rule it entered
+        reduce:     An operator in an expression was given its operands
+        transform:  The transformer turned a parse node into an intermediate node
+        error:      The parser found a syntax error and carried on past it
+
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+    def event(self, event: str, **fields):
+        self.stream.write(json.dumps(dict(event=event, **fields), default=str))
+        self.stream.write("\n")
+
+    def token(self, token):
+        self.event("token", line=token.line, col=token.col, val=token.val, kind=token.kind)
+
+    def node(self, node):
+        self.event("node", id=node.id_, kind=node.kind, value=node.value)
+
+    def enter(self, rule: str, token=None):
+        if token is None:
+            self.event("enter", rule=rule)
+        else:
+            self.event("enter", rule=rule, line=token.line, val=token.val)
+
+    def leave(self, rule: str):
+        self.event("leave", rule=rule)
+
+    def reduce(self, op, operands):
+        self.event("reduce", id=op.id_, kind=op.kind, value=op.value, operands=[o.id_ for o in operands])
+
+    def transform(self, node, result):
+        self.event("transform", id=node.id_, kind=node.kind, result=result.kind)
+
+    def close(self):
+        self.stream.close()
+
+
+# The tracer in use, or None when tracing is off. Tokenizers and parse trees take a copy of this when they
+# are created, so when it is None the only cost is an "is not None" check where an event would be made.
+tracer = None
+
+
+def enable(stream) -> Tracer:
+    """ Start sending trace events to stream, which is either a file like object or a filename
+
+    """
+    global tracer
+    if isinstance(stream, str):
+        stream = open(stream, "w")
+    tracer = Tracer(stream)
+    return tracer
+
+
+def disable():
+    global tracer
+    if tracer is not None:
+        tracer.close()
+    tracer = None
+
+
+def traced_tokens(token_stream):
+    """ Wrap a token stream so that every token produced is traced
+
+    Returns the stream unchanged when tracing is off.
+
+    """
+    t = tracer
+    if t is None:
+        return token_stream
+
+    def gen():
+        for token in token_stream:
+            t.token(token)
+            yield token
+    return gen()
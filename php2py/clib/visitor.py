@@ -0,0 +1,84 @@
+""" Walking trees of nodes without recursing
+
+A chain of "." or "+" in php parses to a tree as deep as the chain is long, so anything which follows the tree down
+with python recursion hits the recursion limit on long chains. These keep their own stack instead.
+
+"""
+import types
+
+
+def walk(root, pre=None, post=None, children=iter):
+    """ Visit root and everything under it, depth first
+
+    pre(node, depth) is called on the way down. If it returns False the children of node aren't visited.
+
+    post(node, results) is called on the way back up, with a list of what post returned for each visited child.
+    walk returns what post returned for root.
+
+    children(node) gives the children of a node, and defaults to iterating over it, which works for both parse
+    nodes and intermediate nodes.
+
+    """
+    no_children = iter(())
+    it = children(root) if pre is None or pre(root, 0) is not False else no_children
+    # Each entry is a node, an iterator over the children still to visit, and what post returned for the others
+    stack = [(root, it, [])]
+    while True:
+        node, it, results = stack[-1]
+        for c in it:
+            if pre is None or pre(c, len(stack)) is not False:
+                stack.append((c, children(c), []))
+            else:
+                stack.append((c, no_children, []))
+            break
+        else:
+            stack.pop()
+            result = post(node, results) if post is not None else None
+            if not stack:
+                return result
+            stack[-1][2].append(result)
+
+
+def run(call):
+    """ Run a generator which recurses by yielding rather than calling
+
+    Where a recursive function would call itself, the generator instead yields the generator for that call, and
+    is sent back what it returned. An exception raised by that call is thrown into it at the same point. Anything
+    yielded which isn't a generator is taken to be the result of a call which didn't need to recurse, and is sent
+    straight back, so functions for leaves don't need to be generators.
+
+    Returns what the first generator returned.
+
+    """
+    generator = types.GeneratorType
+    if type(call) is not generator:
+        return call
+    # The calls waiting on call to finish
+    stack = []
+    value = None
+    error = None
+    while True:
+        try:
+            if error is None:
+                sub = call.send(value)
+            else:
+                e, error = error, None
+                sub = call.throw(e)
+        except StopIteration as e:
+            if not stack:
+                return e.value
+            call = stack.pop()
+            value = e.value
+            continue
+        except Exception as e:
+            if not stack:
+                raise
+            call = stack.pop()
+            error = e
+            continue
+        if type(sub) is generator:
+            stack.append(call)
+            call = sub
+            value = None
+        else:
+            value = sub
@@ -69,8 +69,10 @@ class Compiler(object):
 
     """
 
-    def __init__(self, tree=None, strip_comments=False):
+    def __init__(self, tree=None, strip_comments=False, warn_unreachable=False, bind_builtins=False):
         self.strip_comments = strip_comments
+        self.warn_unreachable = warn_unreachable
+        self.bind_builtins = bind_builtins
         self.imports = collections.defaultdict(list)
         self.imports["php2py.engine.metavars"] = ["_f_", "_g_", "_c_", "_constants_"]
         self.compiled = CompiledSegment()
@@ -80,7 +82,7 @@ class Compiler(object):
     def compile(self, tree=None) -> str:
         if tree is None:
             tree = self.tree
-        tree = transformer.transform(tree)
+        tree = transformer.transform(tree, warn_unreachable=self.warn_unreachable, bind_builtins=self.bind_builtins)
 
         if not tree.kind == "ROOT":
             raise CompilationFailure("Must pass instance of RootNode to compile")
@@ -160,7 +162,7 @@ class Junk:
 
     def keyvalue_compile_str(self, node: parsetree.ParseNode, assign=": ") -> str:
         if len(node) != 2:
-            parsetree.print_tree(node.parent)
+            parsetree.print_tree(node)
             raise CompileError(node, "Keyvalues must have more than one child")
         return self.marshal_str(node[0]) + assign + self.marshal_str(node[1])
 
@@ -261,7 +263,7 @@ class Junk:
         seg.dedent()
         for c in node.children[1:]:
             if c.kind != "CATCH":
-                raise CompileError(node, "Expected catch block as child of try {}".format(c.token))
+                raise CompileError(node, "Expected catch block as child of try, saw {}".format(c))
             exception_nodes = list(c.get_all("EXCEPTION"))
             if len(exception_nodes) == 1:
                 catch_matches = exception_nodes[0].value
@@ -0,0 +1,297 @@
+""" Constant folding over the intermediate tree
+
+Operators whose operands are all literals are worked out at compile time, following what php would give rather
+than what python would. Where the two could differ, or php would give an error or a warning, the operation is left
+for runtime.
+
+Constants given a literal value by a define() at the top level of the file are replaced by their value. Other
+functions use the value too, since php only gives an undefined constant error for one used before its define.
+
+"""
+import re
+from typing import Dict
+
+from .clib import visitor
+from .intermediate import *
+
+
+INT_MIN = -2 ** 63
+INT_MAX = 2 ** 63 - 1
+
+# What php would read as a number in a string, which changes how strings compare
+NUMERIC_STRING = re.compile(r"\s*[+-]?(\d+(\.\d*)?|\.\d+)([eE][+-]?\d+)?\s*$")
+
+# Constants php knows without a define. Their names aren't case sensitive.
+PHP_LITERALS = {"true": True, "false": False, "null": None}
+
+
+class NotConstant(Exception):
+    """ Raised when an operation can't or shouldn't be worked out at compile time
+
+    """
+    pass
+
+
+def fold(root: RootNode):
+    """ Fold the constant expressions in every function and method
+
+    The body of the file goes first, so that the constants it defines are known when folding everything else.
+
+    """
+    # A constant defined more than once, or anywhere other than the top level, could have some other value
+    defines = {}
+
+    def count_defines(node, depth):
+        if node.kind == "CALL" and is_f_call(node, "define") and len(node.args) > 0 and node.args[0].kind == "STRING":
+            defines[node.args[0].value] = defines.get(node.args[0].value, 0) + 1
+    visitor.walk(root, pre=count_defines)
+
+    body = root.functions[-1]
+    constants = {}
+    for statement in body.body:
+        fold_node(statement, constants)
+        name, value = literal_define(statement)
+        if name is not None and defines[name] == 1:
+            constants[name] = value
+    for function in root.functions[:-1]:
+        fold_node(function, constants)
+    for c in root.classes:
+        fold_node(c, constants)
+
+
+def fold_node(node: IntermediateNode, constants: Dict[str, object]) -> IntermediateNode:
+    """ Fold everything under node, returning what node should be replaced with
+
+    """
+    replacements = {}
+
+    def post(n, results):
+        n.replace_children(lambda c: replacements.pop(id(c), c))
+        folded = fold_one(n, constants)
+        if folded is not n:
+            replacements[id(n)] = folded
+        return None
+
+    visitor.walk(node, post=post)
+    return replacements.get(id(node), node)
+
+
+def fold_one(node: IntermediateNode, constants: Dict[str, object]) -> IntermediateNode:
+    """ Node worked out if it can be, else node itself. Its children have been folded already.
+
+    """
+    try:
+        if node.kind == "OPERATOR2" and is_php_operator(node):
+            return fold_operator2(node)
+        if node.kind == "OPERATOR1" and is_php_operator(node):
+            return make_literal(unary(node.parse_node.value, literal(node.child)))
+        if node.kind == "OPERATOR3":
+            return node.true_res if to_bool(literal(node.condition)) else node.false_res
+        if node.kind == "TUPLE" and len(node.children) == 1 and is_literal(node.children[0]):
+            value = literal(node.children[0])
+            # Keep the brackets round negative numbers, as in (-2) ** 2
+            if not isinstance(value, (int, float)) or isinstance(value, bool) or value >= 0:
+                return node.children[0]
+        if is_constant_access(node):
+            name = node.rhs.value
+            if name.lower() in PHP_LITERALS:
+                return make_literal(PHP_LITERALS[name.lower()])
+            if name in constants:
+                return make_literal(constants[name])
+    except NotConstant:
+        pass
+    return node
+
+
+def fold_operator2(node: Operator2Node) -> IntermediateNode:
+    op = node.parse_node.value
+    if op in ("&&", "and", "||", "or"):
+        # Only the left has to be known, as php doesn't evaluate the right when the left decides
+        lhs = to_bool(literal(node.lhs))
+        if (op in ("&&", "and")) != lhs:
+            return make_literal(lhs)
+        return make_literal(to_bool(literal(node.rhs)))
+    if op == "." and node.lhs.kind == "STRING" and node.rhs.kind == "STRING":
+        # Strings are kept as python source, so join them as they are rather than escaping them again
+        return StringNode(node.lhs.value + node.rhs.value)
+    return make_literal(binary(op, literal(node.lhs), literal(node.rhs)))
+
+
+def is_php_operator(node: IntermediateNode) -> bool:
+    """ Whether node came from a php operator, rather than being something like the . of _g_.a
+
+    """
+    return node.parse_node is not None and node.parse_node.kind == node.kind
+
+
+def is_constant_access(node: IntermediateNode) -> bool:
+    return (node.kind == "OPERATOR2" and node.value == "." and node.lhs.kind == "VAR" and
+            node.lhs.value == "_constants_")
+
+
+def is_f_call(node: CallNode, name: str) -> bool:
+    callee = node.callee
+    return (callee.kind == "OPERATOR2" and callee.value == "." and callee.lhs.kind == "VAR" and
+            callee.lhs.value == "_f_" and callee.rhs.value == name)
+
+
+def literal_define(statement: StatementNode):
+    """ The name and value if statement is a define() of a literal, else None, None
+
+    """
+    if statement.kind == "EX_STATEMENT" and statement.child.kind == "CALL" and \
+            is_f_call(statement.child, "define"):
+        args = statement.child.args
+        if len(args) == 2 and args[0].kind == "STRING" and is_literal(args[1]):
+            try:
+                return args[0].value, literal(args[1])
+            except NotConstant:
+                pass
+    return None, None
+
+
+def is_literal(node: IntermediateNode) -> bool:
+    try:
+        literal(node)
+    except NotConstant:
+        return False
+    return True
+
+
+def literal(node: IntermediateNode):
+    """ The python value of a literal node
+
+    """
+    if node.kind == "INT":
+        return int(node.value)
+    if node.kind == "FLOAT":
+        return float(node.value)
+    if node.kind in ("IDENT", "BOOL") and node.value in ("True", "False"):
+        return node.value == "True"
+    if node.kind == "NONE":
+        return None
+    if node.kind == "STRING" and "\\" not in node.value and '"' not in node.value:
+        # Anything with escapes is only joined onto other strings, in fold_operator2
+        return node.value
+    raise NotConstant()
+
+
+def make_literal(value) -> ExpressionNode:
+    if value is None:
+        return NoneNode("None")
+    if isinstance(value, bool):
+        return BoolNode(str(value))
+    if isinstance(value, int):
+        return IntNode(str(value))
+    if isinstance(value, float):
+        return FloatNode(repr(value))
+    return StringNode(value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+
+
+def to_bool(value) -> bool:
+    if isinstance(value, str):
+        return value not in ("", "0")
+    return bool(value)
+
+
+def to_string(value) -> str:
+    if isinstance(value, bool):
+        return "1" if value else ""
+    if value is None:
+        return ""
+    if isinstance(value, int) or isinstance(value, str):
+        return str(value)
+    # Php prints floats with its own precision rules
+    raise NotConstant()
+
+
+def to_number(value):
+    if value is None or isinstance(value, bool):
+        return int(bool(value))
+    if isinstance(value, (int, float)):
+        return value
+    # Php reads numbers out of strings, with a warning for any which aren't numeric
+    raise NotConstant()
+
+
+def to_int(value) -> int:
+    value = to_number(value)
+    if isinstance(value, float):
+        raise NotConstant()
+    return value
+
+
+def checked(value):
+    """ value, unless php would have overflowed to a float
+
+    """
+    if isinstance(value, int) and not INT_MIN <= value <= INT_MAX:
+        raise NotConstant()
+    return value
+
+
+def unary(op: str, value):
+    if op == "!":
+        return not to_bool(value)
+    if op == "-":
+        return checked(-to_number(value))
+    if op == "+":
+        return to_number(value)
+    if op == "~":
+        return ~to_int(value)
+    raise NotConstant()
+
+
+def binary(op: str, a, b):
+    if op == ".":
+        return to_string(a) + to_string(b)
+    if op in ("+", "-", "*"):
+        a, b = to_number(a), to_number(b)
+        return checked(a + b if op == "+" else a - b if op == "-" else a * b)
+    if op == "/":
+        a, b = to_number(a), to_number(b)
+        if b == 0:
+            raise NotConstant()
+        if isinstance(a, int) and isinstance(b, int) and a % b == 0:
+            return checked(a // b)
+        return a / b
+    if op == "%":
+        a, b = to_int(a), to_int(b)
+        if b == 0:
+            raise NotConstant()
+        # The result takes the sign of a in php
+        result = abs(a) % abs(b)
+        return -result if a < 0 else result
+    if op in ("&", "|", "^"):
+        a, b = to_int(a), to_int(b)
+        return a & b if op == "&" else a | b if op == "|" else a ^ b
+    if op in ("==", "!=", "<", ">", "<=", ">="):
+        return compare(op, a, b)
+    if op in ("===", "!=="):
+        same = type(a) is type(b) and a == b
+        return same if op == "===" else not same
+    raise NotConstant()
+
+
+def compare(op: str, a, b) -> bool:
+    """ Php's loose comparison, for the types where it agrees with python's
+
+    """
+    if isinstance(a, bool) or isinstance(b, bool):
+        a, b = to_bool(a), to_bool(b)
+    elif isinstance(a, str) or isinstance(b, str):
+        if not isinstance(a, str) or not isinstance(b, str) or NUMERIC_STRING.match(a) or NUMERIC_STRING.match(b):
+            raise NotConstant()
+    elif a is None or b is None:
+        raise NotConstant()
+    if op == "==":
+        return a == b
+    if op == "!=":
+        return a != b
+    if op == "<":
+        return a < b
+    if op == ">":
+        return a > b
+    if op == "<=":
+        return a <= b
+    return a >= b
@@ -1,5 +1,6 @@
 from typing import Optional, List, TypeVar
 
+from php2py.clib import visitor
 from php2py.clib.segment import CompiledSegment
 from php2py.clib.parsetree import *
 
@@ -22,12 +23,14 @@ class IntermediateNode(MatchableNode):
             self.parse_node = parse_node
             self.value = parse_node.value
             self.id_ = parse_node.id_
-            self.token = parse_node.token
+            self.line = parse_node.line
+            self.col = parse_node.col
         else:
             self.parse_node = None
             self.value = parse_node
-            self.id_ = get_next_id()
-            self.token = None
+            self.id_ = -1
+            self.line = -1
+            self.col = -1
         self.type = "Unknown"
 
     def __str__(self):
@@ -36,12 +39,36 @@ class IntermediateNode(MatchableNode):
     def __iter__(self):
         return iter([])
 
+    def replace_children(self, replace):
+        """ Replace each child node c with replace(c)
+
+        Works on any node by looking through its attributes, so passes which rewrite the tree don't need to know the
+        layout of every kind of node.
+
+        """
+        for key, value in list(vars(self).items()):
+            if isinstance(value, list):
+                value[:] = [replace(v) if isinstance(v, IntermediateNode) else v for v in value]
+            elif isinstance(value, IntermediateNode):
+                new = replace(value)
+                if new is not value:
+                    setattr(self, key, new)
+
+    def compile(self):
+        """ Compile this node and everything under it
+
+        Nodes implement generate rather than this. It yields the generate of each child it needs compiled and gets
+        back the result, which lets clib.visitor.run do the work without recursing however deep the tree is.
+
+        """
+        return visitor.run(self.generate())
+
 
 class ExpressionNode(IntermediateNode):
     base_kind = "EX"
     kind = None
 
-    def compile(self) -> str:
+    def generate(self) -> str:
         return str(self.value)
 
 
@@ -49,22 +76,36 @@ class StatementNode(IntermediateNode):
     base_kind = "STATEMENT"
     kind = None
 
-    def compile(self) -> CompiledSegment:
+    def generate(self) -> CompiledSegment:
         cs = CompiledSegment()
         for c in self:
-            cs.append(c.compile())
+            cs.append((yield c.generate()))
         return cs
 
 
 class HtmlNode(StatementNode):
     kind = "HTML"
 
-    def compile(self) -> CompiledSegment:
+    def generate(self) -> CompiledSegment:
         cs = CompiledSegment()
         cs.append("_app_.write({})".format(repr(self.value)))
         return cs
 
 
+class ConstantsNode(StatementNode):
+    """ Assignments to constants at the top of the module, such as the static html
+
+    """
+    kind = "CONSTANTS"
+
+    def __init__(self, parse_node: PnOrStr, assignments: List[StatementNode]) -> None:
+        super().__init__(parse_node)
+        self.assignments = assignments
+
+    def __iter__(self):
+        yield from self.assignments
+
+
 class BlockNode(IntermediateNode):
     base_kind = "BLOCK"
     kind = "BLOCK"
@@ -76,11 +117,14 @@ class BlockNode(IntermediateNode):
     def __iter__(self):
         yield from self.children
 
-    def compile(self) -> CompiledSegment:
+    def generate(self) -> CompiledSegment:
         cs = CompiledSegment()
         cs.indent()
         for c in self:
-            cs.append(c.compile())
+            cs.append((yield c.generate()))
+        if len(self.children) == 0:
+            # Python needs something in every block
+            cs.append("pass")
         cs.dedent()
         return cs
 
@@ -92,7 +136,7 @@ class CommentNode(IntermediateNode):
     def __init__(self, parse_node: ParseNode) -> None:
         super().__init__(parse_node)
 
-    def compile(self):
+    def generate(self):
         return "# " + self.value
 
 
@@ -112,20 +156,23 @@ class ExpressionStatement(StatementNode):
         if self.comment is not None:
             yield self.comment
 
-    def compile(self):
+    def generate(self):
         cs = CompiledSegment()
-        line = self.child.compile()
+        line = yield self.child.generate()
         if self.comment is not None:
+            comment = yield self.comment.generate()
             if line == "":
-                line = self.comment.compile()
+                line = comment
             else:
-                line = "{} {}".format(line, self.comment.compile())
+                line = "{} {}".format(line, comment)
         cs.append(line)
         return cs
 
 
 class VariableNode(ExpressionNode):
     kind = "VAR"
+    # For php variables, "local", "global" or "superglobal" once scopes.analyse has been run
+    scope = None
 
 
 class CommaListNode(ExpressionNode):
@@ -138,14 +185,17 @@ class CommaListNode(ExpressionNode):
     def __iter__(self):
         yield from self.children
 
-    def compile(self):
-        return ", ".join([c.compile() for c in self.children])
+    def generate(self):
+        compiled = []
+        for c in self.children:
+            compiled.append((yield c.generate()))
+        return ", ".join(compiled)
 
 
 class StringNode(ExpressionNode):
     kind = "STRING"
 
-    def compile(self):
+    def generate(self):
         return '"{}"'.format(self.value)
 
 
@@ -153,6 +203,10 @@ class IntNode(ExpressionNode):
     kind = "INT"
 
 
+class FloatNode(ExpressionNode):
+    kind = "FLOAT"
+
+
 class BoolNode(ExpressionNode):
     kind = "BOOL"
 
@@ -160,22 +214,45 @@ class BoolNode(ExpressionNode):
 class NoneNode(ExpressionNode):
     kind = "NONE"
 
-    def compile(self):
+    def generate(self):
         return "None"
 
 
 class ListNode(CommaListNode):
     kind = "LIST"
 
-    def compile(self):
-        return "[{}]".format(super().compile())
+    def generate(self):
+        items = yield from super().generate()
+        return "[{}]".format(items)
 
 
 class TupleNode(CommaListNode):
     kind = "TUPLE"
 
-    def compile(self):
-        return "({})".format(super().compile())
+    def generate(self):
+        items = yield from super().generate()
+        return "({})".format(items)
+
+
+class DictNode(ExpressionNode):
+    kind = "DICT"
+
+    def __init__(self, parse_node: PnOrStr, keys: List[ExpressionNode], values: List[ExpressionNode]) -> None:
+        super().__init__(parse_node)
+        self.keys = keys
+        self.values = values
+
+    def __iter__(self):
+        yield from self.keys
+        yield from self.values
+
+    def generate(self):
+        items = []
+        for k, v in zip(self.keys, self.values):
+            key = yield k.generate()
+            value = yield v.generate()
+            items.append("{}: {}".format(key, value))
+        return "{" + ", ".join(items) + "}"
 
 
 class IdentNode(ExpressionNode):
@@ -196,16 +273,20 @@ class FunctionNode(IntermediateNode):
             args = []
         self.args = args
         self.body = body
+        # Names of the php variables local to this function, set by scopes.analyse
+        self.locals = []
 
     def __iter__(self):
         yield from self.args
         yield self.body
 
-    def compile(self):
+    def generate(self):
         cs = CompiledSegment()
-        args = ", ".join([a.compile() for a in self.args])
-        cs.append("def {}({}):".format(self.value, args))
-        cs.append(self.body.compile())
+        args = []
+        for a in self.args:
+            args.append((yield a.generate()))
+        cs.append("def {}({}):".format(self.value, ", ".join(args)))
+        cs.append((yield self.body.generate()))
         return cs
 
 
@@ -232,12 +313,73 @@ class Operator2Node(ExpressionNode):
         yield self.lhs
         yield self.rhs
 
-    def compile(self):
+    def generate(self):
         # TODO: Think about putting "." operators in own class
+        lhs = yield self.lhs.generate()
+        rhs = yield self.rhs.generate()
         if self.value in ("."):
-            return "{}{}{}".format(self.lhs.compile(), self.value, self.rhs.compile())
+            return "{}{}{}".format(lhs, self.value, rhs)
         else:
-            return "{} {} {}".format(self.lhs.compile(), self.value, self.rhs.compile())
+            return "{} {} {}".format(lhs, self.value, rhs)
+
+
+class ConcatNode(ExpressionNode):
+    """ A chain of php . operators, which builds its string in one go rather than with a + for each part
+
+    Parts which typer hasn't proven to be strings are converted the way php would. A ConcatNode of a single part
+    is just the conversion.
+
+    """
+    kind = "CONCAT"
+    # Below this many parts a chain of + is quicker than a join
+    JOIN_LENGTH = 4
+    # Before python 3.12 the expressions in an f-string can't contain backslashes or its own quote, and braces,
+    # colons and exclamation marks would be read as part of the f-string
+    NOT_IN_FSTRING = '"\\{}:!#'
+
+    def __init__(self, parse_node: PnOrStr, parts: List[ExpressionNode]) -> None:
+        super().__init__(parse_node)
+        self.parts = parts
+        self.type = "str"
+        # What to call to convert a part, which binding can change
+        self.strval = "_f_.strval"
+
+    def __iter__(self):
+        yield from self.parts
+
+    def generate(self):
+        parts = []
+        for p in self.parts:
+            parts.append((yield p.generate()))
+        if len(parts) == 1:
+            return self.converted(self.parts[0], parts[0])
+        literal = [p.kind == "STRING" for p in self.parts]
+        if all("\\N" not in p.value if l else not any(c in s for c in self.NOT_IN_FSTRING)
+               for p, s, l in zip(self.parts, parts, literal)):
+            # An f-string is quickest, and formats ints the way php would
+            return 'f"{}"'.format("".join(p.value.replace("{", "{{").replace("}", "}}") if l else
+                                          "{" + (s if p.type == "int" else self.converted(p, s)) + "}"
+                                          for p, s, l in zip(self.parts, parts, literal)))
+        parts = [self.converted(p, s) for p, s in zip(self.parts, parts)]
+        if len(parts) >= self.JOIN_LENGTH:
+            return '"".join([{}])'.format(", ".join(parts))
+        return " + ".join(parts)
+
+    def converted(self, part: ExpressionNode, source: str) -> str:
+        """ source, which part compiled to, made into a string as php would
+
+        """
+        if part.kind == "STRING" or part.type == "str":
+            return source
+        if part.type == "int":
+            return "str({})".format(source)
+        return "{}({})".format(self.strval, source)
+
+    def converts(self) -> bool:
+        """ Whether any part needs converting the way php would
+
+        """
+        return any(p.kind != "STRING" and p.type not in ("str", "int") for p in self.parts)
 
 
 class Operator3Node(ExpressionNode):
@@ -258,8 +400,11 @@ class Operator3Node(ExpressionNode):
         yield self.true_res
         yield self.false_res
 
-    def compile(self):
-        return "{} if {} else {}".format(self.true_res.compile(), self.condition.compile(), self.false_res.compile())
+    def generate(self):
+        true_res = yield self.true_res.generate()
+        condition = yield self.condition.generate()
+        false_res = yield self.false_res.generate()
+        return "{} if {} else {}".format(true_res, condition, false_res)
 
 
 class Operator1Node(ExpressionNode):
@@ -272,8 +417,9 @@ class Operator1Node(ExpressionNode):
     def __iter__(self):
         yield self.child
 
-    def compile(self) -> str:
-        return "{} {}".format(self.value, self.child.compile())
+    def generate(self) -> str:
+        child = yield self.child.generate()
+        return "{} {}".format(self.value, child)
 
 
 class AssignmentNode(Operator2Node):
@@ -282,8 +428,10 @@ class AssignmentNode(Operator2Node):
     # TODO: Add new method annotate_types
     # lhs.type = rhs.type
 
-    def compile(self):
-        return "{} = {}".format(self.lhs.compile(), self.rhs.compile())
+    def generate(self):
+        lhs = yield self.lhs.generate()
+        rhs = yield self.rhs.generate()
+        return "{} {} {}".format(lhs, self.value, rhs)
 
 
 class AttributeNode(AssignmentNode):
@@ -310,12 +458,13 @@ class ClassNode(IntermediateNode):
         yield self.parent
         yield self.body
 
-    def compile(self):
+    def generate(self):
         cs = CompiledSegment()
-        cs.append("class {}({}):".format(self.value, self.parent.compile()))
+        parent = yield self.parent.generate()
+        cs.append("class {}({}):".format(self.value, parent))
         cs.indent()
         # TODO: Move as appropriate to __init__
-        cs.append(self.body.compile())
+        cs.append((yield self.body.generate()))
         return cs
 
 
@@ -327,26 +476,67 @@ class RootNode(IntermediateNode):
         super().__init__(parse_node)
         self.functions = functions
         self.classes = classes
+        self.constants = ConstantsNode("", [])
 
     def __iter__(self):
+        if len(self.constants.assignments) > 0:
+            yield self.constants
         yield from iter(self.functions)
         yield from iter(self.classes)
 
 
+class GlobalNode(StatementNode):
+    kind = "GLOBAL"
+
+    def __init__(self, parse_node: PnOrStr, variables: List[VariableNode]) -> None:
+        super().__init__(parse_node)
+        self.variables = variables
+
+    def __iter__(self):
+        yield from self.variables
+
+    def generate(self):
+        # Globals are always reached through _g_, so there's nothing to declare
+        cs = CompiledSegment()
+        cs.append("# global {}".format(", ".join(v.value for v in self.variables)))
+        return cs
+
+
 class ReturnNode(ExpressionStatement):
     kind = "RETURN_STATEMENT"
 
-    def compile(self):
+    def generate(self):
         cs = CompiledSegment()
-        cs.append("return {}".format(self.child.compile()))
+        child = yield self.child.generate()
+        cs.append("return {}".format(child))
         # TODO: Comments
         return cs
 
 
+class WriteNode(ExpressionStatement):
+    kind = "WRITE"
+
+    def generate(self):
+        cs = CompiledSegment()
+        child = yield self.child.generate()
+        cs.append("_app_.write({})".format(child))
+        return cs
+
+
+class ThrowNode(ExpressionStatement):
+    kind = "THROW_STATEMENT"
+
+    def generate(self):
+        cs = CompiledSegment()
+        child = yield self.child.generate()
+        cs.append("raise {}".format(child))
+        return cs
+
+
 class NoopNode(ExpressionNode):
     kind = "NOOP"
 
-    def compile(self) -> str:
+    def generate(self) -> str:
         return ""
 
 
@@ -362,9 +552,12 @@ class CallNode(ExpressionNode):
         yield self.callee
         yield from self.args
 
-    def compile(self) -> str:
-        args = ", ".join([a.compile() for a in self.args])
-        return "{}({})".format(self.callee.compile(), args)
+    def generate(self) -> str:
+        args = []
+        for a in self.args:
+            args.append((yield a.generate()))
+        callee = yield self.callee.generate()
+        return "{}({})".format(callee, ", ".join(args))
 
 
 class PySpecial(VariableNode):
@@ -383,8 +576,10 @@ class IndexNode(ExpressionNode):
         yield self.target
         yield self.key
 
-    def compile(self) -> str:
-        return "{}[{}]".format(self.target.compile(), self.key.compile())
+    def generate(self) -> str:
+        target = yield self.target.generate()
+        key = yield self.key.generate()
+        return "{}[{}]".format(target, key)
 
 
 class BlockStatement(StatementNode):
@@ -401,10 +596,10 @@ class BlockStatement(StatementNode):
 class ElseNode(BlockStatement):
     kind = "ELSE"
 
-    def compile(self):
+    def generate(self):
         cs = CompiledSegment()
         cs.append("else:")
-        cs.append(self.block.compile())
+        cs.append((yield self.block.generate()))
         return cs
 
 
@@ -422,10 +617,11 @@ class ElifNode(ElseNode):
         yield self.condition
         yield from super().__iter__()
 
-    def compile(self):
+    def generate(self):
         cs = CompiledSegment()
-        cs.append("elif {}:".format(self.condition.compile()))
-        cs.append(self.block.compile())
+        condition = yield self.condition.generate()
+        cs.append("elif {}:".format(condition))
+        cs.append((yield self.block.generate()))
         return cs
 
 
@@ -446,12 +642,13 @@ class IfNode(BlockStatement):
         yield from super().__iter__()
         yield from self.elses
 
-    def compile(self):
+    def generate(self):
         cs = CompiledSegment()
-        cs.append("if {}:".format(self.condition.compile()))
-        cs.append(self.block.compile())
+        condition = yield self.condition.generate()
+        cs.append("if {}:".format(condition))
+        cs.append((yield self.block.generate()))
         for e in self.elses:
-            cs.append(e.compile())
+            cs.append((yield e.generate()))
         return cs
 
 
@@ -469,15 +666,18 @@ class WhileNode(BlockStatement):
         yield self.condition
         yield from super().__iter__()
 
-    def compile(self):
+    def generate(self):
         cs = CompiledSegment()
-        cs.append("while {}:".format(self.condition.compile()))
-        cs.append(self.block.compile())
+        condition = yield self.condition.generate()
+        cs.append("while {}:".format(condition))
+        cs.append((yield self.block.generate()))
         return cs
 
 
 class ForNode(BlockStatement):
     kind = "FOR"
+    # For a counted php for loop, the statement after it which gives the loop variable the value php would leave
+    exit_value = None
 
     def __init__(self,
                  parse_node: PnOrStr,
@@ -493,10 +693,12 @@ class ForNode(BlockStatement):
         yield self.items
         yield from super().__iter__()
 
-    def compile(self):
+    def generate(self):
         cs = CompiledSegment()
-        cs.append("for {} in {}:".format(self.thing.compile(), self.items.compile()))
-        cs.append(self.block.compile())
+        thing = yield self.thing.generate()
+        items = yield self.items.generate()
+        cs.append("for {} in {}:".format(thing, items))
+        cs.append((yield self.block.generate()))
         return cs
 
 
@@ -516,18 +718,32 @@ class CatchNode(BlockStatement):
         yield from self.exceptions
         yield from super().__iter__()
 
-    def compile(self):
+    def generate(self):
         cs = CompiledSegment()
-        if len(self.exceptions) > 1:
-            exceptions = "({})".format(", ".join([e.compile() for e in self.exceptions]))
+        exceptions = []
+        for e in self.exceptions:
+            exceptions.append((yield e.generate()))
+        if len(exceptions) > 1:
+            exceptions = "({})".format(", ".join(exceptions))
         else:
-            exceptions = self.exceptions[0].compile()
+            exceptions = exceptions[0]
 
         if self.exc_name is None:
             cs.append("except {}:".format(exceptions))
         else:
-            cs.append("except {} as {}:".format(exceptions, self.exc_name.compile()))
-        cs.append(self.block.compile())
+            exc_name = yield self.exc_name.generate()
+            cs.append("except {} as {}:".format(exceptions, exc_name))
+        cs.append((yield self.block.generate()))
+        return cs
+
+
+class FinallyNode(BlockStatement):
+    kind = "FINALLY"
+
+    def generate(self):
+        cs = CompiledSegment()
+        cs.append("finally:")
+        cs.append((yield self.block.generate()))
         return cs
 
 
@@ -537,18 +753,24 @@ class TryNode(BlockStatement):
     def __init__(self,
                  parse_node: PnOrStr,
                  block: BlockNode,
-                 catches: List[CatchNode]) -> None:
+                 catches: List[CatchNode],
+                 finally_: Optional[FinallyNode]=None) -> None:
         super().__init__(parse_node, block)
         self.catches = catches
+        self.finally_ = finally_
 
     def __iter__(self):
         yield from super().__iter__()
         yield from self.catches
+        if self.finally_ is not None:
+            yield self.finally_
 
-    def compile(self):
+    def generate(self):
         cs = CompiledSegment()
         cs.append("try:")
-        cs.append(self.block.compile())
+        cs.append((yield self.block.generate()))
         for c in self.catches:
-            cs.append(c.compile())
+            cs.append((yield c.generate()))
+        if self.finally_ is not None:
+            cs.append((yield self.finally_.generate()))
         return cs
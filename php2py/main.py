@@ -6,26 +6,46 @@ import time
 
 from .compiler import Compiler, CompilationFailure
 from .parser import PhpParser
+from .tokeniser import parallel_buffer_tokens
+from .clib.cache import ParseCache
+from .clib.parsetree import print_tree as print_parse_tree
 
 
 BAD_FILE = 1
 COMPILE_FAILURE = 2
 
 
-def compile_file(filename: str, compile: bool, strip_comments: bool, print_tree: bool = False):
+def compile_file(filename: str, compile: bool, strip_comments: bool, print_tree: bool = False,
+                 cache_dir: str = None, parallel: bool = False, warn_unreachable: bool = False,
+                 bind_builtins: bool = False):
     """ Compile a file called file_name
 
+    If cache_dir is given, parse trees are cached there and a file which hasn't changed since it was last
+    parsed goes straight to being compiled. parallel tokenizes large files using several processes.
+    warn_unreachable logs a warning for each piece of code dropped because it can never run. bind_builtins has
+    the compiled module look up the builtins it calls once, rather than on every call.
+
     """
     print("Parsing {}".format(filename))
     try:
         # newline='' means we just accept whatever line ending is already in the file
-        parser = PhpParser(open(filename, "r", newline=''))
+        with open(filename, "r", newline='') as f:
+            source = f.read()
     except FileNotFoundError:
         logging.critical("Unknown file: {}. Check filename and try again.".format(filename))
         sys.exit(BAD_FILE)
 
+    cache = None if cache_dir is None else ParseCache(cache_dir)
+    tree = None if cache is None else cache.get(source)
+    if tree is None:
+        tree = PhpParser(parallel_buffer_tokens(source) if parallel else source).pt
+        if cache is not None:
+            cache.put(source, tree)
+    else:
+        logging.info("Using cached parse tree for {}".format(filename))
+
     if print_tree:
-        parser.pt.print_()
+        print_parse_tree(tree.root_node)
 
     if not compile:
         return
@@ -36,7 +56,8 @@ def compile_file(filename: str, compile: bool, strip_comments: bool, print_tree:
 
     print()
     print("Compiling {} to {}".format(filename, py_filename))
-    c = Compiler(parser.get_tree(), strip_comments=strip_comments)
+    c = Compiler(tree.root_node, strip_comments=strip_comments, warn_unreachable=warn_unreachable,
+                 bind_builtins=bind_builtins)
     try:
         results = c.compile()
     except CompilationFailure as e:
@@ -45,26 +66,53 @@ def compile_file(filename: str, compile: bool, strip_comments: bool, print_tree:
         for cause in e.args[1]:
             print("    " + cause.msg)
             print("        Node was {}".format(cause.node))
-            t = cause.node.token
-            if t is None:
-                print("        Node didn't include a token. Unknown location")
+            if cause.node.line < 0:
+                print("        Node didn't include a position. Unknown location")
             else:
-                print("        Original token was {}".format(t))
+                print("        Node came from line {}, column {}".format(cause.node.line, cause.node.col))
             print()
         sys.exit(COMPILE_FAILURE)
     with open(py_filename, "w") as py_file:
         py_file.write(str(results))
 
 
-def compile_dir(dirname: str, compile: bool, strip_comments: bool):
+def check_file(filename: str) -> int:
+    """ Parse a file, carrying on past syntax errors, and print every error found
+
+    Returns the number of errors.
+
+    """
+    try:
+        with open(filename, "r", newline='') as f:
+            source = f.read()
+    except FileNotFoundError:
+        logging.critical("Unknown file: {}. Check filename and try again.".format(filename))
+        sys.exit(BAD_FILE)
+    parser = PhpParser(source, recover=True)
+    for error in parser.errors:
+        print("{}: {}".format(filename, error))
+    return len(parser.errors)
+
+
+def compile_dir(dirname: str, compile: bool, strip_comments: bool, cache_dir: str = None,
+                parallel: bool = False, check: bool = False, warn_unreachable: bool = False,
+                bind_builtins: bool = False):
     print("Searching for php files in {} to compile".format(dirname))
     print("-" * 50)
     count = 0
+    errors = 0
     start_time = time.time()
     for root, dirnames, filenames in os.walk(dirname):
         for filename in fnmatch.filter(filenames, '*.php'):
-            compile_file(os.path.join(root, filename), compile, strip_comments)
+            if check:
+                errors += check_file(os.path.join(root, filename))
+            else:
+                compile_file(os.path.join(root, filename), compile, strip_comments, cache_dir=cache_dir,
+                             parallel=parallel, warn_unreachable=warn_unreachable, bind_builtins=bind_builtins)
             count += 1
     end_time = time.time()
     print("-" * 50)
-    print("Compiled {} files in {:.3f} seconds".format(count, end_time - start_time))
+    if check:
+        print("Checked {} files in {:.3f} seconds, found {} errors".format(count, end_time - start_time, errors))
+    else:
+        print("Compiled {} files in {:.3f} seconds".format(count, end_time - start_time))
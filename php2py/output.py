@@ -0,0 +1,124 @@
+""" Writing output in as few calls as possible
+
+Every html island and echo would otherwise be a call of its own, so a template makes thousands of them. Each run of
+html and echo statements next to each other in a block becomes a single _app_.write, with the literal parts joined at
+compile time. Literal parts with html in are kept in constants at the top of the module.
+
+Output has to come out in the order php would give it, and what was written before an exception has to stay written,
+as anything from the function up to the top of the page could catch it. So only literal parts are joined on before
+an expression which could raise, or could call something which writes output of its own. Such an expression starts
+a new write, which the literal parts after it can join.
+
+"""
+from typing import List
+
+from .clib import visitor
+from .intermediate import *
+from . import folding
+from . import scopes
+
+
+class Text(object):
+    """ Output known at compile time, and whether any of it is html
+
+    """
+    def __init__(self, value: str, html: bool) -> None:
+        self.value = value
+        self.html = html
+
+
+def coalesce(root: RootNode):
+    """ Replace the html and echo statements in every function and method with as few writes as possible
+
+    """
+    # The names of the html constants, by their value
+    constants = {}
+
+    def pre(node, depth):
+        if node.kind == "BLOCK":
+            node.children = coalesce_block(node.children, constants)
+
+    visitor.walk(root, pre=pre)
+    root.constants.assignments.extend(scopes.assignment(VariableNode(name), folding.make_literal(value))
+                                      for value, name in constants.items())
+
+
+def coalesce_block(statements: List[StatementNode], constants: dict) -> List[StatementNode]:
+    coalesced = []
+    # The parts of the write being built, with Text for what is known at compile time
+    parts = []
+    first = None
+
+    def finish():
+        if len(parts) > 0:
+            coalesced.append(WriteNode(first.parse_node, write_value(parts, constants)))
+            parts.clear()
+
+    for statement in statements:
+        statement_parts = output_parts(statement)
+        if statement_parts is None:
+            finish()
+            coalesced.append(statement)
+            continue
+        for p in statement_parts:
+            if not isinstance(p, Text) and not is_plain_read(p):
+                finish()
+            if len(parts) == 0:
+                first = statement
+            if isinstance(p, Text) and len(parts) > 0 and isinstance(parts[-1], Text):
+                parts[-1] = Text(parts[-1].value + p.value, parts[-1].html or p.html)
+            else:
+                parts.append(p)
+    finish()
+    return coalesced
+
+
+def output_parts(statement: StatementNode):
+    """ What statement writes if it's html or an echo, with Text for what is known at compile time
+
+    None if statement is anything else.
+
+    """
+    if statement.kind == "HTML":
+        return [Text(statement.value, True)]
+    if statement.kind == "EX_STATEMENT" and statement.child.kind == "CALL" and \
+            folding.is_f_call(statement.child, "echo"):
+        parts = []
+        for a in statement.child.args:
+            try:
+                value = folding.literal(a)
+            except folding.NotConstant:
+                parts.append(a)
+            else:
+                # Php has its own rules for printing floats
+                parts.append(a if isinstance(value, float) else Text(folding.to_string(value), False))
+        return parts
+    return None
+
+
+def is_plain_read(node: ExpressionNode) -> bool:
+    """ Whether node is a local which typer has proven is written as it is, so can't raise or write anything
+
+    """
+    return node.kind == "VAR" and node.scope is not None and node.type in ("str", "int")
+
+
+def write_value(parts: list, constants: dict) -> ExpressionNode:
+    """ The expression to write for parts, with the html made into module constants
+
+    """
+    nodes = []
+    for p in parts:
+        if isinstance(p, Text) and p.html:
+            if p.value not in constants:
+                constants[p.value] = "_html_{}".format(len(constants))
+            nodes.append(VariableNode(constants[p.value]))
+            nodes[-1].type = "str"
+        elif isinstance(p, Text):
+            nodes.append(folding.make_literal(p.value))
+        else:
+            nodes.append(p)
+    # The app writes ints as php would, but anything else other than a string needs converting
+    if len(nodes) == 1 and nodes[0].type in ("str", "int"):
+        return nodes[0]
+    return ConcatNode("", nodes)
@@ -4,6 +4,8 @@ import logging
 
 from .clib.parsetree import ParseTree, print_tree, ParseNode
 from . import tokeniser
+from .clib import trace
+from .tokeniser import Kind
 
 
 class ParseException(Exception):
@@ -34,6 +36,26 @@ class UpTooMuchException(Exception):
     pass
 
 
+class Diagnostic(object):
+    """ A syntax error found while parsing with recovery turned on
+
+    """
+    def __init__(self, error: ParseError, token: tokeniser.Token):
+        self.error = error
+        self.token = token
+
+    @property
+    def line(self):
+        return self.token.line
+
+    @property
+    def col(self):
+        return self.token.col
+
+    def __str__(self):
+        return "line {}, column {}: {}".format(self.line, self.col, self.error)
+
+
 super_globals = [
     "GLOBALS",
     "_SERVER",
@@ -55,8 +77,8 @@ class Parser(object):
         self.pt = ParseTree(name)
         self.chars = contents
         self.current = None
-        self.debug_indent = 0
         self.tokens = None
+        self.tracer = trace.tracer
 
     def to_list(self, ):
         return self.get_tree().to_list()
@@ -107,13 +129,14 @@ class Parser(object):
             for c in node:
                 self.print_node_info(c, recurse, start_indent)
 
-    def pdebug(self, s, i_change=0):
-        logging.debug(" " * self.debug_indent + str(s))
-        self.debug_indent += i_change
+    def enter(self, rule):
+        """ Trace the start of parsing rule. Call with "if self.tracer is not None" to keep it free when off
+
+        """
+        self.tracer.enter(rule, self.peek())
 
     def next(self) -> tokeniser.Token:
         self.current = self.tokens.next()
-        self.pdebug("^^^^^^^" + str(self.current))
         return self.current
 
     def peek(self) -> tokeniser.Token:
@@ -121,10 +144,14 @@ class Parser(object):
 
     def next_while_kind(self, match):
         while True:
-            if self.peek().kind in match:
+            try:
+                t = self.peek()
+            except StopIteration:
+                return
+            if t.code in match:
                 yield self.next()
             else:
-                raise StopIteration
+                return
 
     def next_while(self, match):
         for t in self.peek_while(match):
@@ -138,24 +165,30 @@ class Parser(object):
 
     def peek_until(self, match):
         while True:
-            if self.peek().val in match:
-                raise StopIteration
+            try:
+                t = self.peek()
+            except StopIteration:
+                return
+            if t.val in match:
+                return
             else:
-                yield self.peek()
+                yield t
 
     def peek_while(self, match):
         while True:
-            if self.peek().val in match:
-                yield self.peek()
+            try:
+                t = self.peek()
+            except StopIteration:
+                return
+            if t.val in match:
+                yield t
             else:
-                raise StopIteration
+                return
 
     def assert_next(self, kind, value=None):
         t = self.next()
-        if t.kind != kind:
-            raise ExpectedCharError(kind + ":" + value, self.current)
-        if value is not None and t.val != value:
-            raise ExpectedCharError(kind + ":" + value, self.current)
+        if t.kind != kind or (value is not None and t.val != value):
+            raise ExpectedCharError(kind if value is None else kind + ":" + value, self.current)
         return t
 
 
@@ -229,6 +262,15 @@ indent_map = {
 }
 
 
+WHITE_KINDS = frozenset((Kind.WHITESPACE, Kind.NEWLINE))
+COMMENT_KINDS = frozenset((Kind.COMMENTLINE, Kind.BLOCKCOMMENT))
+CASE_END_KINDS = frozenset((Kind.CASE, Kind.BREAK, Kind.DEFAULT, Kind.ENDBRACE, Kind.PHPEND))
+DEFAULT_END_KINDS = frozenset((Kind.BREAK, Kind.ENDBRACE, Kind.PHPEND))
+# Where parsing picks up again after a syntax error
+STATEMENT_START_KINDS = frozenset((Kind.CONTROL, Kind.TRY, Kind.IF, Kind.FUNCTION, Kind.CLASS, Kind.METHODMOD,
+                                   Kind.RETURN, Kind.THROW, Kind.GLOBAL, Kind.CASE, Kind.DEFAULT, Kind.PHPEND))
+
+
 EOF = ["EOF"]
 PHPEND = EOF + ["?>"]
 ENDBLOCK = PHPEND + ["}"]
@@ -259,19 +301,67 @@ def lookup_op_type(op_value):
         return "OPERATOR2"
 
 
+def binding_powers(op):
+    """ Get the (left, right) binding powers of an operator after something, from operator_map
+
+    An operator takes the thing before it if its left power is more than the right power of the operator
+    before that. Powers are twice the precedence, plus one on the left for operators which aren't left
+    associative, so that of two operators with the same precedence the second only wins when it associates
+    to the right. Operators with one operand after something are postfix and have no right power.
+
+    """
+    arity, prec, assoc = operator_map[op]
+    left = prec * 2 + (assoc != "left")
+    if arity == 1:
+        return left, None
+    return left, prec * 2
+
+
+OPERATOR_KINDS = {op: lookup_op_type(op) for op in operator_map if op != "EX"}
+BINDING_POWERS = {op: binding_powers(op) for op in OPERATOR_KINDS}
+BINDING_POWERS["("] = (155 * 2, None)
+BINDING_POWERS["["] = (130 * 2, None)
+# Operators which can start an expression. & is a reference here rather than a bitwise and
+PREFIX_POWERS = {op: prec * 2 for op, (arity, prec, assoc) in operator_map.items()
+                 if arity == 1 and op not in ("->{", "EX")}
+PREFIX_POWERS["&"] = operator_map["&"][1] * 2
+END_EXPRESSION = frozenset(ENDEXPRESSION)
+NEWLINE_KINDS = frozenset((Kind.NEWLINE, Kind.BLANKLINE))
+
+
 PYTHON_KEYWORDS = ["continue"]
 
 
 class PhpParser(Parser):
-    def __init__(self, linestream):
+    def __init__(self, linestream, recover=False, hash_cons=False):
+        """ Parse php from linestream
+
+        linestream can either be an iterable of lines, or the whole source as a string. A string is
+        tokenized in one go by a BufferTokenizer, which is faster for large files. A Tokenizer, such as a
+        TokenReader over tokens made earlier, is used as it is.
+
+        If recover is True, a statement with a syntax error in it becomes an ERROR node and parsing carries on
+        from the next place a statement could start. Every error is kept in errors as a Diagnostic.
+
+        If hash_cons is True, identical small subtrees in the finished tree are shared (see
+        ParseTree.intern_subtrees), which saves a lot of memory on generated php.
+
+        """
         Parser.__init__(self, "", "Test")
-        self.tokens = tokeniser.tokens(linestream)
-        logging.log(logging.DEBUG - 1, tokeniser.TOKENS)
-        self.debug_indent = 0
+        self.recover = recover
+        self.errors = []
+        if isinstance(linestream, tokeniser.Tokenizer):
+            self.tokens = linestream
+        elif isinstance(linestream, str):
+            self.tokens = tokeniser.buffer_tokens(linestream)
+        else:
+            self.tokens = tokeniser.tokens(linestream)
         self.push_scope("GLOBAL")
         self.comments = None
         try:
             self.parse()
+            if hash_cons:
+                self.pt.intern_subtrees()
         except ExpectedCharError:
             logging.critical("\n".join(self.tokens.position()))
             raise
@@ -280,7 +370,7 @@ class PhpParser(Parser):
             raise
 
     def next_non_white(self):
-        while self.peek().kind in ("WHITESPACE", "NEWLINE"):
+        while self.peek().code in WHITE_KINDS:
             self.next()
 
     def parse(self):
@@ -289,61 +379,113 @@ class PhpParser(Parser):
             h = self.parse_html()
             if h is not None:
                 self.pt.root_node.append(h)
-            if self.peek().kind == "PHPSTART":
+            if self.peek().code == Kind.PHPSTART:
                 self.pt.root_node.append(self.parse_php())
 
     def parse_html(self):
         contents = ""
-        logging.debug("Parsing html")
         t = self.peek()
-        for t in self.next_while_kind(("HTML",)):
-            logging.debug("FOUND HTML")
+        for t in self.next_while_kind((Kind.HTML,)):
             contents += t.val
         if len(contents) > 0:
-            self.pdebug("FOUND HTML CONTENTS. APPENDING NOW")
             return self.pt.new("HTML", t, contents)
         else:
             return None
 
     def parse_php(self):
-        self.pdebug("PHP:", 4)
+        if self.tracer is not None:
+            self.enter("php")
         php_node = self.pt.new("PHP", self.assert_next("PHPSTART"))
         for _ in self.peek_until(PHPEND):
             self.next_non_white()
             php_node.append(self.parse_statement())
 
-        self.next()
-        self.debug_indent -= 4
+        if self.current is None or self.current.val != "EOF":
+            # Recovering from a statement the file ended in leaves the EOF taken already
+            self.next()
+        if self.tracer is not None:
+            self.tracer.leave("php")
         return php_node
 
     def parse_statement(self):
-        self.pdebug("STATEMENT starting with {}:".format(self.peek()), 4)
+        start = self.peek()
+        scope_depth = len(self.scope)
+        try:
+            statement = self.parse_any_statement()
+            if self.peek() is start:
+                # Something like a stray } which can't start a statement
+                raise ParseError("Unexpected {}".format(start))
+            return statement
+        except ParseError as e:
+            if not self.recover:
+                raise
+            return self.recover_statement(e, start, scope_depth)
+
+    def recover_statement(self, error, start, scope_depth):
+        """ Record error and skip to where the next statement can start, returning an ERROR node in its place
+
+        Parsing carries on after a ;, or before a } or a keyword which starts a statement. If the statement
+        couldn't get past its first token, just that token is skipped.
+
+        """
+        token = error.saw if isinstance(error, ExpectedCharError) and error.saw is not None else self.peek()
+        self.errors.append(Diagnostic(error, token))
+        if self.tracer is not None:
+            self.tracer.event("error", line=token.line, col=token.col, message=str(error))
+        del self.scope[scope_depth:]
+        del self.globals[scope_depth:]
+        if token.val == "EOF" or self.current is not None and self.current.val == "EOF":
+            # The file ended part way through the statement, so there's nothing left to skip
+            pass
+        elif self.peek() is start and start.val != "EOF":
+            # Nothing could be made of the first token, so just skip it
+            self.next()
+        elif token is self.current and token.val == ";":
+            # The error was seeing the end of the statement, which has already been taken
+            pass
+        else:
+            while True:
+                try:
+                    t = self.peek()
+                except StopIteration:
+                    break
+                if t.val == "EOF" or t.val == "}" or t.code in STATEMENT_START_KINDS:
+                    break
+                self.next()
+                if t.val == ";":
+                    break
+        return self.pt.new("ERROR", start, str(error))
+
+    def parse_any_statement(self):
+        if self.tracer is not None:
+            self.enter("statement")
         self.comments = []
         # TODO: Move to using attr to look up these
-        if self.peek().kind == "CONTROL":
+        code = self.peek().code
+        if code == Kind.CONTROL:
             statement = self.parse_control()
-        elif self.peek().kind == "TRY":
+        elif code == Kind.TRY:
             statement = self.parse_try()
-        elif self.peek().kind == "IF":
+        elif code == Kind.IF:
             statement = self.parse_if()
-        elif self.peek().kind == "FUNCTION":
+        elif code == Kind.FUNCTION:
             statement = self.parse_function()
-        elif self.peek().kind == "CLASS":
+        elif code == Kind.CLASS:
             statement = self.parse_class()
-        elif self.peek().kind == "BLANKLINE":
+        elif code == Kind.BLANKLINE:
             statement = self.parse_blankline()
-        elif self.peek().kind == "METHODMOD":
+        elif code == Kind.METHODMOD:
             static = False
             visibility = None
-            while self.peek().kind == "METHODMOD":
+            while self.peek().code == Kind.METHODMOD:
                 mm = self.next()
                 if mm.val == "static":
                     static = True
                 elif mm.val in ("public", "protected", "private"):
                     visibility = mm
-            if self.peek().kind == "FUNCTION":
+            if self.peek().code == Kind.FUNCTION:
                 statement = self.parse_method(static, visibility)
-            elif self.peek().kind == "VARIABLE":
+            elif self.peek().code == Kind.VARIABLE:
                 # TODO: This should be limited, not a full expression
                 statement = self.pt.new("STATEMENT", self.peek())
                 en = self.parse_expression()
@@ -351,51 +493,52 @@ class PhpParser(Parser):
                 self.assert_next("ENDSTATEMENT", ";")
             else:
                 raise ExpectedCharError("function", self.peek().val)
-        elif self.peek().kind == "RETURN":
+        elif code == Kind.RETURN:
             statement = self.parse_simple_control("RETURN", "return")
-        elif self.peek().kind == "THROW":
+        elif code == Kind.THROW:
             statement = self.parse_simple_control("THROW", "throw")
-        elif self.peek().kind == "GLOBAL":
+        elif code == Kind.GLOBAL:
             statement = self.parse_global()
-        elif self.peek().kind == "CASE":
+        elif code == Kind.CASE:
             statement = self.parse_case()
-        elif self.peek().kind == "DEFAULT":
+        elif code == Kind.DEFAULT:
             statement = self.parse_default()
         else:
             statement = self.pt.new("STATEMENT", self.peek())
-            if self.peek().kind in ("COMMENTLINE", "BLOCKCOMMENT"):
-                while self.peek().kind in ("COMMENTLINE", "BLOCKCOMMENT"):
+            if code in COMMENT_KINDS:
+                while self.peek().code in COMMENT_KINDS:
                     self.comments.append(self.parse_comment(self.next()))
             else:
                 statement.append(self.parse_expression())
                 cur_line = self.tokens.line_number
                 if self.peek().val == ";":
                     self.next()
-                if self.peek().kind == "COMMENTLINE" and self.tokens.line_number == cur_line:
+                if self.peek().code == Kind.COMMENTLINE and self.tokens.line_number == cur_line:
                     self.comments.append(self.parse_comment(self.next()))
         # Now we've collected all the comments, append them to the statement
         for c in self.comments:
             statement.append(c)
-        self.pdebug("STATEMENT END")
-        self.debug_indent -= 4
+        if self.tracer is not None:
+            self.tracer.leave("statement")
         return statement
 
     def parse_block(self):
-        self.pdebug("Staring new block", 4)
+        if self.tracer is not None:
+            self.enter("block")
         block = self.pt.new("BLOCK", self.assert_next("STARTBRACE", "{"))
-        for _ in self.peek_until(["}"]):
-            if self.peek().kind == "PHPEND":
+        for t in self.peek_until(["}"]):
+            if t.val == "EOF":
+                raise ExpectedCharError("ENDBRACE:}", t)
+            if t.code == Kind.PHPEND:
                 self.next()
                 block.append(self.parse_html())
                 self.assert_next("PHPSTART")
                 #block.append(self.pt.new("HTML", self.next()))
             block.append(self.parse_statement())
 
-        self.pdebug("At end of block")
-        # print_tree(block)
-        self.pdebug("=-=-=-=-=-")
         self.assert_next("ENDBRACE", "}")
-        self.debug_indent -= 4
+        if self.tracer is not None:
+            self.tracer.leave("block")
         return block
 
     def parse_if(self):
@@ -406,14 +549,14 @@ class PhpParser(Parser):
             i.append(self.parse_block())
         else:
             i.append(self.parse_statement())
-        while self.peek().kind == "ELSEIF":
+        while self.peek().code == Kind.ELSEIF:
             e = self.pt.new("ELIF", self.next())
             e.append(self.parse_expression_group(self.next()))
             e.append(self.parse_block())
             i.append(e)
-        if self.peek().kind == "ELSE":
+        if self.peek().code == Kind.ELSE:
             e = self.pt.new("ELSE", self.next())
-            if self.peek().kind == "IF":
+            if self.peek().code == Kind.IF:
                 e.append(self.parse_if())
             else:
                 e.append(self.parse_block())
@@ -424,11 +567,11 @@ class PhpParser(Parser):
         case = self.pt.new("CASE", self.next())
         case.append(self.parse_expression())
         block = self.pt.new("BLOCK", self.assert_next("COLON", ":"))
-        while self.peek().kind not in ("CASE", "BREAK", "DEFAULT", "ENDBRACE"):
+        while self.peek().code not in CASE_END_KINDS:
             block.append(self.parse_statement())
-        if self.peek().kind != "BREAK":
+        if self.peek().code != Kind.BREAK:
             # self.next()
-            case.kind = "CASEFALLTHROUGH"
+            case.rename("CASEFALLTHROUGH")
         else:
             self.assert_next("BREAK")
         case.append(block)
@@ -437,9 +580,9 @@ class PhpParser(Parser):
     def parse_default(self):
         default = self.pt.new("DEFAULT", self.next())
         block = self.pt.new("BLOCK", self.assert_next("COLON", ":"))
-        while self.peek().kind not in ("BREAK", "ENDBRACE"):
+        while self.peek().code not in DEFAULT_END_KINDS:
             block.append(self.parse_statement())
-        if self.peek().kind == "BREAK":
+        if self.peek().code == Kind.BREAK:
             # Skip the break, we are at the end anyway I hope
             self.next()
         default.append(block)
@@ -448,11 +591,27 @@ class PhpParser(Parser):
     def parse_control(self):
         control_token = self.next()
         keyword = control_token.val.upper()
+        if keyword == "FOR":
+            return self.parse_for(control_token)
         c = self.pt.new(keyword, control_token)
         c.append(self.parse_expression_group(self.next()))
         c.append(self.parse_block())
         return c
 
+    def parse_for(self, for_token):
+        """ A for loop has three expression groups, for the initialisers, the conditions and the steps
+
+        """
+        f = self.pt.new("FOR", for_token)
+        self.assert_next("STARTBRACE", "(")
+        f.append(self.parse_comma_list("EXPRESSIONGROUP"))
+        self.assert_next("ENDSTATEMENT", ";")
+        f.append(self.parse_comma_list("EXPRESSIONGROUP"))
+        self.assert_next("ENDSTATEMENT", ";")
+        f.append(self.parse_expression_group(for_token))
+        f.append(self.parse_block())
+        return f
+
     def parse_try(self) -> ParseNode:
         try_node = self.pt.new("TRY", self.next())
         try_node.append(self.parse_block())
@@ -462,7 +621,7 @@ class PhpParser(Parser):
             catchmatch = self.pt.new("EXCEPTION", self.next())
             c.append(catchmatch)
 
-            if self.peek().kind == "VARIABLE":
+            if self.peek().code == Kind.VARIABLE:
                 as_node = self.pt.new("AS", t)
                 as_node.append(self.parse_variable(self.next()))
                 c.append(as_node)
@@ -472,20 +631,48 @@ class PhpParser(Parser):
         return try_node
 
     def parse_function(self):
-        self.pdebug("Doing a function call", 4)
+        if self.tracer is not None:
+            self.enter("function")
         self.push_scope("LOCAL")
         self.next()
         # Function names are case insensitive
         f = self.pt.new("FUNCTION", self.peek(), self.next().val.lower())
-        f.append(self.parse_expression_group(self.next(), "ARGSLIST"))
+        self.assert_next("STARTBRACE", "(")
+        f.append(self.parse_parameters())
         f.append(self.parse_block())
-        self.pdebug("At end of function")
-        # print_tree(f)
-        self.pdebug("=-=-=-=-=-")
-        self.debug_indent -= 4
         self.pop_scope()
+        if self.tracer is not None:
+            self.tracer.leave("function")
         return f
 
+    def parse_parameters(self):
+        """ Chomp the parameters of a function, with the types of those which have one
+
+        function f(int $a, ?string $b, $c = 1)
+                  >   ARGSLIST                <
+
+        A parameter's type is kept as a TYPE after its expression, with a ? in front for a nullable one.
+
+        """
+        params = self.pt.new("ARGSLIST", self.peek())
+        for _ in self.peek_until(ENDGROUP):
+            nullable = ""
+            if self.peek().val == "?":
+                nullable = self.next().val
+            hint = None
+            if self.peek().code in (Kind.IDENT, Kind.SPECIAL):
+                hint = self.next()
+            param = self.parse_expression()
+            if hint is not None:
+                param.append(self.pt.new("TYPE", hint, nullable + hint.val))
+            params.append(param)
+            if self.peek().code == Kind.COMMA:
+                self.next()
+            else:
+                break
+        self.assert_next("ENDBRACE", ")")
+        return params
+
     def parse_class(self):
         """ Chomp a class
 
@@ -493,7 +680,8 @@ class PhpParser(Parser):
         CLASS CLASS.val <    parse_extends    > <parse_block >
 
         """
-        self.pdebug("Doing a class call", 4)
+        if self.tracer is not None:
+            self.enter("class")
         self.push_scope("CLASS")
         self.next()
         c = self.pt.new("CLASS", self.next())
@@ -501,7 +689,8 @@ class PhpParser(Parser):
             c.append(self.parse_extends())
         c.append(self.parse_block())
         self.pop_scope()
-        self.debug_indent -= 4
+        if self.tracer is not None:
+            self.tracer.leave("class")
         return c
 
     def parse_extends(self):
@@ -519,138 +708,130 @@ class PhpParser(Parser):
         # For now, methods are functions with visibility
         f = self.parse_function()
         if static:
-            f.kind = "CLASSMETHOD"
+            f.rename("CLASSMETHOD")
         else:
-            f.kind = "METHOD"
+            f.rename("METHOD")
         if visibility is not None:
             f.append(self.pt.new("VISIBILITY", visibility))
         return f
 
     def parse_expression(self):
+        if self.tracer is not None:
+            self.enter("expression")
         ex = self.pt.new("EXPRESSION", self.peek(), "EX")
-        self.pdebug("\033[94m########Starting new expression##########", 4)
-        full_ex = []
-        noo1a = True  # We expect that the next item is a non-operator or an arrity 1 operator
-        for t in self.next_until(ENDEXPRESSION):
-            self.pdebug("Current token is {}".format(t))
-            if t.val in operator_map:
-                op_node = self.parse_operator(t)
-                if noo1a and op_node.arrity > 1:
-                    if op_node.value == "&":
-                        op_node.kind = "REFERENCE"
-                        op_node.arrity = 1
-                        op_node.assoc = "right"
-                    else:
-                        raise ParseError("Expected to see a 1-ary operator or a non-operator here")
-                full_ex.append(op_node)
-                self.pdebug("Appended an operator")
-                if t.val == "?":
-                    op_node.append((self.parse_expression()))
-                    self.assert_next("COLON", ":")
-                if t.val == "->{":
-                    op_node.append(self.parse_expression())
-                    self.assert_next("ENDBRACE", "}")
-                noo1a = True
-            elif t.kind in ("BLOCKCOMMENT", "COMMENTLINE"):
-                # Get rid of block comments for the meantime - too hard to deal with
-                self.comments.append(self.parse_comment(t))
-            elif t.val == "(":
-                # TODO: When lhs is an operator, this isn't a call...
-                self.pdebug("About to deal with an expression group")
-                eg = self.parse_expression_group("(")
-                op_node = self.pt.new("CALL", t, "")
-                op_node.append(eg)
-                op_node.arrity = 1
-                op_node.assoc = "left"
-                op_node.precedence = 155
-                full_ex.append(op_node)
-                # print_tree(full_ex[-1])
-                self.pdebug("Finished with expression group")
-                noo1a = False
-            elif t.kind == "IDENT":
-                # Hopefully we haven't missed too many ident cases
-                full_ex.append(self.parse_ident(t, bare=True))
-                noo1a = False
-            #elif t.kind == "STARTBRACE":
-            #    # Assume we have a attr lookup
-            #    full_ex.append(self.parse_startbrace())
-            else:
-                try:
-                    self.pdebug("Going to try to run parse_" + t.kind.lower())
-                    full_ex.append(getattr(self, "parse_" + t.kind.lower())(t))
-                except AttributeError:
-                    raise ParseError("function for parsing {} not yet implemented".format(t))
-                self.pdebug("Appended notoperator")
-                noo1a = False
-        self.pdebug("Expresion nodes")
-        self.pdebug([str(n) for n in full_ex])
-
-        def shuffle_stacks(op_stack, opee_stack):
-            o2 = op_stack.pop()
-            # TODO: Spell arity correctly everywhere else
-            pretend_arity = 1 if o2.arrity == 1 else 2
-            args = [opee_stack.pop() for _ in range(0, pretend_arity)]
-            [o2.children.append(a) for a in args]
-            if o2.kind not in ("CALL", "GETATTR"):
-                o2.kind = lookup_op_type(o2.value)
-            opee_stack.append(o2)
-
-        # Here follows the shunting algorithm(ish)
-        op_stack = []
-        opee_stack = []
-        for n in full_ex:
-            if n is None:
-                continue
-            if n.kind not in ("OPERATOR", "INDEX", "REFERENCE", "CALL", "GETATTR"):
-                opee_stack.append(n)
-            else:
-                if len(op_stack) == 0:
-                    op_stack.append(n)
-                else:
-                    while len(op_stack) > 0:
-                        o2 = op_stack[-1]
-                        if (n.assoc == "left" and n.precedence == o2.precedence) or n.precedence < o2.precedence:
-                            shuffle_stacks(op_stack, opee_stack)
-                        else:
-                            break
-                    op_stack.append(n)
-        while len(op_stack) != 0:
-            shuffle_stacks(op_stack, opee_stack)
-        if len(opee_stack) > 1:
-            self.pdebug("========opee_stack > 1========")
-            [print_tree(n) for n in op_stack]
-            self.pdebug("----ops-----")
-            [print_tree(n) for n in opee_stack]
-            self.pdebug("----opees-----")
-            raise ParseError("Shit")
-        elif len(opee_stack) == 1:
-            ex.append(opee_stack[0])
-        self.pdebug("Expression ended at")
-        self.pdebug(self.tokens.position()[0])
-        self.pdebug(self.tokens.position()[1])
-        self.debug_indent -= 4
+        if self.peek_expression_token() is not None:
+            ex.append(self.parse_binding(0))
+            if self.peek_expression_token() is not None:
+                raise ParseError("Expected the end of the expression, saw {}".format(self.peek()))
+        if self.tracer is not None:
+            self.tracer.leave("expression")
         return ex
 
+    def peek_expression_token(self):
+        """ Peek at the next token of an expression, or None if the expression has ended
+
+        Newlines and comments inside expressions are skipped over, with the comments kept for the statement.
+
+        """
+        while True:
+            t = self.peek()
+            if t.val in END_EXPRESSION:
+                return None
+            if t.code in COMMENT_KINDS:
+                self.comments.append(self.parse_comment(self.next()))
+            elif t.code in NEWLINE_KINDS:
+                self.next()
+            else:
+                return t
+
+    def parse_binding(self, right_power):
+        """ Parse an expression in which only operators binding tighter than right_power are included
+
+        This is a Pratt parser. Each operator's left binding power comes from BINDING_POWERS, and the right hand
+        side of an infix operator is parsed with that operator's own right binding power.
+
+        """
+        t = self.peek_expression_token()
+        if t is None:
+            raise ParseError("Expected an operand, saw {}".format(self.peek()))
+        self.next()
+        left = self.parse_prefix(t)
+        while True:
+            t = self.peek_expression_token()
+            if t is None:
+                return left
+            powers = BINDING_POWERS.get(t.val)
+            if powers is None or powers[0] <= right_power:
+                return left
+            self.next()
+            left = self.parse_infix(t, left, powers[1])
+
+    def parse_prefix(self, t):
+        """ Parse something at the start of an expression: an operand, a prefix operator or a bracketed group
+
+        """
+        if t.val in OPERATOR_KINDS:
+            right_power = PREFIX_POWERS.get(t.val)
+            if right_power is None:
+                raise ParseError("Expected to see a 1-ary operator or a non-operator here")
+            op_node = self.pt.new(OPERATOR_KINDS[t.val], t)
+            return self.reduce(op_node, [self.parse_binding(right_power)])
+        if t.val == "(":
+            return self.parse_expression_group(t)
+        parse_operand = OPERAND_PARSERS.get(t.code)
+        if parse_operand is None:
+            raise ParseError("function for parsing {} not yet implemented".format(t))
+        return parse_operand(self, t)
+
+    def parse_infix(self, t, left, right_power):
+        """ Parse the operator t, which has left on its left. Postfix operators have a right_power of None
+
+        """
+        if t.val == "(":
+            eg = self.parse_expression_group(t)
+            op_node = self.pt.new("CALL", t, "")
+            op_node.append(eg)
+            return self.reduce(op_node, [left])
+        if t.val == "[":
+            return self.reduce(self.parse_index(t), [left])
+        op_node = self.pt.new(OPERATOR_KINDS[t.val], t)
+        if t.val == "?":
+            op_node.append(self.parse_expression())
+            self.assert_next("COLON", ":")
+        elif t.val == "->{":
+            op_node.append(self.parse_expression())
+            self.assert_next("ENDBRACE", "}")
+        if right_power is None:
+            return self.reduce(op_node, [left])
+        return self.reduce(op_node, [self.parse_binding(right_power), left])
+
+    def reduce(self, op_node, operands):
+        """ Give op_node its operands, right hand one first
+
+        """
+        for o in operands:
+            op_node.append(o)
+        if self.tracer is not None:
+            self.tracer.reduce(op_node, operands)
+        return op_node
+
     def parse_expression_group(self, start_token, kind="EXPRESSIONGROUP"):
         eg = self.parse_comma_list(kind)
         self.assert_next("ENDBRACE", ")")
         return eg
 
     def parse_comma_list(self, kind="COMMALIST"):
-        self.pdebug("COMMA LIST", 4)
+        if self.tracer is not None:
+            self.enter("commalist")
         cl = self.pt.new(kind, self.peek())
-        self.pdebug(self.peek())
         for _ in self.peek_until(ENDGROUP):
             cl.append(self.parse_expression())
-            if self.peek().kind == "COMMA":
+            if self.peek().code == Kind.COMMA:
                 self.next()
             else:
                 break
-        self.pdebug("Reached end of comma list at")
-        self.pdebug(repr(self.peek().val))
-        self.pdebug(self.tokens.position()[0])
-        self.pdebug(self.tokens.position()[1])
-        self.debug_indent -= 4
+        if self.tracer is not None:
+            self.tracer.leave("commalist")
         return cl
 
     def parse_variable(self, var_token):
@@ -664,10 +845,7 @@ class PhpParser(Parser):
         return var
 
     def parse_string(self, string_token):
-        self.pdebug("STRING:", 4)
-        self.pdebug("String is {}".format(string_token))
         s = string_token.val[1:-1]
-        self.pdebug("String contents are " + s)
 
         # TODO: Lots of work parsing strings
         #st = tokeniser.tokens(iter([s]), keep_white=True)
@@ -677,7 +855,6 @@ class PhpParser(Parser):
             #print("tokens")
             #try:
                 #t = st.next()
-                #self.pdebug("{} found in string".format(t))
             #except StopIteration:
                 #break
             #if t.kind == "ESCAPE":
@@ -689,7 +866,6 @@ class PhpParser(Parser):
                 #format_vars.append(self.pt.new("VARIABLE", t.val))
         string = self.pt.new("STRING", string_token, s)
         #string.children = format_vars
-        self.debug_indent -= 4
         return string
 
     def parse_simple_control(self, name, value):
@@ -719,14 +895,6 @@ class PhpParser(Parser):
             self.next()
         return g
 
-    def parse_operator(self, op_token):
-        arrity, prec, assoc = operator_map[op_token.val]
-        op_node = self.pt.new("OPERATOR", op_token)
-        op_node.arrity = arrity
-        op_node.precedence = prec
-        op_node.assoc = assoc
-        return op_node
-
     def parse_int(self, int_token):
         if len(int_token.val) > 1 and int_token.val[0] == "0":
             # IGNORE: We are deliberately ignoring what php call octal weirdness
@@ -734,10 +902,7 @@ class PhpParser(Parser):
         # TODO: Implement hex
         return self.pt.new("INT", int_token, int(int_token.val))
 
-    def parse_newline(self, t=None):
-        if t is not None:
-            # If t isn't none, then this was called from within an expression
-            return None
+    def parse_newline(self):
         t = self.next()
         return self.pt.new("NOOP", t, "\n")
 
@@ -750,15 +915,12 @@ class PhpParser(Parser):
 
         """
         if ident.val in indent_map:
-            ident.val = indent_map[ident.val]
+            return self.pt.new("IDENT", ident, indent_map[ident.val])
         elif bare:
             # Assume all bare idents which aren't message calls and are bare  are constants
             return self.pt.new("CONSTANT", ident)
         return self.pt.new("IDENT", ident)
 
-    def parse_unknown(self):
-        raise UnexpectedCharError(None)
-
     def parse_index(self, t):
         """
         Args:
@@ -766,14 +928,21 @@ class PhpParser(Parser):
         """
         i = self.pt.new("INDEX", t)
         i.append(self.parse_expression())
-        i.precedence = 130
-        i.arrity = 1
-        i.assoc = "left"
         self.assert_next("ENDBRACE", "]")
         return i
 
     def parse_comment(self, comment_token):
-        if comment_token.kind == "COMMENTLINE":
+        if comment_token.code == Kind.COMMENTLINE:
             return self.pt.new("COMMENTLINE", comment_token, value=comment_token.val[2:])
         else:
             return self.pt.new("COMMENTBLOCK", comment_token, value=comment_token.val.strip(" \t\r\n*/"))
+
+
+# How to parse each kind of token when it's an operand in an expression
+OPERAND_PARSERS = {
+    Kind.VARIABLE: PhpParser.parse_variable,
+    Kind.STRING: PhpParser.parse_string,
+    Kind.INT: PhpParser.parse_int,
+    Kind.SPECIAL: PhpParser.parse_special,
+    Kind.IDENT: lambda parser, t: parser.parse_ident(t, bare=True),
+}
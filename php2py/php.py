@@ -29,8 +29,8 @@ class PhpApp(object):
             for r in config["rewrites"]:
                 self.rewrites.append((r["match"], r["dest"]))
 
-        # TODO: body_str should be replaced with an iterable - list probably
-        self.body_str = ""
+        # The pieces of the body, which are only joined once the whole page is written
+        self.body = []
         self.environ = {}
         self._headers = OrderedDict()
         self.response_code = 500
@@ -50,9 +50,12 @@ class PhpApp(object):
         self.error_level = self.constants.E_ALL
 
     def write(self, item):
-        # Write the item as a string to the body string
-        # TODO: Build the body string much more nicely. Think about making a phpfunction called echo instead
-        self.body_str += str(item)
+        # Adding to a string would copy the body so far every time
+        self.body.append(str(item))
+
+    @property
+    def body_str(self) -> str:
+        return "".join(self.body)
 
     # TODO: You are doing this wrong?
     @property
@@ -114,7 +117,7 @@ class WsgiApp(PhpApp):
     def __call__(self, environ: dict, start_response):
         init_metavars(self)
         self.i = {}
-        self.body_str = ""
+        self.body = []
         # TODO: This isn't thread safe at all
         # TODO: it probably isn't even cross request safe
         self.environ = environ
@@ -7,6 +7,56 @@ from php2py.engine.exceptions import HttpRedirect
 from .phptypes import PhpArray
 
 
+# The number php reads from the start of a string when converting it, ignoring anything after
+NUMERIC_PREFIX = re.compile(r"\s*[+-]?(\d+(\.\d*)?|\.\d+)([eE][+-]?\d+)?")
+
+DIGITS = string.digits + string.ascii_lowercase
+
+# The prefixes which give the base of an integer, when the base is 0 or that base
+BASE_PREFIXES = {"0x": 16, "0b": 2}
+
+
+def int_prefix(value: str, base: int) -> int:
+    """ The integer in base php reads from the start of value, as C's strtol would
+
+    A base of 0 is taken from the prefix, as 16 for 0x, 2 for 0b, 8 for 0 and 10 for anything else.
+
+    """
+    if not (base == 0 or 2 <= base <= 36):
+        return 0
+    value = value.lstrip(" \t\n\r\v\f")
+    sign = -1 if value[:1] == "-" else 1
+    if value[:1] in ("+", "-"):
+        value = value[1:]
+    prefix_base = BASE_PREFIXES.get(value[:2].lower())
+    if prefix_base is not None and base in (0, prefix_base) and value[2:3].lower() in DIGITS[:prefix_base]:
+        value = value[2:]
+        base = prefix_base
+    elif base == 0:
+        base = 8 if value[:1] == "0" else 10
+    end = 0
+    while end < len(value) and value[end].lower() in DIGITS[:base]:
+        end += 1
+    return sign * int(value[:end], base) if end > 0 else 0
+
+
+def float_to_string(value: float) -> str:
+    """ Php prints floats to 14 significant figures, with exponents as in 1.0E+25
+
+    """
+    if value != value:
+        return "NAN"
+    if value in (float("inf"), float("-inf")):
+        return "INF" if value > 0 else "-INF"
+    s = "{:.14G}".format(value)
+    if "E" not in s:
+        return s
+    mantissa, exponent = s.split("E")
+    if "." not in mantissa:
+        mantissa += ".0"
+    return "{}E{:+d}".format(mantissa, int(exponent))
+
+
 class Functions:
 
     def header(self, header: str, replace: bool = True, http_response_code: None = None) -> None:
@@ -28,7 +78,7 @@ class Functions:
             if str(self.app.response_code)[0] != "3" and str(self.app.response_code) != "201":
                 raise HttpRedirect(302)
 
-    def str_replace(self, search: str, replace: str, subject: str, count: Optional[int] = None) -> str:
+    def str_replace(self, search: str, replace: str, subject: str, count: Optional[int] = None) -> Union[str, PhpArray]:
         """ Replaces instances of a string
     
         Note that this can accept either arrays of strings...........
@@ -42,7 +92,7 @@ class Functions:
             raise NotImplementedError
         return subject.replace(search, replace, count)
 
-    def preg_replace(self, pattern: str, replacement: str, subject: str, limit: int = -1) -> str:
+    def preg_replace(self, pattern: str, replacement: str, subject: str, limit: int = -1) -> Union[str, PhpArray, None]:
         if isinstance(pattern, PhpArray) or isinstance(replacement, PhpArray):
             raise NotImplementedError("Php can take arrays as args to preg_replace")
         # TODO: There are a lot of differences between regex engines in different languages
@@ -106,6 +156,58 @@ class Functions:
             return 0
         return len(s)
 
+    def strval(self, value: Any) -> str:
+        """ value as php would print it
+
+        """
+        if isinstance(value, str):
+            return value
+        if value is None:
+            return ""
+        if isinstance(value, bool):
+            return "1" if value else ""
+        if isinstance(value, float):
+            return float_to_string(value)
+        if hasattr(value, "_php_tostring"):
+            return value._php_tostring()
+        return str(value)
+
+    def intval(self, value: Any, base: int = 10) -> int:
+        if isinstance(value, str):
+            if base != 10:
+                return int_prefix(value, base)
+            match = NUMERIC_PREFIX.match(value)
+            if match is None:
+                return 0
+            if match.group(2) is not None or match.group(3) is not None:
+                return self.intval(float(match.group(0)))
+            return int(match.group(0))
+        if isinstance(value, float):
+            # Php gives 0 rather than an error for nan and infinity
+            if value != value or value in (float("inf"), float("-inf")):
+                return 0
+            return int(value)
+        if value is None:
+            return 0
+        if isinstance(value, PhpArray):
+            return 1 if len(value) > 0 else 0
+        if isinstance(value, int):
+            return int(value)
+        return 1
+
+    def floatval(self, value: Any) -> float:
+        if isinstance(value, str):
+            match = NUMERIC_PREFIX.match(value)
+            return 0.0 if match is None else float(match.group(0))
+        return float(self.intval(value)) if not isinstance(value, float) else value
+
+    def boolval(self, value: Any) -> bool:
+        if isinstance(value, str):
+            return value not in ("", "0")
+        if isinstance(value, PhpArray):
+            return len(value) > 0
+        return bool(value)
+
     abspath = os.path.abspath
 
     def get_included_files(self) -> PhpArray:
@@ -113,7 +215,7 @@ class Functions:
 
     get_required_files = get_included_files
 
-    def getenv(self, varname: str) -> str:
+    def getenv(self, varname: str) -> Union[str, bool]:
         """ The value of the environment variable varname
 
         These might just be the contents of the _SERVER array?
@@ -183,7 +285,7 @@ class Functions:
                   extra_headers: str = None):
         raise NotImplementedError()
 
-    def error_reporting(self, level: int) -> int:
+    def error_reporting(self, level: int) -> Any:
         ol = self.app.error_level
         self.app.error_level = level
         return ol
@@ -248,7 +350,7 @@ class Functions:
         except:
             return False
 
-    def getmyuid(self) -> int:
+    def getmyuid(self) -> Union[int, bool]:
         try:
             return os.getuid()
         except:
@@ -282,7 +384,7 @@ class Functions:
 
     phpinfo = phpcredits
 
-    def phpversion(self, extension: str = None) -> str:
+    def phpversion(self, extension: str = None) -> Union[str, bool]:
         if extension is not None:
             raise NotImplementedError()
         return self.c.PHP_VERSION
@@ -310,7 +412,7 @@ class Functions:
         """
         raise NotImplementedError()
 
-    def ini_set(self, name: str, value: str) -> str:
+    def ini_set(self, name: str, value: str) -> Union[str, bool, None]:
         # TODO: Set the old value somewhere so we can use restore on it
         old = None
         if name in self.app.ini:
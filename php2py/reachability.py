@@ -0,0 +1,143 @@
+""" Dropping code which can never run
+
+Statements after a return, throw, exit or die in the same block are dropped. So are if and elseif branches whose
+condition folding has made constant false, and while loops which never run. An if whose first remaining branch is
+constant true is replaced by the statements in that branch.
+
+Php declares the functions and classes at the top level of a file before running any of it, so the statements
+registering them are kept even after an exit.
+
+"""
+import logging
+from typing import List, Optional
+
+from .clib import visitor
+from .intermediate import *
+from . import folding
+
+
+def eliminate(root: RootNode, warn: bool=False) -> List[IntermediateNode]:
+    """ Drop the unreachable code in every function and method
+
+    Returns the statements and branches dropped. If warn is set, a warning is logged for each.
+
+    """
+    top_level = root.functions[-1].body
+    dropped = []
+
+    def post(node, results):
+        if node.kind == "BLOCK":
+            node.children = reachable(node.children, node is top_level, dropped)
+
+    visitor.walk(root, post=post)
+    if warn:
+        for node in dropped:
+            if not is_noop(node):
+                logging.warning("Line {}, column {}: dropped code which can never run".format(node.line, node.col))
+    return dropped
+
+
+def reachable(statements: List[StatementNode], top_level: bool, dropped: List[IntermediateNode]):
+    """ The statements of a block which can run, with any constant branches taken out
+
+    The blocks inside the statements have been done already.
+
+    """
+    kept = []
+    ended = False
+    for statement in statements:
+        if ended:
+            if top_level and is_declaration(statement):
+                kept.append(statement)
+            else:
+                dropped.append(statement)
+            continue
+        for s in simplify(statement, dropped):
+            if ended:
+                dropped.append(s)
+            else:
+                kept.append(s)
+                ended = terminates(s)
+    return kept
+
+
+def simplify(statement: StatementNode, dropped: List[IntermediateNode]) -> List[StatementNode]:
+    """ The statements to replace statement with once branches that can't run are dropped
+
+    """
+    if statement.kind == "IF":
+        return simplify_if(statement, dropped)
+    if statement.kind == "WHILE" and constant(statement.condition) is False:
+        dropped.append(statement)
+        return []
+    return [statement]
+
+
+def simplify_if(statement: IfNode, dropped: List[IntermediateNode]) -> List[StatementNode]:
+    # Each branch as its condition, or None for one which always runs, its block and its node
+    branches = []
+    for condition, block, node in [(statement.condition, statement.block, statement)] + \
+            [(e.condition if e.kind == "ELIF" else BoolNode("True"), e.block, e) for e in statement.elses]:
+        value = constant(condition)
+        if value is False or len(branches) > 0 and branches[-1][0] is None:
+            dropped.append(node)
+        else:
+            branches.append((None if value else condition, block, node))
+
+    if len(branches) == 0:
+        return []
+    if branches[0][0] is None:
+        return branches[0][1].children
+    statement.condition = branches[0][0]
+    statement.block = branches[0][1]
+    statement.elses = []
+    for condition, block, node in branches[1:]:
+        if condition is None:
+            statement.elses.append(node if node.kind == "ELSE" else ElseNode(node.parse_node, block))
+        else:
+            statement.elses.append(node)
+    return [statement]
+
+
+def constant(condition: ExpressionNode) -> Optional[bool]:
+    """ Whether condition is always true or always false, or None if it isn't known
+
+    """
+    try:
+        return folding.to_bool(folding.literal(condition))
+    except folding.NotConstant:
+        return None
+
+
+def terminates(statement: StatementNode) -> bool:
+    """ Whether the statements after statement in its block can never run
+
+    """
+    if statement.kind in ("RETURN_STATEMENT", "THROW_STATEMENT"):
+        return True
+    if statement.kind == "EX_STATEMENT" and statement.child.kind == "CALL":
+        return folding.is_f_call(statement.child, "exit") or folding.is_f_call(statement.child, "die")
+    if statement.kind == "IF":
+        # Every branch has to end, including an else
+        return (len(statement.elses) > 0 and statement.elses[-1].kind == "ELSE" and
+                all(any(terminates(s) for s in b.block) for b in [statement] + statement.elses))
+    return False
+
+
+def is_declaration(statement: StatementNode) -> bool:
+    """ Whether statement registers a function or class, as in _f_.foo = foo
+
+    """
+    if statement.kind != "EX_STATEMENT" or statement.child.kind != "ASSIGNMENT":
+        return False
+    lhs = statement.child.lhs
+    rhs = statement.child.rhs
+    return (lhs.kind == "OPERATOR2" and lhs.lhs.kind == "VAR" and lhs.lhs.value in ("_f_", "_c_") and
+            rhs.kind == "VAR" and rhs.value == lhs.rhs.value)
+
+
+def is_noop(node: IntermediateNode) -> bool:
+    """ Whether node is just a blank line or a comment, which isn't worth a warning
+
+    """
+    return node.kind == "NOOP" or node.kind == "EX_STATEMENT" and node.child.kind == "NOOP"
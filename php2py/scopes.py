@@ -0,0 +1,269 @@
+""" Scope analysis over the intermediate tree
+
+Works out whether each php variable is local to its function, a global or a superglobal, as described under
+Locals in optimise.rst. Locals are plain python locals, which are much faster than going through _g_. Php gives
+null for a variable which hasn't been set yet where python would raise UnboundLocalError, so every local which
+isn't an argument is set to None at the start of its function.
+
+Globals go through _g_, whose attribute lookups are slow, so the globals a function uses a lot are also loaded into
+locals when it starts and stored back whenever it exits, as described under Globals in optimise.rst.
+
+"""
+import collections
+from typing import List
+
+from .clib import visitor
+from .intermediate import *
+from .parser import super_globals
+from .phpbaselib.functions import Functions
+from .phpbaselib.specials import Specials
+
+
+# Globals referenced more than this many times in a function are held in locals while it runs
+MIN_GLOBALS_REFACTOR = 2
+
+# Builtins which run php code of their own, which could see or change a global while it's held in a local
+RUNS_PHP = {"eval", "include", "include_once", "require", "require_once", "trigger_error"}
+
+SAFE_BUILTINS = {n for n in dir(Functions) + dir(Specials) if not n.startswith("_")} - RUNS_PHP
+
+# The start of the names of the module constants which switches look their cases up in
+CASE_TABLE = "_cases_"
+
+
+def is_php_variable(node: IntermediateNode) -> bool:
+    """ Whether node is a variable from the php, rather than one made up by the transformer such as _g_
+
+    """
+    return (isinstance(node, VariableNode) and node.parse_node is not None and
+            node.parse_node.kind in ("VAR", "GLOBALVAR"))
+
+
+def analyse(root: RootNode, min_globals_refactor: int=MIN_GLOBALS_REFACTOR):
+    """ Classify the variables in every function and method, and set up their locals
+
+    """
+    functions = list(root.functions)
+    for c in root.classes:
+        functions.extend(c.methods)
+    while functions:
+        function = functions.pop()
+        # Functions declared inside others are found as we go
+        functions.extend(analyse_function(function))
+        hoist_globals(function, min_globals_refactor)
+
+
+def analyse_function(function: FunctionNode) -> List[FunctionNode]:
+    """ Classify the variables in function and set function.locals
+
+    Returns any functions declared inside function, which are scopes of their own.
+
+    """
+    arguments = []
+    declared = set()
+    nested = []
+
+    def argument(node, depth):
+        if is_php_variable(node):
+            node.scope = "local"
+            arguments.append(node.value)
+
+    def classify(node, depth):
+        if node.kind in ("FUNCTION", "METHOD", "CLASSMETHOD") and node is not function:
+            nested.append(node)
+            return False
+        if node.kind == "CLASS":
+            nested.extend(node.methods)
+            return False
+        if node.kind == "GLOBAL":
+            for v in node.variables:
+                v.scope = "global"
+                declared.add(v.value)
+            return False
+        if is_php_variable(node):
+            if node.value in super_globals:
+                node.scope = "superglobal"
+            elif node.parse_node.kind == "GLOBALVAR" or node.value in declared:
+                node.scope = "global"
+            else:
+                node.scope = "local"
+                if node.value not in local_names:
+                    local_names.append(node.value)
+
+    for a in function.args:
+        visitor.walk(a, pre=argument)
+    local_names = list(arguments)
+    # Locals which are first set by an assignment straight in the function body, so can't be read unset
+    assigned = set()
+    for statement in function.body:
+        name, value = assigned_variable(statement)
+        if name is not None and name not in local_names and name not in variable_names(value):
+            assigned.add(name)
+        visitor.walk(statement, pre=classify)
+
+    function.locals = local_names
+    uninitialised = [n for n in local_names if n not in arguments and n not in assigned and n != "this"]
+    if len(uninitialised) > 0:
+        function.body.children.insert(0, initialise(uninitialised))
+    drop_exit_values(function)
+    return nested
+
+
+def assigned_variable(statement: StatementNode):
+    """ The name of the php variable statement assigns to and what it's set from, or None, None
+
+    Only plain assignments like $a = 1 and counted for loops count.
+
+    """
+    if statement.kind == "EX_STATEMENT" and statement.child.kind == "ASSIGNMENT" and statement.child.value == "=" and \
+            is_php_variable(statement.child.lhs):
+        return statement.child.lhs.value, statement.child.rhs
+    if statement.kind == "FOR" and statement.exit_value is not None and is_php_variable(statement.thing):
+        return statement.thing.value, statement.items
+    return None, None
+
+
+def variable_names(node: IntermediateNode) -> set:
+    names = set()
+
+    def add(n, depth):
+        if is_php_variable(n):
+            names.add(n.value)
+    visitor.walk(node, pre=add)
+    return names
+
+
+def initialise(names: List[str]) -> ExpressionStatement:
+    """ A statement setting each of names to None, as in a = b = None
+
+    """
+    value = NoneNode("None")
+    for name in reversed(names):
+        value = AssignmentNode("=", VariableNode(name), value)
+    return ExpressionStatement("", value)
+
+
+def drop_exit_values(function: FunctionNode):
+    """ Drop the statements after counted for loops which set the loop variable as php leaves it
+
+    They're only needed when something outside a counted loop over the same local reads the variable.
+
+    """
+    exits = {}
+    counting = []
+    outside = set()
+
+    def pre(node, depth):
+        if node.kind in ("FUNCTION", "METHOD", "CLASSMETHOD", "CLASS") and node is not function:
+            return False
+        if id(node) in exits:
+            return False
+        if node.kind == "FOR" and node.exit_value is not None:
+            exits[id(node.exit_value)] = node
+            counting.append(node.thing.value)
+        elif is_php_variable(node) and node.value not in counting:
+            outside.add(node.value)
+
+    def post(node, results):
+        if node.kind == "FOR" and node.exit_value is not None:
+            counting.pop()
+
+    visitor.walk(function.body, pre=pre, post=post)
+    drop = {i for i, loop in exits.items()
+            if is_php_variable(loop.thing) and loop.thing.scope == "local" and loop.thing.value not in outside}
+    if len(drop) == 0:
+        return
+
+    def remove(node, depth):
+        if node.kind == "BLOCK":
+            node.children = [c for c in node.children if id(c) not in drop]
+
+    visitor.walk(function.body, pre=remove)
+
+
+def is_global_access(node: IntermediateNode) -> bool:
+    """ Whether node is a php global reached through _g_, as in _g_.a
+
+    """
+    return (node.kind == "OPERATOR2" and node.value == "." and node.lhs.kind == "VAR" and node.lhs.value == "_g_" and
+            is_php_variable(node.rhs))
+
+
+def can_run_php(call: CallNode) -> bool:
+    """ Whether call could run php code, which might use the globals
+
+    Magic methods such as __get and __toString aren't allowed for.
+
+    """
+    callee = call.callee
+    if callee.kind == "IDENT":
+        # Python builtins such as del and getattr
+        return False
+    if callee.kind == "OPERATOR2" and callee.lhs.kind == "VAR" and callee.lhs.value == "_f_":
+        return callee.rhs.value not in SAFE_BUILTINS
+    if callee.kind == "OPERATOR2" and callee.lhs.kind == "VAR" and callee.lhs.value.startswith(CASE_TABLE):
+        # Looking a switch's branch up in its table of cases
+        return False
+    return True
+
+
+def hoisted_name(name: str) -> str:
+    return "_g_" + name
+
+
+def hoist_globals(function: FunctionNode, min_references: int):
+    """ Hold the globals function uses more than min_references times in locals while it runs
+
+    They're loaded at the start, and stored back in a finally so that returns and exceptions store them too. Nothing
+    is hoisted if function calls anything which could use a global while it's held in a local, unsets a global or
+    uses $GLOBALS.
+
+    """
+    references = collections.Counter()
+    safe = True
+
+    def count(node, depth):
+        nonlocal safe
+        if node.kind in ("FUNCTION", "METHOD", "CLASSMETHOD", "CLASS") and node is not function:
+            return False
+        if is_global_access(node):
+            references[node.rhs.value] += 1
+        elif node.kind == "CALL":
+            if can_run_php(node):
+                safe = False
+            elif node.callee.value == "del" and any(is_global_access(a) for a in node.args):
+                safe = False
+
+    visitor.walk(function.body, pre=count)
+    if not safe or "GLOBALS" in references:
+        return
+    names = [n for n, c in references.items() if c > min_references]
+    if len(names) == 0:
+        return
+
+    def local(node):
+        if is_global_access(node) and node.rhs.value in names:
+            return VariableNode(hoisted_name(node.rhs.value))
+        return node
+
+    def replace(node, depth):
+        if node.kind in ("FUNCTION", "METHOD", "CLASSMETHOD", "CLASS") and node is not function:
+            return False
+        node.replace_children(local)
+
+    visitor.walk(function.body, pre=replace)
+    loads = []
+    stores = []
+    for name in names:
+        loads.append(assignment(VariableNode(hoisted_name(name)), global_access(name)))
+        stores.append(assignment(global_access(name), VariableNode(hoisted_name(name))))
+    finally_ = FinallyNode("", BlockNode("", stores))
+    function.body.children = loads + [TryNode("", BlockNode("", function.body.children), [], finally_)]
+
+
+def global_access(name: str) -> Operator2Node:
+    return Operator2Node(".", VariableNode("_g_"), VariableNode(name))
+
+
+def assignment(lhs: ExpressionNode, rhs: ExpressionNode) -> ExpressionStatement:
+    return ExpressionStatement("", AssignmentNode("=", lhs, rhs))
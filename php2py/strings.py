@@ -0,0 +1,240 @@
+""" Building strings without copying them over and over
+
+Php strings are mutable, so $s .= $x in a loop only copies $x. Python strings aren't. CPython gets round this for a
+local by growing the string in place when nothing else refers to it, but it can't for an attribute, so each
+_g_.s += x or this.s += x copies all of s, which makes building a page up a piece at a time quadratic. A loop which
+only appends to a global or to a property of $this appends the pieces to a list instead, which is joined and stored
+once the loop is done.
+
+Chains of . operators compile to a single f-string or join, rather than a + for each part which copies the string
+built so far every time. So does a single . unless typer has proven both sides strings, as the f-string or join
+converts them the way php would. What a .= appends to could be null, a number or anything else, so unless typer has
+proven it a string it's converted first. A local is converted in a statement of its own and then grown with a += as
+before, and anything else is assigned the two joined.
+
+"""
+import collections
+import copy
+from typing import List, Optional
+
+from .clib import visitor
+from .intermediate import *
+from . import folding
+from . import scopes
+from . import typer
+
+
+# Chains with fewer parts than this are left as + if every part is a string
+CHAIN_LENGTH = 3
+
+
+def build(root: RootNode):
+    """ Rewrite the loops building strings and the chains of . in every function and method
+
+    Has to run after scopes.analyse, so that globals held in locals are left alone, and after typer.infer.
+
+    """
+    def pre(node, depth):
+        if node.kind == "BLOCK":
+            statements = []
+            for statement in node.children:
+                statements.extend(build_in_loop(statement))
+            node.children = statements
+
+    visitor.walk(root, pre=pre)
+    join_chains(root)
+    convert_appends(root)
+
+
+def build_in_loop(statement: StatementNode) -> List[StatementNode]:
+    """ The statements to replace statement with, appending to lists for what it only appends to if it's a loop
+
+    The lists are joined in a finally, so that the global or property is right whichever way the loop is left. A list
+    starts with the target as it was, which is only converted to a string, and the target set, if anything was
+    appended, as php would leave a target the loop didn't append to as it was.
+
+    """
+    if statement.kind not in ("FOR", "WHILE"):
+        return [statement]
+    targets = appended_only(statement)
+    if len(targets) == 0:
+        return [statement]
+
+    def append(node):
+        if is_append(node) and target_name(node.child.lhs) in targets:
+            return ExpressionStatement(node.parse_node, CallNode("", attribute(parts(node.child.lhs), "append"),
+                                                                 [node.child.rhs]))
+        return node
+
+    def replace(node, depth):
+        node.replace_children(append)
+
+    visitor.walk(statement, pre=replace)
+
+    starts = []
+    joins = []
+    for target in targets.values():
+        starts.append(scopes.assignment(parts(target), ListNode("", [target])))
+        appended = Operator2Node(">", CallNode("", IdentNode("len"), [parts(target)]), IntNode("1"))
+        first = IndexNode("", parts(target), IntNode("0"))
+        joins.append(IfNode("", appended, BlockNode("", [
+            # Php takes the string the target starts as, whatever type it had
+            scopes.assignment(first, ConcatNode("", [IndexNode("", parts(target), IntNode("0"))])),
+            scopes.assignment(read_again(target), CallNode("", attribute(StringNode(""), "join"), [parts(target)])),
+        ]), []))
+    return starts + [TryNode("", BlockNode("", [statement]), [], FinallyNode("", BlockNode("", joins)))]
+
+
+def appended_only(loop: StatementNode) -> dict:
+    """ The globals and properties of $this which loop only appends to with .=, by target_name
+
+    Nothing is returned if loop calls anything which could see them, as for scopes.hoist_globals.
+
+    """
+    appended = {}
+    references = collections.Counter()
+    safe = True
+
+    def count(node, depth):
+        nonlocal safe
+        if node.kind in ("FUNCTION", "METHOD", "CLASSMETHOD", "CLASS"):
+            return False
+        if is_append(node) and target_name(node.child.lhs) is not None:
+            name = target_name(node.child.lhs)
+            appended[name] = node.child.lhs
+            references[name] -= 1
+        elif node.kind == "CALL" and scopes.can_run_php(node):
+            safe = False
+        elif node.kind == "VAR" and node.value == "GLOBALS":
+            safe = False
+        elif node.kind == "OPERATOR2" and node.value == "." and node.rhs.kind not in ("IDENT", "VAR"):
+            # A property looked up by a name worked out at runtime could be any of them
+            safe = False
+        elif node.kind == "OPERATOR2" and node.value == ".":
+            # Counted by name alone, as some other variable could refer to $this
+            references[target_name(node) or node.rhs.value] += 1
+
+    visitor.walk(loop, pre=count)
+    if not safe:
+        return {}
+    # The lhs of each append was counted once as a reference too, so anything left is a reference of some other sort
+    return {n: t for n, t in appended.items() if references[n] == 0}
+
+
+def target_name(node: ExpressionNode) -> Optional[str]:
+    """ A name for node if it's a global or a property of $this, as in _g_.a or this.a, else None
+
+    """
+    if scopes.is_global_access(node):
+        return "g_" + node.rhs.value
+    if node.kind == "OPERATOR2" and node.value == "." and node.lhs.kind == "VAR" and node.lhs.value == "this" and \
+            node.rhs.kind == "IDENT":
+        return "this_" + node.rhs.value
+    return None
+
+
+def is_append(node: IntermediateNode) -> bool:
+    """ Whether node is a statement like $a .= $b
+
+    """
+    return (node.kind == "EX_STATEMENT" and node.child.kind == "ASSIGNMENT" and
+            node.child.parse_node is not None and node.child.parse_node.value == ".=")
+
+
+def parts(target: ExpressionNode) -> VariableNode:
+    """ The list the pieces of target are appended to while a loop builds it
+
+    """
+    return VariableNode("_parts_" + target_name(target))
+
+
+def attribute(node: ExpressionNode, name: str) -> Operator2Node:
+    return Operator2Node(".", node, IdentNode(name))
+
+
+def join_chains(root: RootNode):
+    """ Replace each chain of at least CHAIN_LENGTH php . operators with a ConcatNode, as well as shorter ones with
+    parts which need converting to strings
+
+    """
+    replacements = {}
+
+    def post(node, results):
+        node.replace_children(lambda c: replacements.pop(id(c), c))
+        if node.kind == "OPERATOR2" and folding.is_php_operator(node) and node.parse_node.value == ".":
+            chain = chain_parts(node)
+            if len(chain) >= CHAIN_LENGTH or any(p.type != "str" for p in chain):
+                replacements[id(node)] = ConcatNode(node.parse_node, chain)
+
+    visitor.walk(root, post=post)
+
+
+def chain_parts(node: Operator2Node) -> List[ExpressionNode]:
+    """ The operands of the chain of . which node ends
+
+    Php's . is left associative, so a chain is nested down its left hand side. The shorter chains inside have been
+    looked at already, so the left hand side can be a chain of . left as it was or one already made into a ConcatNode.
+
+    """
+    rhs = [node.rhs]
+    lhs = node.lhs
+    while lhs.kind == "OPERATOR2" and folding.is_php_operator(lhs) and lhs.parse_node.value == ".":
+        rhs.append(lhs.rhs)
+        lhs = lhs.lhs
+    chain = lhs.parts if lhs.kind == "CONCAT" else [lhs]
+    return chain + list(reversed(rhs))
+
+
+def convert_appends(root: RootNode):
+    """ Replace each .= which typer hasn't proven appends to a string with an assignment of a ConcatNode
+
+    A .= statement on a local is left as a +=, after converting the local once, so that python can still grow it in
+    place. A target which reading again could do something else, such as an index found by a call, is left as a +=.
+
+    """
+    def pre(node, depth):
+        if node.kind == "BLOCK":
+            statements = []
+            for statement in node.children:
+                if is_append(statement) and statement.child.lhs.kind == "VAR" and statement.child.lhs.type != "str":
+                    local = statement.child.lhs
+                    statements.append(scopes.assignment(read_again(local), ConcatNode("", [read_again(local)])))
+                    local.type = "str"
+                statements.append(statement)
+            node.children = statements
+
+    def post(node, results):
+        if node.kind == "ASSIGNMENT" and folding.is_php_operator(node) and node.parse_node.value == ".=" and \
+                node.lhs.type != "str":
+            current = read_again(node.lhs)
+            if current is not None:
+                appended = node.rhs.parts if node.rhs.kind == "CONCAT" else [node.rhs]
+                node.value = "="
+                node.rhs = ConcatNode("", [current] + appended)
+
+    visitor.walk(root, pre=pre, post=post)
+
+
+# Nodes which give the same each time they're read, if everything under them does too
+REREADABLE = {"VAR", "IDENT", "INDEX", "OPERATOR2", "STRING", "INT", "FLOAT", "BOOL", "NONE"}
+
+
+def read_again(node: ExpressionNode) -> Optional[ExpressionNode]:
+    """ A copy of node, to read the target of an assignment with, or None if reading it again could differ
+
+    """
+    if node.kind not in REREADABLE or typer.is_increment(node):
+        return None
+    copied = copy.copy(node)
+    rereadable = True
+
+    def replace(c):
+        nonlocal rereadable
+        c_copy = read_again(c)
+        if c_copy is None:
+            rereadable = False
+            return c
+        return c_copy
+
+    copied.replace_children(replace)
+    return copied if rereadable else None
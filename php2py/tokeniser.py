@@ -1,15 +1,87 @@
 from __future__ import unicode_literals
 
 import re
+import sys
 import logging
+import concurrent.futures
+from array import array
+from bisect import bisect_left
+from enum import IntEnum
+
+from .clib import trace
+
+
+class Kind(IntEnum):
+    """ The kinds of token the tokenizer produces
+
+    Tokens store their kind as one of these small ints. Token.kind gives the name.
+
+    """
+    UNKNOWN = 0
+    HTML = 1
+    PHPSTART = 2
+    PHPEND = 3
+    BLANKLINE = 4
+    WHITESPACE = 5
+    NEWLINE = 6
+    BLOCKCOMMENT = 7
+    COMMENTLINE = 8
+    INT = 9
+    STRING = 10
+    VARIABLE = 11
+    IDENT = 12
+    COMPARATOR = 13
+    OPERATOR = 14
+    ASSIGNMENT = 15
+    INDEX = 16
+    STARTBRACE = 17
+    ENDBRACE = 18
+    ENDSTATEMENT = 19
+    COMMA = 20
+    COLON = 21
+    SPECIAL = 22
+    CONTROL = 23
+    TRY = 24
+    CATCH = 25
+    CASE = 26
+    DEFAULT = 27
+    BREAK = 28
+    THROW = 29
+    RETURN = 30
+    GLOBAL = 31
+    EXTENDS = 32
+    IF = 33
+    ELSE = 34
+    ELSEIF = 35
+    CLASS = 36
+    METHODMOD = 37
+    FUNCTION = 38
+
+
+# Look up the code for a kind by name or by code. None is allowed for tokens made without a kind.
+KIND_CODES = {None: Kind.UNKNOWN}
+for _kind in Kind:
+    KIND_CODES[_kind.name] = _kind
+    KIND_CODES[_kind] = _kind
+KIND_NAMES = tuple(k.name for k in Kind)
 
 
 class Token(object):
+    __slots__ = ("line", "col", "val", "code")
+
     def __init__(self, line, column, value, kind=None):
         self.line = line
         self.col = column
         self.val = value
-        self.kind = kind
+        self.code = KIND_CODES[kind]
+
+    @property
+    def kind(self):
+        return KIND_NAMES[self.code]
+
+    @property
+    def position(self):
+        return self.line, self.col
 
     def __str__(self):
         return '{} ({}) on line {}, column {}'.format(repr(self.val), self.kind, self.line, self.col)
@@ -21,6 +93,72 @@ class Token(object):
                                                                            self.kind)
 
 
+class TokenBuffer(object):
+    """ Compact storage for a whole stream of tokens
+
+    Rather than keeping a Token object per token, the lines, columns and kinds are kept in parallel arrays
+    and the values are interned, so repeated names and symbols are only stored once. Tokens are created
+    again when they are asked for.
+
+    """
+    def __init__(self, tokens=()):
+        self.lines = array("i")
+        self.cols = array("i")
+        self.codes = array("B")
+        self.vals = []
+        self.extend(tokens)
+
+    def append(self, token: Token) -> None:
+        self.lines.append(token.line)
+        self.cols.append(token.col)
+        self.codes.append(token.code)
+        self.vals.append(sys.intern(token.val))
+
+    def extend(self, tokens) -> None:
+        for t in tokens:
+            self.append(t)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i) -> Token:
+        t = Token(self.lines[i], self.cols[i], self.vals[i])
+        t.code = self.codes[i]
+        return t
+
+    def __iter__(self):
+        for i in range(0, len(self.codes)):
+            yield self[i]
+
+
+class BufferToken(Token):
+    """ A token from a BufferTokenizer
+
+    Only the offset into the buffer is stored. The line and column are worked out from the tokenizer's
+    newline index when they are asked for.
+
+    """
+    __slots__ = ("tokenizer", "offset")
+
+    def __init__(self, tokenizer, offset, value, kind=None):
+        self.tokenizer = tokenizer
+        self.offset = offset
+        self.val = value
+        self.code = KIND_CODES[kind]
+
+    @property
+    def line(self):
+        return self.tokenizer.line_col(self.offset)[0]
+
+    @property
+    def col(self):
+        return self.tokenizer.line_col(self.offset)[1]
+
+    @property
+    def position(self):
+        return self.tokenizer.line_col(self.offset)
+
+
 class Tokenizer(object):
     def __init__(self, linestream, tokens):
         self.linestream = linestream
@@ -32,8 +170,11 @@ class Tokenizer(object):
         self.cursor = -1
 
         self.state = "html"
+        # The state at the start of each line. Tokenizing a line only depends on the line and the state it
+        # starts in, so these are where tokenizing can be restarted from after an edit
+        self.checkpoints = []
         self.peeked = None
-        self.token_stream = self.token_gen()
+        self.token_stream = trace.traced_tokens(self.token_gen())
         self.last_match = None
     # TODO: Work out how this is meant to be done
 
@@ -47,12 +188,9 @@ class Tokenizer(object):
         if self.peeked is not None:
             res = self.peeked
             self.peeked = None
-            logging.debug("Produced1 {}".format(res))
             return res
         else:
-            res = next(self.token_stream)
-            logging.debug("Produced2 {}".format(res))
-            return res
+            return next(self.token_stream)
 
     def __next__(self):
         return self.next()
@@ -61,6 +199,7 @@ class Tokenizer(object):
         self.line = next(self.linestream)
         self.line_number += 1
         self.cursor = 0
+        self.checkpoints.append(self.state)
 
     def match_for(self, match_re):
         m = match_re.match(self.line, self.cursor)
@@ -84,6 +223,18 @@ class Tokenizer(object):
             yield from self.tokenize_line()
         yield Token(self.line_number + 1, 0, "EOF", "PHPEND")
 
+    def lex_line(self, line, line_number, state):
+        """ Tokenize a single line on its own, starting in state
+
+        Returns the tokens on the line and the state at the end of it.
+
+        """
+        self.line = line
+        self.line_number = line_number
+        self.cursor = 0
+        self.state = state
+        return list(self.tokenize_line()), self.state
+
     def tokenize_line(self):
         state_map = {
             "html": self.tokenize_html,
@@ -111,7 +262,7 @@ class Tokenizer(object):
                     if self.line[self.cursor:self.cursor + 3].lower() == "php":
                         self.cursor += 3
                 yield php_start_t
-                raise StopIteration()
+                return
         else:
             next_state_at = len(self.line)
         html_t = Token(self.line_number, self.cursor, self.line[self.cursor:next_state_at], "HTML")
@@ -136,32 +287,284 @@ class Tokenizer(object):
             bl_t = Token(self.line_number, self.cursor, "\n", "BLANKLINE")
             self.cursor = len(self.line)
             yield bl_t
-            raise StopIteration()
+            return
+        line = self.line
+        match = self.tokens.match
         while True:
-            # Eliminate leading whitespace
-            self.match_for(whitespace)
-            if self.match_for(php_end):
+            # A single match skips leading whitespace and picks out the next token. The name of the
+            # group which matched tells us what kind of token it is.
+            m = match(line, self.cursor)
+            if m is None:
+                self.match_for(whitespace)
+                if self.cursor == len(line):
+                    return
+                raise NotImplementedError("How did we get here?")
+            self.cursor = m.end()
+            group = m.lastgroup
+            t = m.group(group)
+            self.last_match = t
+            if group == "IDENT":
+                yield Token(self.line_number, self.cursor, t, KEYWORD_KINDS.get(t, Kind.IDENT))
+            elif group == "SYMBOL":
+                t = t.rstrip()
+                kind = SYMBOL_KINDS.get(t)
+                if kind is None:
+                    kind = SYMBOL_KINDS[t.lower()]
+                yield Token(self.line_number, self.cursor, t, kind)
+            elif group == "PHPEND":
                 self.state = "html"
                 yield Token(self.line_number, self.cursor, "?>", "PHPEND")
-                raise StopIteration()
-            m = self.match_for(full_block_comment)
-            if m is not None:
-                yield Token(self.line_number, self.cursor, m, "BLOCKCOMMENT")
-                continue
-            m = self.match_for(start_block_comment)
-            if m is not None:
+                return
+            elif group == "STARTBLOCKCOMMENT":
                 # Remember, if it is just the start of a block comment then it goes past the end of the line
                 self.state = "blockcomment"
-                yield Token(self.line_number, self.cursor, m, "BLOCKCOMMENT")
-                raise StopIteration()
-            t = self.match_for(self.tokens)
-            if t is None:
-                if self.cursor == len(self.line):
-                    raise StopIteration()
+                yield Token(self.line_number, self.cursor, t, "BLOCKCOMMENT")
+                return
+            elif group == "COMMENTLINE":
+                yield Token(self.line_number, self.cursor, t.rstrip(), "COMMENTLINE")
+            else:
+                yield Token(self.line_number, self.cursor, t, GROUP_KINDS[group])
+
+
+class BufferTokenizer(Tokenizer):
+    """ Tokenizes a whole buffer at once rather than line by line
+
+    The cursor is an absolute offset into the buffer, so strings can run over several lines. Lines and
+    columns are only calculated when something asks for them, using an index of where the newlines are.
+
+    The tokens produced are the same as for Tokenizer, except that html is not split up at the ends of lines
+    and multi-line strings are understood. Block comments still give one token per line as comments are
+    compiled a line at a time.
+
+    """
+    def __init__(self, buffer, tokens):
+        self.buffer = buffer
+        self.tokens = tokens
+        self.cursor = 0
+        self.newlines = None
+
+        self.state = "html"
+        self.peeked = None
+        self.token_stream = trace.traced_tokens(self.token_gen())
+        self.last_match = None
+
+    def line_col(self, offset):
+        """ Get the (line, column) of an offset into the buffer
+
+        """
+        if self.newlines is None:
+            self.newlines = [m.start() for m in newline.finditer(self.buffer)]
+        line = bisect_left(self.newlines, offset)
+        if line == 0:
+            return 0, offset
+        return line, offset - self.newlines[line - 1] - 1
+
+    @property
+    def line_number(self):
+        return self.line_col(self.cursor)[0]
+
+    @property
+    def line(self):
+        line_number, col = self.line_col(self.cursor)
+        start = self.cursor - col
+        end = self.buffer.find("\n", start)
+        if end < 0:
+            end = len(self.buffer)
+        return self.buffer[start:end + 1]
+
+    def position(self):
+        line_number, col = self.line_col(self.cursor)
+        return self.line, " " * col + "^---- column {}, line {}".format(col, line_number)
+
+    def token_gen(self):
+        state_map = {
+            "html": self.tokenize_html,
+            "php": self.tokenize_php,
+        }
+        while self.cursor < len(self.buffer):
+            yield from state_map[self.state]()
+        lines = self.buffer.count("\n")
+        if len(self.buffer) > 0 and self.buffer[-1] != "\n":
+            lines += 1
+        yield Token(lines, 0, "EOF", "PHPEND")
+
+    def tokenize_html(self):
+        buf = self.buffer
+        next_state_at = buf.find("<?", self.cursor)
+        if next_state_at == self.cursor:
+            self.state = "php"
+            php_start_t = BufferToken(self, self.cursor, php_start_value(buf, self.cursor), "PHPSTART")
+            self.cursor += 2
+            if len(buf) > self.cursor + 3 and buf[self.cursor:self.cursor + 3].lower() == "php":
+                self.cursor += 3
+            yield php_start_t
+            return
+        if next_state_at < 0:
+            next_state_at = len(buf)
+        html_t = BufferToken(self, self.cursor, buf[self.cursor:next_state_at], "HTML")
+        self.cursor = next_state_at
+        yield html_t
+
+    def tokenize_blockcomment(self, start, end):
+        """ Split the block comment from start to end into one token per line
+
+        """
+        buf = self.buffer
+        line_end = buf.find("\n", start, end)
+        if line_end < 0:
+            yield BufferToken(self, end, buf[start:end], "BLOCKCOMMENT")
+            return
+        yield BufferToken(self, start, buf[start:line_end + 1], "BLOCKCOMMENT")
+        start = line_end + 1
+        while start < end:
+            line_end = buf.find("\n", start, end)
+            if line_end < 0:
+                yield BufferToken(self, end, buf[start:end], "BLOCKCOMMENT")
+                return
+            yield BufferToken(self, start, buf[start:line_end + 1], "BLOCKCOMMENT")
+            start = line_end + 1
+
+    def tokenize_php(self):
+        buf = self.buffer
+        match = self.tokens.match
+        while True:
+            m = match(buf, self.cursor)
+            if m is None:
+                m = whitespace.match(buf, self.cursor)
+                if m is not None:
+                    self.cursor = m.end()
+                if self.cursor == len(buf):
+                    return
                 raise NotImplementedError("How did we get here?")
-            t = t.rstrip()
-            kind = lookup_kind(t)
-            yield Token(self.line_number, self.cursor, t, kind)
+            self.cursor = m.end()
+            group = m.lastgroup
+            t = m.group(group)
+            self.last_match = t
+            if group == "IDENT":
+                yield BufferToken(self, self.cursor, t, KEYWORD_KINDS.get(t, Kind.IDENT))
+            elif group == "SYMBOL":
+                t = t.rstrip()
+                kind = SYMBOL_KINDS.get(t)
+                if kind is None:
+                    kind = SYMBOL_KINDS[t.lower()]
+                yield BufferToken(self, self.cursor, t, kind)
+            elif group == "NEWLINE":
+                # Lines with nothing on them are kept as they become blank lines in the output
+                bl = blank_line.match(buf, self.cursor)
+                while bl is not None:
+                    yield BufferToken(self, self.cursor, "\n", "BLANKLINE")
+                    self.cursor = bl.end()
+                    bl = blank_line.match(buf, self.cursor)
+            elif group == "PHPEND":
+                self.state = "html"
+                yield BufferToken(self, self.cursor, "?>", "PHPEND")
+                return
+            elif group == "BLOCKCOMMENT":
+                yield from self.tokenize_blockcomment(m.start(group), self.cursor)
+            elif group == "COMMENTLINE":
+                yield BufferToken(self, self.cursor, t.rstrip(), "COMMENTLINE")
+            else:
+                yield BufferToken(self, self.cursor, t, GROUP_KINDS[group])
+
+
+class TokenReader(Tokenizer):
+    """ Hands out tokens which have already been made, such as from a TokenBuffer or IncrementalTokens
+
+    Behaves like a Tokenizer as far as the parser is concerned.
+
+    """
+    def __init__(self, tokens):
+        self.line = ""
+        self.line_number = 0
+        self.cursor = 0
+        self.peeked = None
+        self.token_stream = trace.traced_tokens(self.token_gen(tokens))
+
+    def token_gen(self, tokens):
+        for t in tokens:
+            self.line_number = t.line
+            self.cursor = t.col
+            yield t
+
+
+class IncrementalTokens(object):
+    """ The tokens of a source file, kept line by line so they can be brought up to date after an edit
+
+    The state the tokenizer was in at the start of every line is kept as a checkpoint. After an edit the lines
+    are tokenized again starting from the first changed line, until the end of the change has been passed and
+    the state at the start of a line is the same as it was before the edit. Every line from there on would be
+    tokenized exactly as it was before, so the old tokens are kept and just have their line numbers moved.
+
+    """
+    def __init__(self, lines):
+        self.lines = list(lines)
+        self.tokenizer = tokens(iter(self.lines))
+        self.line_tokens = [[] for _ in self.lines]
+        for t in self.tokenizer:
+            if t.line < len(self.lines):
+                self.line_tokens[t.line].append(t)
+        self.checkpoints = self.tokenizer.checkpoints
+        self.end_state = self.tokenizer.state
+
+    def __iter__(self):
+        for line in self.line_tokens:
+            yield from line
+        yield Token(len(self.lines), 0, "EOF", "PHPEND")
+
+    def reader(self) -> TokenReader:
+        return TokenReader(self)
+
+    def edit(self, start, end, new_lines):
+        """ Replace lines start to end (not including end) with new_lines and tokenize what needs it again
+
+        Returns the range of (new) line numbers that were tokenized again.
+
+        """
+        new_lines = list(new_lines)
+        delta = len(new_lines) - (end - start)
+        old_checkpoints = self.checkpoints
+        state = old_checkpoints[start] if start < len(old_checkpoints) else self.end_state
+        self.lines[start:end] = new_lines
+        change_end = start + len(new_lines)
+
+        checkpoints = []
+        line_tokens = []
+        i = start
+        while i < len(self.lines):
+            if i >= change_end and state == old_checkpoints[i - delta]:
+                break
+            checkpoints.append(state)
+            toks, state = self.tokenizer.lex_line(self.lines[i], i, state)
+            line_tokens.append(toks)
+            i += 1
+        if i == len(self.lines):
+            self.end_state = state
+
+        old_i = i - delta
+        self.checkpoints[start:old_i] = checkpoints
+        self.line_tokens[start:old_i] = line_tokens
+        if delta != 0:
+            for line in self.line_tokens[i:]:
+                for t in line:
+                    t.line += delta
+        return start, i
+
+    def update(self, lines):
+        """ Bring the tokens up to date with lines, the whole of the edited source
+
+        Only the lines between the first and last ones that differ are treated as changed.
+
+        """
+        lines = list(lines)
+        old = self.lines
+        start = 0
+        most = min(len(old), len(lines))
+        while start < most and old[start] == lines[start]:
+            start += 1
+        end = 0
+        while end < most - start and old[-1 - end] == lines[-1 - end]:
+            end += 1
+        return self.edit(start, len(old) - end, lines[start:len(lines) - end])
 
 
 def lookup_kind(s):
@@ -222,6 +625,7 @@ keyword_table = {
     "break": "BREAK",
     "throw": "THROW",
     "while": "CONTROL",
+    "for": "CONTROL",
     "foreach": "CONTROL",
     "switch": "CONTROL",
     "return": "RETURN",
@@ -281,7 +685,7 @@ OPERATORS = ["new ", "and ", "xor " "or ", "as ",
              "<<", ">>", "||", "&&", "++", "--",
              "+", "-", "*", "/", "%", ".", "&", "|", "^", "~", "!", "?", "@"]
 ASSIGNMENTS = ["<<=", ">>=",
-               "+=", "-=", "*=", "/=", "|=", "^=", "="]
+               "+=", "-=", "*=", "/=", ".=", "|=", "^=", "="]
 STARTBRACES = ["(", "{", "["]
 ENDBRACES = [")", "}", "]"]
 BRACES = STARTBRACES + ENDBRACES
@@ -316,15 +720,186 @@ more_table = {
     "IDENT": full_matcher(INDENTIFIERS),
 }
 
+# The master pattern used while in the php state. End of php and block comments are checked first, then the
+# alternatives from TOKENS in the same order. Numbers are split into INT and FLOAT so that the name of the
+# group is enough to give the kind.
+PHP_TOKENS = ("\\s*(?:"
+              "(?P<PHPEND>\\?>)|"
+              "(?P<BLOCKCOMMENT>/\\*.*?\\*/)|"
+              "(?P<STARTBLOCKCOMMENT>/\\*(?:.|[^*/])*)|"
+              "(?P<COMMENTLINE>{})|"
+              "(?P<INT>-?[0-9]+(?![0-9.]))|"
+              "(?P<FLOAT>{})|"
+              "(?P<SYMBOL>{})|"
+              "(?P<STRING>{})|"
+              "(?P<VARIABLE>{})|"
+              "(?P<IDENT>{}))").format(COMMENTS, NUMBERS, escape_and_join(SYMBOLS), STRINGS, VARIABLES,
+                                       INDENTIFIERS)
+
+# Kinds for the groups which don't need any further classification
+GROUP_KINDS = {
+    "BLOCKCOMMENT": Kind.BLOCKCOMMENT,
+    "INT": Kind.INT,
+    "FLOAT": Kind.UNKNOWN,     # As lookup_kind gives for them
+    "STRING": Kind.STRING,
+    "VARIABLE": Kind.VARIABLE,
+}
+
+# Every symbol is classified once here rather than for every token. Symbols are matched case insensitively,
+# but none of them change kind with case, so the lowercase version is enough
+SYMBOL_KINDS = {s.rstrip(): Kind[lookup_kind(s.rstrip())] for s in SYMBOLS}
+KEYWORD_KINDS = {k: Kind[v] for k, v in keyword_table.items()}
+
+
+# The same again for BufferTokenizer. Newlines are matched separately so that blank lines can be found, and
+# block comments may run over several lines.
+BUFFER_TOKENS = ("[^\\S\\n]*(?:"
+                 "(?P<NEWLINE>\\n)|"
+                 "(?P<PHPEND>\\?>)|"
+                 "(?P<BLOCKCOMMENT>/\\*(?s:.*?\\*/|.*))|"
+                 "(?P<COMMENTLINE>{})|"
+                 "(?P<INT>-?[0-9]+(?![0-9.]))|"
+                 "(?P<FLOAT>{})|"
+                 "(?P<SYMBOL>{})|"
+                 "(?P<STRING>{})|"
+                 "(?P<VARIABLE>{})|"
+                 "(?P<IDENT>{}))").format(COMMENTS, NUMBERS, escape_and_join(SYMBOLS), STRINGS, VARIABLES,
+                                          INDENTIFIERS)
+newline = re.compile("\\n")
+blank_line = re.compile("[^\\S\\n]*\\n|[^\\S\\n]+\\Z")
+
+
+def php_start_value(buffer, offset):
+    """ The value of the start tag at offset, cut at the end of the line to match Tokenizer
+
+    """
+    start = buffer[offset:offset + 5]
+    if "\n" in start:
+        start = start[:start.index("\n") + 1]
+    return start
+
 
 def tokens(linestream):
     logging.debug("Tokenizing")
-    return Tokenizer(linestream, re.compile(TOKENS, flags=re.IGNORECASE))
+    return Tokenizer(linestream, re.compile(PHP_TOKENS, flags=re.IGNORECASE))
+
+
+def buffer_tokens(buffer):
+    logging.debug("Tokenizing buffer")
+    return BufferTokenizer(buffer, re.compile(BUFFER_TOKENS, flags=re.IGNORECASE))
+
+
+# Files smaller than this aren't worth starting processes for
+PARALLEL_CHUNK_SIZE = 256 * 1024
+
+
+def _tokenize_chunk(chunk, first_line=0, first_col=0):
+    """ Tokenize a chunk of a buffer on its own, starting in the html state
+
+    first_line and first_col are where the chunk starts in the whole buffer. Returns the token columns, whether
+    the chunk ended with a ?> right at its end, and the (index, offset) of any start tag too near the end of
+    the chunk to have its value worked out. If the chunk didn't end at a ?>, the split after it was inside a
+    string or comment or html and the tokens can't be used.
+
+    """
+    tokenizer = buffer_tokens(chunk)
+    tb = TokenBuffer()
+    near_end = []
+    try:
+        toks = list(tokenizer.token_gen())
+    except NotImplementedError:
+        return None, False, near_end
+    # Drop the EOF
+    toks.pop()
+    for t in toks:
+        line, col = tokenizer.line_col(t.offset)
+        if line == 0:
+            col += first_col
+        tb.lines.append(line + first_line)
+        tb.cols.append(col)
+        tb.codes.append(t.code)
+        tb.vals.append(sys.intern(t.val))
+        if t.code == Kind.PHPSTART and t.offset + 5 > len(chunk):
+            near_end.append((len(tb) - 1, t.offset))
+    ends_at_split = (len(toks) > 0 and toks[-1].code == Kind.PHPEND and toks[-1].offset == len(chunk) and
+                     tokenizer.state == "html")
+    return (tb.lines.tobytes(), tb.cols.tobytes(), tb.codes.tobytes(), tb.vals), ends_at_split, near_end
+
+
+def split_points(buffer, chunk_size):
+    """ Find places to split buffer, just after the first ?> after every chunk_size characters
+
+    """
+    points = []
+    start = 0
+    while True:
+        split = buffer.find("?>", start + chunk_size)
+        if split < 0:
+            break
+        start = split + 2
+        if start >= len(buffer):
+            break
+        points.append(start)
+    return points
+
+
+def parallel_buffer_tokens(buffer, processes=None, chunk_size=PARALLEL_CHUNK_SIZE) -> TokenReader:
+    """ Tokenize a large buffer in several processes at once
+
+    The buffer is split just after ?>, where the tokenizer goes back to the html state, and each chunk is
+    tokenized in a process pool. A ?> inside a string or comment isn't really a split point, which shows up as
+    the chunk before it not ending in a PHPEND. That chunk is joined to the next one and tokenized again here.
+    The tokens are exactly those buffer_tokens would give.
+
+    """
+    points = split_points(buffer, chunk_size)
+    bounds = list(zip([0] + points, points + [len(buffer)]))
+    if len(bounds) == 1:
+        return TokenReader(TokenBuffer(buffer_tokens(buffer)))
+
+    # Where each chunk starts, as (line, column)
+    starts = []
+    line = 0
+    line_start = 0
+    for start, end in bounds:
+        starts.append((line, start - line_start))
+        newlines = buffer.count("\n", start, end)
+        if newlines:
+            line += newlines
+            line_start = buffer.rfind("\n", start, end) + 1
+
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        results = list(pool.map(_tokenize_chunk, (buffer[s:e] for s, e in bounds), *zip(*starts)))
+
+    tb = TokenBuffer()
+    i = 0
+    while i < len(bounds):
+        start, end = bounds[i]
+        columns, ends_at_split, near_end = results[i]
+        first_line, first_col = starts[i]
+        i += 1
+        # Keep joining on chunks until we reach a real split, or the end of the buffer
+        while not ends_at_split and i < len(bounds):
+            end = bounds[i][1]
+            i += 1
+            columns, ends_at_split, near_end = _tokenize_chunk(buffer[start:end], first_line, first_col)
+        if columns is None:
+            # The rest of the buffer can't be tokenized, so go over it all here to raise what buffer_tokens would
+            return TokenReader(TokenBuffer(buffer_tokens(buffer)))
+        lines, cols, codes, vals = columns
+        for j, offset in near_end:
+            vals[j] = php_start_value(buffer, start + offset)
+        tb.lines.frombytes(lines)
+        tb.cols.frombytes(cols)
+        tb.codes.frombytes(codes)
+        tb.vals.extend(vals)
+    tb.append(Token(buffer.count("\n") + (buffer[-1] != "\n"), 0, "EOF", "PHPEND"))
+    return TokenReader(tb)
 
 
 if __name__ == "__main__":
     import sys
-    print("matching for " + TOKENS)
+    print("matching for " + PHP_TOKENS)
     f = open(sys.argv[1], "r")
     for token in tokens(f):
         print(token)
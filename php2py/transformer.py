@@ -1,9 +1,17 @@
 from __future__ import absolute_import, unicode_literals
 
-import logging
-from typing import Tuple, Iterable
+from typing import List, Tuple, Iterable
 
+from .clib import trace
+from .clib import visitor
 from .intermediate import *
+from . import binding
+from . import folding
+from . import output
+from . import reachability
+from . import scopes
+from . import strings
+from . import typer
 
 
 TransformExprTuple = Tuple[Iterable[StatementNode], ExpressionNode, Iterable[StatementNode]]
@@ -19,25 +27,38 @@ def transforms(*args):
     return wrap
 
 
-def pdebug(*s):
-    logging.debug("|".join([str(p) for p in s]))
-
-
 class TransformException(Exception):
     pass
 
 
-def transform(root_node: ParseNode) -> RootNode:
+def transform(root_node: ParseNode,
+              min_globals_refactor: int=scopes.MIN_GLOBALS_REFACTOR,
+              warn_unreachable: bool=False,
+              bind_builtins: bool=False) -> RootNode:
+    """ Transform a parse tree into an intermediate tree
+
+    The transforms are generators so that deep trees don't hit the recursion limit. Instead of calling the
+    transform for a child they yield it, and clib.visitor.run sends back the result. Switches whose cases are all
+    literals look their branch up in a table at the top of the module.
+
+    Globals referenced more than min_globals_refactor times in a function are held in locals while it runs.
+    Unreachable code is dropped, with a warning logged for each piece if warn_unreachable is set. Types are
+    inferred, so that php's conversions are left out where python would do the same. Strings built up
+    in loops or by chains of . are built in one go, and html and echo statements next to each other are written
+    together. If bind_builtins is set, builtins are called through names bound once at the top of the module
+    rather than through _f_.
+
+    """
     functions = []
     classes = []
     body_statements = []
+    t.case_tables.clear()
+    t.strict_types = declares_strict_types(root_node)
 
     for tln in root_node:
-        pdebug("Transforming top level node {}".format(tln))
         if tln.kind == "PHP":
-            pdebug("T PHP")
             for php_child in tln:
-                for n in t.transform_statement_node(php_child):
+                for n in visitor.run(t.transform_statement_node(php_child)):
                     if n.kind == "FUNCTION":
                         functions.append(n)
                     elif n.kind == "CLASS":
@@ -45,15 +66,23 @@ def transform(root_node: ParseNode) -> RootNode:
                     else:
                         body_statements.append(n)
         else:
-            pdebug("T HTML")
-            # TODO: Change to a call to "echo" here
             body_statements.append(HtmlNode(tln))
 
     body_block = BlockNode(ParseNode("BLOCK", None), body_statements)
 
     body_function = FunctionNode("body", None, body_block)
     functions.append(body_function)
-    return RootNode(root_node, functions, classes)
+    root = RootNode(root_node, functions, classes)
+    root.constants.assignments = list(t.case_tables)
+    folding.fold(root)
+    reachability.eliminate(root, warn_unreachable)
+    scopes.analyse(root, min_globals_refactor)
+    typer.infer(root)
+    strings.build(root)
+    output.coalesce(root)
+    if bind_builtins:
+        binding.bind(root)
+    return root
 
 
 class Transformer:
@@ -61,25 +90,44 @@ class Transformer:
         self.hoisting = False
         self.pre_statements = []
         self.post_statements = []
+        # The assignments of the tables switches look their cases up in, for the top of the module
+        self.case_tables = []
+        # Whether the file being transformed has declare(strict_types=1)
+        self.strict_types = False
 
-    def transform_statement_node(self, node: ParseNode) -> StatementNode:
+    def transform_statement_node(self, node: ParseNode) -> List[StatementNode]:
+        """ Transform a statement, along with any statements hoisted out from before or after it
+
+        Like the transforms, this is a generator to be yielded or run with visitor.run.
+
+        """
         if node.kind in transform_map:
-            statement = transform_map[node.kind](node)
-            yield from self.pre_statements
-            yield statement
-            yield from self.post_statements
+            statement = yield transform_map[node.kind](node)
+            if trace.tracer is not None:
+                trace.tracer.transform(node, statement)
+            statements = self.pre_statements + [statement] + self.post_statements
             self.pre_statements.clear()
             self.post_statements.clear()
+            return statements
         else:
             raise NotImplementedError("UNKNOWN TRANSFORM " + str(node))
 
     def transform_expr_node(self, node: ParseNode) -> ExpressionNode:
+        """ Get the transform of an expression, to be yielded or run with visitor.run
+
+        """
         if node.kind in transform_map:
-            res = transform_map[node.kind](node)
-            return res
+            if trace.tracer is not None:
+                return self.traced_transform(node)
+            return transform_map[node.kind](node)
         else:
             raise NotImplementedError("UNKNOWN TRANSFORM " + str(node))
 
+    def traced_transform(self, node: ParseNode) -> ExpressionNode:
+        res = yield transform_map[node.kind](node)
+        trace.tracer.transform(node, res)
+        return res
+
 
 t = Transformer()
 
@@ -87,7 +135,7 @@ t = Transformer()
 def transform_block(node: ParseNode) -> BlockNode:
     new_children = []
     for c in node:
-        for statement in t.transform_statement_node(c):
+        for statement in (yield t.transform_statement_node(c)):
             new_children.append(statement)
     return BlockNode(node, new_children)
 
@@ -103,11 +151,11 @@ def transform_class(node: ParseNode) -> ClassNode:
     body = []
     for c in node["BLOCK"]:
         if c.kind in ("METHOD", "CLASSMETHOD", "FUNCTION"):
-            m = transform_method(c)
+            m = yield transform_method(c)
             methods.append(m)
             body.append(m)
         elif c.kind == "STATEMENT":
-            ex_s = transform_plain_statement(c)
+            ex_s = yield transform_plain_statement(c)
             if ex_s.child.kind == "ASSIGNMENT":
                 attribs.append(ex_s.child)
             body.append(ex_s)
@@ -122,26 +170,96 @@ def transform_html(node: ParseNode) -> HtmlNode:
 
 @transforms("FUNCTION")
 def transform_function(node: ParseNode) -> FunctionNode:
-    args = []
-    for a in node["ARGSLIST"]:
-        args.append(transform_plain_expression(a))
-    body = transform_block(node["BLOCK"])
+    args, conversions = yield transform_parameters(node)
+    body = yield transform_block(node["BLOCK"])
+    body.children[:0] = conversions
     t.post_statements.append(assignment_statement(f_access(node), VariableNode(node)))
     return FunctionNode(node, args, body)
 
 
 def transform_method(node: ParseNode) -> MethodNode:
-    # Php methods starting with __ include the constructor
-    if node.value.startswith("__"):
-        node.value = "_php_" + node.value[2:]
-    args = [VariableNode("this")]
-    for a in node["ARGSLIST"]:
-        args.append(transform_plain_expression(a))
-    body = transform_block(node["BLOCK"])
+    params, conversions = yield transform_parameters(node)
+    args = [VariableNode("this")] + params
+    body = yield transform_block(node["BLOCK"])
+    body.children[:0] = conversions
     if node.kind == "CLASSMETHOD":
-        return ClassMethodNode(node, args, body)
+        method = ClassMethodNode(node, args, body)
     else:
-        return MethodNode(node, args, body)
+        method = MethodNode(node, args, body)
+    # Php methods starting with __ include the constructor. The parse node can be shared, so is left as it was.
+    if method.value.startswith("__"):
+        method.value = "_php_" + method.value[2:]
+    return method
+
+
+def transform_parameter(node: ParseNode) -> ExpressionNode:
+    """ A parameter of a function or method, typed if php gives it a type typer knows
+
+    Php only holds scalar parameters to their types under strict_types. Otherwise it converts the arguments, which
+    parameter_conversion does in the compiled function, and the type holds after that. Arrays are checked either way.
+
+    """
+    param = yield transform_plain_expression(node)
+    param_type = parameter_type(node)
+    if param_type == "array" or t.strict_types:
+        variable = param.lhs if param.kind == "ASSIGNMENT" else param
+        variable.type = param_type
+    return param
+
+
+def parameter_type(node: ParseNode) -> str:
+    if "TYPE" not in node:
+        return "Unknown"
+    return typer.PARAMETER_TYPES.get(node["TYPE"].value.lower(), "Unknown")
+
+
+def parameter_conversion(node: ParseNode, param: ExpressionNode) -> List[StatementNode]:
+    """ The statement converting the argument for a parameter to its type as php does without strict_types, if any
+
+    A null default is passed on as it is, whatever the type.
+
+    """
+    conversion = cast_functions.get(parameter_type(node))
+    if t.strict_types or conversion is None or param.kind == "ASSIGNMENT" and is_null(param.rhs):
+        return []
+    variable = param.lhs if param.kind == "ASSIGNMENT" else param
+    return [assignment_statement(VariableNode(variable.parse_node),
+                                 f_call("", conversion, [VariableNode(variable.parse_node)]))]
+
+
+def is_null(node: ExpressionNode) -> bool:
+    return node.kind == "NONE" or folding.is_constant_access(node) and node.rhs.value.lower() == "null"
+
+
+def transform_parameters(node: ParseNode) -> Tuple[List[ExpressionNode], List[StatementNode]]:
+    """ The parameters of a function or method, and the statements to convert their arguments with
+
+    """
+    params = []
+    conversions = []
+    for a in node["ARGSLIST"]:
+        param = yield transform_parameter(a)
+        params.append(param)
+        conversions.extend(parameter_conversion(a, param))
+    return params, conversions
+
+
+def declares_strict_types(root_node: ParseNode) -> bool:
+    """ Whether the file has declare(strict_types=1)
+
+    """
+    for tln in root_node.get_all("PHP"):
+        for statement in tln.get_all("STATEMENT"):
+            if "EXPRESSION" not in statement or len(statement["EXPRESSION"]) == 0:
+                continue
+            call = statement["EXPRESSION"][0]
+            if call.kind != "CALL" or "CONSTANT" not in call or call["CONSTANT"].value.lower() != "declare":
+                continue
+            for e in call["EXPRESSIONGROUP"]:
+                if len(e) > 0 and e[0].kind == "ASSIGNMENT" and "CONSTANT" in e[0] and "INT" in e[0] and \
+                        e[0]["CONSTANT"].value.lower() == "strict_types" and str(e[0]["INT"].value) == "1":
+                    return True
+    return False
 
 
 @transforms("STATEMENT")
@@ -150,7 +268,7 @@ def transform_plain_statement(node: ParseNode) -> ExpressionStatement:
 
     """
     if "EXPRESSION" in node:
-        expr = transform_plain_expression(node["EXPRESSION"])
+        expr = yield transform_plain_expression(node["EXPRESSION"])
     else:
         expr = NoopNode("")
 
@@ -175,35 +293,35 @@ def transform_if(node: ParseNode) -> IfNode:
     # Check if this if was a one liner
     # TODO: Maybe use python one liners? Not very pythonic though
     if "STATEMENT" in node:
-        s = transform_plain_statement(node["STATEMENT"])
+        s = yield transform_plain_statement(node["STATEMENT"])
         if_block = BlockNode(s.parse_node, [s])
     else:
-        if_block = transform_block(node["BLOCK"])
+        if_block = yield transform_block(node["BLOCK"])
     t.hoisting = True
-    if_op = t.transform_expr_node(node["EXPRESSIONGROUP"]["EXPRESSION"][0])
+    if_op = yield t.transform_expr_node(node["EXPRESSIONGROUP"]["EXPRESSION"][0])
     t.hoisting = False
     elses = []
 
     for c in node:
         if c.kind == "ELIF":
-            elses.append(transform_elif(c))
+            elses.append((yield transform_elif(c)))
         elif c.kind == "ELSE":
-            elses.append(transform_else(c))
+            elses.append((yield transform_else(c)))
     return IfNode(node, if_op, if_block, elses)
 
 
 def transform_elif(node: ParseNode) -> ElifNode:
     # TODO: One liners
     t.hoisting = True
-    condition = t.transform_expr_node(node["EXPRESSIONGROUP"]["EXPRESSION"][0])
+    condition = yield t.transform_expr_node(node["EXPRESSIONGROUP"]["EXPRESSION"][0])
     t.hoisting = False
-    block = transform_block(node["BLOCK"])
+    block = yield transform_block(node["BLOCK"])
     return ElifNode(node, condition, block)
 
 
 def transform_else(node: ParseNode) -> ElseNode:
     # TODO: One liners
-    return ElseNode(node, transform_block(node["BLOCK"]))
+    return ElseNode(node, (yield transform_block(node["BLOCK"])))
 
 
 @transforms("FOREACH")
@@ -212,64 +330,317 @@ def transform_foreach(node: ParseNode):
     thing = as_[0]
     items = as_[1]
     if thing.value == "=>":
-        its = Operator2Node(".", t.transform_expr_node(items), VariableNode("items"))
+        its = Operator2Node(".", (yield t.transform_expr_node(items)), VariableNode("items"))
         items = CallNode(thing, its, [])
-        key = t.transform_expr_node(thing[1])
-        value = t.transform_expr_node(thing[0])
+        key = yield t.transform_expr_node(thing[1])
+        value = yield t.transform_expr_node(thing[0])
         thing = CommaListNode(thing, [key, value])
     else:
-        items = t.transform_expr_node(items)
-        thing = t.transform_expr_node(thing)
-    return ForNode(node, thing, items, transform_block(node["BLOCK"]))
+        items = yield t.transform_expr_node(items)
+        thing = yield t.transform_expr_node(thing)
+    return ForNode(node, thing, items, (yield transform_block(node["BLOCK"])))
 
 
 @transforms("WHILE")
 def transform_while(node: ParseNode):
-    condition = t.transform_expr_node(node["EXPRESSIONGROUP"]["EXPRESSION"])
-    block = transform_block(node["BLOCK"])
+    condition = yield t.transform_expr_node(node["EXPRESSIONGROUP"]["EXPRESSION"])
+    block = yield transform_block(node["BLOCK"])
     return WhileNode(node, condition, block)
 
 
+@transforms("FOR")
+def transform_for(node: ParseNode):
+    """ Counted loops like for ($i = 0; $i < 10; $i++) become for i in range(0, 10), anything else a while loop
+
+    """
+    block = yield transform_block(node["BLOCK"])
+    init, conditions, steps = node.get_all("EXPRESSIONGROUP")
+    counted = counted_loop(init, conditions, steps, node["BLOCK"])
+    if counted is not None:
+        var, start, bound, inclusive, step = counted
+        range_args = yield range_arguments(start, bound, inclusive, step)
+        for_node = ForNode(node, (yield t.transform_expr_node(var)), CallNode(node, IdentNode("range"), range_args),
+                           block)
+        # Php leaves the loop variable one step past the last time round, or at start if the loop didn't run. The
+        # later passes change nodes in place, so the exit value is made from nodes of its own.
+        exit_args = yield range_arguments(start, bound, inclusive, step)
+        if step == 1:
+            exit_value = CallNode(node, IdentNode("max"), exit_args)
+        elif step == -1:
+            exit_value = CallNode(node, IdentNode("min"), exit_args[:2])
+        else:
+            count = CallNode(node, IdentNode("len"), [CallNode(node, IdentNode("range"), exit_args)])
+            exit_value = Operator2Node("+", (yield t.transform_expr_node(start)),
+                                       Operator2Node("*", count, IntNode(str(step))))
+        for_node.exit_value = assignment_statement((yield t.transform_expr_node(var)), exit_value)
+        t.post_statements.append(for_node.exit_value)
+        return for_node
+
+    for e in init:
+        t.pre_statements.append(ExpressionStatement(e, (yield transform_plain_expression(e))))
+    if len(conditions) == 0:
+        condition = BoolNode("True")
+    elif len(conditions) == 1:
+        condition = yield transform_plain_expression(conditions[0])
+    else:
+        # Every condition is evaluated, but only the last decides
+        condition = IndexNode(conditions, (yield transform_expression_group(conditions)), IntNode("-1"))
+    # There's no continue, so the steps can just go at the end of the body
+    for e in steps:
+        block.children.append(ExpressionStatement(e, (yield transform_plain_expression(e))))
+    return WhileNode(node, condition, block)
+
+
+def range_arguments(start: ParseNode, bound: ParseNode, inclusive: bool, step: int) -> List[ExpressionNode]:
+    """ The arguments to range for a counted loop
+
+    """
+    start = yield t.transform_expr_node(start)
+    end = yield t.transform_expr_node(bound)
+    if inclusive:
+        end = add_int(end, 1 if step > 0 else -1)
+    args = [start, end]
+    if step != 1:
+        args.append(IntNode(str(step)))
+    return args
+
+
+# Builtins which only read their arguments and don't run any php code
+READ_ONLY_BUILTINS = {"count", "sizeof", "strlen", "echo", "print", "isset", "empty", "array", "intval", "floatval",
+                      "strval", "abs", "min", "max", "substr", "strtolower", "strtoupper", "trim", "implode",
+                      "explode", "in_array", "array_key_exists", "is_array", "is_int", "is_string", "is_numeric",
+                      "str_replace", "str_repeat", "sprintf", "dirname"}
+
+
+def counted_loop(init: ParseNode, conditions: ParseNode, steps: ParseNode, block: ParseNode):
+    """ Check whether a for loop just counts from one int to another, without its block changing either end
+
+    Returns the loop variable, the start, the bound, whether the bound is inclusive and the step, or None.
+
+    """
+    if len(init) != 1 or len(conditions) != 1 or len(steps) != 1:
+        return None
+    assignment = init[0][0] if len(init[0]) > 0 else None
+    if assignment is None or assignment.kind != "ASSIGNMENT" or assignment.value != "=" or \
+            assignment[1].kind not in ("VAR", "GLOBALVAR"):
+        return None
+    var = assignment[1]
+    start = assignment[0]
+
+    condition = conditions[0][0] if len(conditions[0]) > 0 else None
+    if condition is None or condition.kind != "OPERATOR2" or condition.value not in ("<", "<=", ">", ">=") or \
+            not same_variable(condition[1], var):
+        return None
+    bound = condition[0]
+
+    step = steps[0][0] if len(steps[0]) > 0 else None
+    if step is None or not same_variable(step[-1], var):
+        return None
+    if step.kind == "OPERATOR1" and step.value in ("++", "--"):
+        by = 1
+    elif step.kind == "ASSIGNMENT" and step.value in ("+=", "-=") and is_int_literal(step[0]) and \
+            int(step[0].value) > 0:
+        by = int(step[0].value)
+    else:
+        return None
+    if step.value[0] == "-":
+        by = -by
+    if (by > 0) != (condition.value[0] == "<"):
+        return None
+
+    names = {(var.kind, var.value)}
+    if not int_expression(start, var, names) or not int_expression(bound, var, names):
+        return None
+    if may_change(block, names):
+        return None
+    return var, start, bound, condition.value.endswith("="), by
+
+
+def same_variable(node: ParseNode, var: ParseNode) -> bool:
+    return node.kind == var.kind and node.value == var.value
+
+
+def is_int_literal(node: ParseNode) -> bool:
+    return node.kind == "INT" and isinstance(node.value, int)
+
+
+def int_expression(node: ParseNode, var: ParseNode, names: set) -> bool:
+    """ Whether node is sure to give an int without using var, adding the variables it reads to names
+
+    """
+    if is_int_literal(node):
+        return True
+    if node.kind == "OPERATOR2" and node.value in ("+", "-", "*"):
+        return int_expression(node[0], var, names) and int_expression(node[1], var, names)
+    if node.kind == "EXPRESSIONGROUP" and len(node) == 1 and len(node[0]) == 1:
+        return int_expression(node[0][0], var, names)
+    if node.kind == "CALL" and node[1].kind == "CONSTANT" and node[1].value.lower() in ("count", "sizeof", "strlen"):
+        args = node["EXPRESSIONGROUP"]
+        if len(args) == 1 and len(args[0]) == 1 and args[0][0].kind in ("VAR", "GLOBALVAR") and \
+                not same_variable(args[0][0], var):
+            names.add((args[0][0].kind, args[0][0].value))
+            return True
+    return False
+
+
+def root_variable(node: ParseNode) -> ParseNode:
+    """ The variable at the bottom of $a[1]->b and so on
+
+    """
+    while node.kind in ("INDEX", "ATTR"):
+        node = node[1]
+    return node
+
+
+def may_change(block: ParseNode, names: set) -> bool:
+    """ Whether anything in block could change one of names, which are (kind, name) pairs
+
+    Errs on the side of saying yes.
+
+    """
+    changed = False
+    has_globals = any(kind == "GLOBALVAR" for kind, name in names)
+
+    def changes(node):
+        return (node.kind, node.value) in names
+
+    def check(node, depth):
+        nonlocal changed
+        if changed or node.kind in ("FUNCTION", "CLASS"):
+            return False
+        if node.kind == "ASSIGNMENT":
+            lhs = root_variable(node[1])
+            if changes(lhs) or lhs.kind not in ("VAR", "GLOBALVAR") and \
+                    visitor.walk(lhs, post=lambda n, r: changes(n) or any(r)):
+                changed = True
+        elif node.kind == "OPERATOR1" and node.value in ("++", "--", "&"):
+            changed = changes(root_variable(node[0]))
+        elif node.kind == "GLOBAL":
+            changed = any(changes(ParseNode("VAR", None, v.value)) for v in node)
+        elif node.kind == "CALLSPECIAL":
+            if node.value not in READ_ONLY_BUILTINS:
+                changed = True
+        elif node.kind == "CALL":
+            if node[1].kind != "CONSTANT" or node[1].value.lower() not in READ_ONLY_BUILTINS:
+                # Php functions can take references, and can change globals
+                changed = has_globals or changes(root_variable(node[1])) or \
+                    any(changes(root_variable(a[0])) for a in node["EXPRESSIONGROUP"] if len(a) > 0)
+
+    visitor.walk(block, pre=check)
+    return changed
+
+
+# Switches with fewer cases than this are an if for each branch, even if every case is a literal
+DISPATCH_CASES = 4
+
+
 @transforms("SWITCH")
 def transform_switch(node: ParseNode) -> IfNode:
-    decide_ex = t.transform_expr_node(node["EXPRESSIONGROUP"]["EXPRESSION"])
-    switch_var = VariableNode("_switch_choice")
-
-    # The contents of the switch will be rearranged into a whole series of elif
-    contents = node["BLOCK"]
-    # We are going to ignore "STATEMENT" nodes directly in block for now - these are comments
-    first = contents[0]
-    if_rhs = t.transform_expr_node(first["EXPRESSION"])
-    if_decide = Operator2Node(first, switch_var, if_rhs)
-    if_block = transform_block(first["BLOCK"])
-
-    extras = []
-    elses = []
-    for c in contents:
-        if c.kind == "CASE":
-            elses.append(transform_case(c, switch_var, extras))
-            extras = []
-        elif c.kind == "DEFAULT":
-            elses.append(ElseNode(c, transform_block(c["BLOCK"])))
-        elif c.kind == "CASEFALLTHROUGH":
-            ctf_node = transform_case(c, switch_var, extras)
-            elses.append(ctf_node)
-            extras.append(ctf_node.decision)
-        elif c.kind == "STATEMENT":
-            pass
+    """ A switch, as an if for each branch or, if every case is a literal, a look up of its branch in a table
 
-    t.pre_statements.append(assignment_statement(switch_var, decide_ex))
-    return IfNode(first, if_decide, if_block, elses)
+    The table is a dict at the top of the module, from each case to the index of its branch. The index is then
+    found by halving the branches, so a switch with a lot of cases takes a few comparisons rather than one for each.
 
+    Cases with nothing in them run the branch of the case after. The statements of the branches a branch falls
+    through to are repeated in it.
 
-def transform_case(node: ParseNode, switch_var: VariableNode, extras: List[ExpressionNode]) -> ElifNode:
+    """
+    decide_ex = yield t.transform_expr_node(node["EXPRESSIONGROUP"]["EXPRESSION"])
+    # The STATEMENT nodes directly in the block are comments and the ; after a break
+    entries = [c for c in node["BLOCK"] if c.kind in ("CASE", "CASEFALLTHROUGH", "DEFAULT")]
+
+    # Each branch as its cases, whether it's the default, and its block
+    branches = []
+    cases = []
+    default = False
+    for i, c in enumerate(entries):
+        if c.kind == "DEFAULT":
+            default = True
+        else:
+            cases.append((yield t.transform_expr_node(c["EXPRESSION"])))
+        if c.kind == "CASEFALLTHROUGH" and len(c["BLOCK"]) == 0 and i < len(entries) - 1:
+            continue
+        statements = []
+        for following in entries[i:]:
+            statements.extend((yield transform_block(following["BLOCK"])).children)
+            if following.kind != "CASEFALLTHROUGH":
+                break
+        branches.append((cases, default, BlockNode(c["BLOCK"], statements)))
+        cases = []
+        default = False
+
+    all_cases = [c for b in branches for c in b[0]]
+    if len(all_cases) >= DISPATCH_CASES and all(folding.is_literal(c) for c in all_cases):
+        return dispatch_switch(node, decide_ex, branches)
+    return chain_switch(node, decide_ex, branches)
+
+
+def chain_switch(node: ParseNode, decide_ex: ExpressionNode, branches: list) -> IfNode:
+    t.pre_statements.append(assignment_statement(VariableNode("_switch_choice"), decide_ex))
+    ifs = []
+    default = None
+    for cases, is_default, block in branches:
+        if is_default:
+            # Only taken if no other case matches, wherever it is
+            default = block
+            continue
+        decision = None
+        for c in cases:
+            equal = Operator2Node("==", VariableNode("_switch_choice"), c)
+            decision = equal if decision is None else Operator2Node("or", decision, equal)
+        ifs.append((decision, block))
+    if len(ifs) == 0:
+        return IfNode(node, BoolNode("True"), default if default is not None else BlockNode("", []), [])
+    elses = [ElifNode("", decision, block) for decision, block in ifs[1:]]
+    if default is not None:
+        elses.append(ElseNode("", default))
+    return IfNode(node, ifs[0][0], ifs[0][1], elses)
+
+
+def dispatch_switch(node: ParseNode, decide_ex: ExpressionNode, branches: list) -> IfNode:
+    keys = []
+    values = []
+    found = set()
+    for index, (cases, is_default, block) in enumerate(branches):
+        for c in cases:
+            # The first case which matches is the one taken
+            value = folding.literal(c)
+            if value not in found:
+                found.add(value)
+                keys.append(c)
+                values.append(folding.make_literal(index))
+    blocks = [b[2] for b in branches]
+    default = next((i for i, b in enumerate(branches) if b[1]), None)
+    if default is None:
+        # An index past the branches, for nothing to run
+        default = len(blocks)
+        blocks.append(BlockNode("", []))
+    if len(blocks) == 1:
+        return chain_switch(node, decide_ex, branches)
+
+    table = VariableNode("{}{}".format(scopes.CASE_TABLE, len(t.case_tables)))
+    t.case_tables.append(scopes.assignment(table, DictNode("", keys, values)))
+    look_up = CallNode("", Operator2Node(".", table, IdentNode("get")), [decide_ex, folding.make_literal(default)])
+    t.pre_statements.append(assignment_statement(VariableNode("_switch_branch"), look_up))
+    return choose_branch(node, blocks, 0, len(blocks))
+
+
+def choose_branch(node: ParseNode, blocks: List[BlockNode], start: int, end: int) -> IfNode:
+    """ An if which runs whichever of blocks[start:end] _switch_branch is the index of
 
-    rhs = t.transform_expr_node(node["EXPRESSION"])
-    decision = Operator2Node("==", switch_var, rhs)
-    for e in extras:
-        decision = Operator2Node("or", e, decision)
-    block = transform_block(node["BLOCK"])
-    return ElifNode(node, decision, block)
+    """
+    middle = (start + end) // 2
+    decision = Operator2Node("<", VariableNode("_switch_branch"), folding.make_literal(middle))
+    block = blocks[start] if middle - start == 1 else BlockNode("", [choose_branch(node, blocks, start, middle)])
+    if end - middle > 1:
+        after = choose_branch(node, blocks, middle, end)
+        elses = [ElifNode("", after.condition, after.block)] + after.elses
+    elif len(blocks[middle].children) > 0:
+        elses = [ElseNode("", blocks[middle])]
+    else:
+        # Nothing runs for the index past the branches
+        elses = []
+    return IfNode(node, decision, block, elses)
 
 
 @transforms("TRY")
@@ -277,11 +648,11 @@ def transform_try(node: ParseNode):
     catches = []
     for c in node.get_all("CATCH"):
         exc = [transform_exception(e) for e in c.get_all("EXCEPTION")]
-        exc_name = t.transform_expr_node(c["AS"][0])
-        catch_block = transform_block(c["BLOCK"])
+        exc_name = yield t.transform_expr_node(c["AS"][0])
+        catch_block = yield transform_block(c["BLOCK"])
         catches.append(CatchNode(c, exc, exc_name, catch_block))
 
-    block = transform_block(node["BLOCK"])
+    block = yield transform_block(node["BLOCK"])
     return TryNode(node, block, catches)
 
 
@@ -289,28 +660,40 @@ def transform_exception(node: ParseNode) -> ExceptionNode:
     return ExceptionNode(node)
 
 
+@transforms("GLOBAL")
+def transform_global(node: ParseNode) -> GlobalNode:
+    return GlobalNode(node, [VariableNode(v) for v in node])
+
+
 @transforms("RETURN")
 def transform_return(node: ParseNode) -> ReturnNode:
-    return ReturnNode(node, t.transform_expr_node(node[0]))
+    return ReturnNode(node, (yield t.transform_expr_node(node[0])))
+
+
+@transforms("THROW")
+def transform_throw(node: ParseNode) -> ThrowNode:
+    return ThrowNode(node, (yield t.transform_expr_node(node[0])))
 
 
 @transforms("EXPRESSION")
 def transform_plain_expression(expression_node: ParseNode) -> ExpressionNode:
     if len(expression_node) == 0:
-        return NoopNode(ParseNode("NOOP", expression_node.token))
+        return NoopNode(ParseNode("NOOP", expression_node))
     return t.transform_expr_node(expression_node[0])
 
 
 @transforms("ASSIGNMENT")
 def transform_assignment(node: ParseNode) -> AssignmentNode:
     # hoist assignments out of if statements etc
-    lhs = t.transform_expr_node(node[1])
-    rhs = t.transform_expr_node(node[0])
+    lhs = yield t.transform_expr_node(node[1])
+    rhs = yield t.transform_expr_node(node[0])
+    op = AssignmentNode(node, lhs, rhs)
+    op.value = op_map.get(node.value, node.value)
     if t.hoisting:
-        t.pre_statements.append(assignment_statement(lhs, rhs))
+        t.pre_statements.append(ExpressionStatement(node, op))
         return lhs
     else:
-        return AssignmentNode(node, lhs, rhs)
+        return op
 
 
 @transforms("NOOP")
@@ -322,12 +705,24 @@ def transform_noop(node: ParseNode) -> NoopNode:
 def transform_index(node: ParseNode) -> IndexNode:
     exp = node["EXPRESSION"]
     if len(exp) == 0:
-        exp.append(ParseNode("STRING", exp.token, "MagicEmptyArrayIndex"))
-    lookup = transform_plain_expression(node[0])
-    target = t.transform_expr_node(node[1])
+        lookup = StringNode(ParseNode("STRING", exp, "MagicEmptyArrayIndex"))
+    else:
+        lookup = yield transform_plain_expression(exp)
+    target = yield t.transform_expr_node(node[1])
     return IndexNode(node, target, lookup)
 
 
+@transforms("EXPRESSIONGROUP")
+def transform_expression_group(node: ParseNode) -> TupleNode:
+    """ Brackets around an expression, which are kept so that precedence is the same in python
+
+    """
+    children = []
+    for c in node:
+        children.append((yield t.transform_expr_node(c)))
+    return TupleNode(node, children)
+
+
 @transforms("STRING")
 def transform_string(node: ParseNode) -> StringNode:
     return StringNode(node)
@@ -362,15 +757,17 @@ def transform_constant(node: ParseNode) -> Operator2Node:
 @transforms("CALLSPECIAL")
 def transform_callspecial(node: ParseNode) -> CallNode:
     if node.value == "array":
-        return transform_array(node)
+        return (yield transform_array(node))
     elif node.value == "isset":
-        return transform_isset(node)
+        return (yield transform_isset(node))
     elif node.value == "__dir__":
         file = VariableNode("__file__")
         return f_call(node, "dirname", [file])
 
     # Basis transforms
-    args = [t.transform_expr_node(c) for c in node["ARGSLIST"].children]
+    args = []
+    for c in node["ARGSLIST"]:
+        args.append((yield t.transform_expr_node(c)))
     if node.value == "unset":
         return CallNode(node, IdentNode("del"), args)
     else:
@@ -382,7 +779,7 @@ def transform_array(node: ParseNode) -> CallNode:
     i = 0
     children = []
     for exp in node["ARGSLIST"]:
-        el = t.transform_expr_node(exp)
+        el = yield t.transform_expr_node(exp)
         if el.value == "=>":
             assert isinstance(el, Operator2Node)
             children.append(TupleNode(el.parse_node, [el.lhs, el.rhs]))
@@ -406,7 +803,7 @@ def transform_isset(node: ParseNode):
     """
     # TODO: Deal with more than one argument
     not_none = Operator1Node("not", NoneNode(node))
-    is_ = Operator2Node("is", t.transform_expr_node(node["ARGSLIST"]["EXPRESSION"]), not_none)
+    is_ = Operator2Node("is", (yield t.transform_expr_node(node["ARGSLIST"]["EXPRESSION"])), not_none)
     tempvar = VariableNode("_tempvar")
     try_contents = [assignment_statement(tempvar, is_)]
     try_block = BlockNode(node, try_contents)
@@ -419,58 +816,62 @@ def transform_isset(node: ParseNode):
 
 @transforms("OPERATOR2")
 def transform_operator2(node: ParseNode) -> Operator2Node:
-    if node.value in op_map:
-        node.value = op_map[node.value]
-    lhs = t.transform_expr_node(node[1])
-    rhs = t.transform_expr_node(node[0])
-    return Operator2Node(node, lhs, rhs)
+    lhs = yield t.transform_expr_node(node[1])
+    rhs = yield t.transform_expr_node(node[0])
+    op = Operator2Node(node, lhs, rhs)
+    op.value = op_map.get(node.value, node.value)
+    return op
 
 
 @transforms("OPERATOR1")
 def transform_operator1(node: ParseNode):
     if node.value in ["++", "--"]:
-        node.value = node.value[0] + "="
-        node.children.insert(0, ParseNode("INT", node.token, "1"))
-        node.kind = "OPERATOR2"
-        return transform_operator2(node)
+        lhs = yield t.transform_expr_node(node[0])
+        op = Operator2Node(node, lhs, IntNode("1"))
+        op.value = node.value[0] + "="
+        return op
 
-    if node.value in op_map:
-        node.value = op_map[node.value]
-    child = t.transform_expr_node(node[0])
-    return Operator1Node(node, child)
+    child = yield t.transform_expr_node(node[0])
+    if cast_map.get(node.value) in cast_functions:
+        return f_call(node, cast_functions[cast_map[node.value]], [child])
+    op = Operator1Node(node, child)
+    op.value = op_map.get(node.value, node.value)
+    return op
 
 
 @transforms("OPERATOR3")
 def transform_operator3(node: ParseNode) -> Operator3Node:
-    condition = t.transform_expr_node(node[2])
-    true_res = t.transform_expr_node(node[0])
-    false_res = t.transform_expr_node(node[1])
+    condition = yield t.transform_expr_node(node[2])
+    true_res = yield t.transform_expr_node(node[0])
+    false_res = yield t.transform_expr_node(node[1])
     return Operator3Node(node, condition, true_res, false_res)
 
 
 @transforms("CALL")
 def transform_call(node: ParseNode):
+    # Php function and method names aren't case sensitive
     if node[1].kind == "CONSTANT":
-        node[1].value = node[1].value.lower()
         lhs = f_access(node[1])
+        lhs.rhs.value = lhs.rhs.value.lower()
     elif node[1].kind == "ATTR":
-        node[1][0].value = node[1][0].value.lower()
-        lhs = transform_attr(node[1])
+        lhs = yield transform_attr(node[1])
+        lhs.rhs.value = lhs.rhs.value.lower()
     else:
-        lhs = t.transform_expr_node(node[1])
+        lhs = yield t.transform_expr_node(node[1])
     args = []
     for a in node["EXPRESSIONGROUP"]:
-        args.append(t.transform_expr_node(a))
+        args.append((yield t.transform_expr_node(a)))
     return CallNode(node, lhs, args)
 
 
 @transforms("ATTR")
 def transform_attr(node: ParseNode) -> Operator2Node:
-    lhs = t.transform_expr_node(node[1])
+    lhs = yield t.transform_expr_node(node[1])
     # right hand side of attrs are just idents
     if node[0].kind == "CONSTANT":
-        node[0].kind = "IDENT"
-    rhs = t.transform_expr_node(node[0])
+        rhs = IdentNode(node[0])
+    else:
+        rhs = yield t.transform_expr_node(node[0])
     return Operator2Node(".", lhs, rhs)
 
 
@@ -481,8 +882,9 @@ def transform_staticattr(node: ParseNode) -> Operator2Node:
     else:
         raise NotImplementedError("Expect LHS of staticattr to be constant")
     if node[0].kind == "CONSTANT":
-        node[0].kind = "IDENT"
-    rhs = t.transform_expr_node(node[0])
+        rhs = IdentNode(node[0])
+    else:
+        rhs = yield t.transform_expr_node(node[0])
     return Operator2Node(".", lhs, rhs)
 
 
@@ -494,22 +896,22 @@ def transform_new(node: ParseNode) -> CallNode:
         access_node = c_access(class_name)
         args = []
         for a in class_call["EXPRESSIONGROUP"]:
-            args.append(t.transform_expr_node(a))
+            args.append((yield t.transform_expr_node(a)))
         return CallNode(node, access_node, args)
     else:
         ga = IdentNode("getattr")
-        ga_args = [VariableNode("_c_"), t.transform_expr_node(node["CALL"][1])]
+        ga_args = [VariableNode("_c_"), (yield t.transform_expr_node(node["CALL"][1]))]
         ga_call = CallNode("node", ga, ga_args)
         args = []
         for a in node["CALL"]["EXPRESSIONGROUP"]:
-            args.append(t.transform_expr_node(a))
+            args.append((yield t.transform_expr_node(a)))
         return CallNode(node, ga_call, args)
 
 
 @transforms("GETATTR")
 def transform_getattr(node: ParseNode) -> CallNode:
-    obj = t.transform_expr_node(node[1])
-    name = t.transform_expr_node(node[0])
+    obj = yield t.transform_expr_node(node[1])
+    name = yield t.transform_expr_node(node[0])
     return CallNode(node, IdentNode("getattr"), [obj, name])
 
 
@@ -554,14 +956,18 @@ def f_call(node: ParseNode, f_name: str, args: List[ExpressionNode]):
     return CallNode(node, op2, args)
 
 
+def add_int(node: ExpressionNode, i: int) -> ExpressionNode:
+    if node.kind == "INT":
+        return IntNode(str(int(node.value) + i))
+    return Operator2Node("+" if i > 0 else "-", node, IntNode(str(abs(i))))
+
+
 def assignment_statement(lhs, rhs) -> ExpressionStatement:
-    token = lhs.token
-    op2_pn = ParseNode("ASSIGNMENT", token, "=")
+    op2_pn = ParseNode("ASSIGNMENT", lhs.parse_node, "=")
     op2 = AssignmentNode(op2_pn, lhs, rhs)
     return ExpressionStatement(op2_pn, op2)
 
 
-# TODO: String casts for bools are "1" and "", not "True" and "False"
 cast_map = {
     "(int)": "int",
     "(integer)": "int",
@@ -576,6 +982,15 @@ cast_map = {
     "(unset)": None,    # TODO: unset should be not so shit. Use "del"
 }
 
+# The php functions which convert to the python types of the casts, the way php does. typer puts the python type
+# back where it's proven to do the same.
+cast_functions = {
+    "int": "intval",
+    "float": "floatval",
+    "bool": "boolval",
+    "str": "strval",
+}
+
 
 op_map = {
     "!": "not ",
@@ -584,4 +999,5 @@ op_map = {
     "||": "or",
     "===": "==",     # TODO: Do we need to use a function here? I think the == case is the naughty one...
     "!==": "!=",
+    ".=": "+=",
 }
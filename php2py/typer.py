@@ -1,25 +1,433 @@
-from typing import Callable
-from copy import deepcopy
-
-class Typer:
-    def __init__(self):
-        self.callables = {}
-        self.typed = {}
-        for function_name, function in phpfunctions.functionlist:
-            self.callables[function_name] = self.type_sig(function)
-
-    def type_sig(self, function: Callable):
-        if hasattr(function, "__annotations__"):
-            return function.__annotations__
+""" Type inference over the intermediate tree
+
+Works out the python type an expression has at runtime wherever it can be proven, and records it as the type of
+the node, which is left as Unknown everywhere else. Types start from literals, casts, the return annotations of the
+builtins and the types php gives parameters, and follow the assignments to locals a statement at a time. A local
+which the branches of an if, or the runs of a loop, could leave with different types is Unknown after them. Only
+locals are followed, as nothing but an assignment in the function itself can change one.
+
+Parameter types are only taken as given under php's strict_types, since the compiled functions don't check them.
+Otherwise the transformer converts the arguments when the function starts, and the types follow from that.
+
+Php converts a value to the type an operation needs, where python would raise or give something else, and the
+compiled code calls the php conversion functions to do the same. Where the types prove python would already do it,
+the plain python is used instead: a cast to the type something already has goes, as does one python does the same
+way, and a . of two strings stays a +. ConcatNode only converts its parts which aren't proven strings.
+
+"""
+from typing import Dict, Iterable, List
+
+from .clib import visitor
+from .intermediate import *
+from .phpbaselib.functions import Functions
+from .phpbaselib.phptypes import PhpArray
+from .phpbaselib.specials import Specials
+from . import folding
+
+
+UNKNOWN = "Unknown"
+
+# The types of the values a python annotation allows
+ANNOTATION_TYPES = {int: "int", float: "float", str: "str", bool: "bool", None: "None", PhpArray: "array"}
+
+# The types of php's parameter types
+PARAMETER_TYPES = {"int": "int", "float": "float", "string": "str", "bool": "bool", "array": "array"}
+
+# The python type each php conversion function gives, and the other types python converts the same way
+CONVERSIONS = {
+    "intval": ("int", {"bool"}),
+    "floatval": ("float", {"int", "bool"}),
+    "boolval": ("bool", {"int", "float", "None"}),
+    "strval": ("str", {"int"}),
+}
+
+# The types of the python builtins the compiled code calls
+PYTHON_CALLS = {"int": "int", "float": "float", "bool": "bool", "str": "str"}
+
+KIND_TYPES = {"STRING": "str", "INT": "int", "FLOAT": "float", "BOOL": "bool", "NONE": "None", "CONCAT": "str"}
+
+COMPARISONS = {"==", "!=", "<>", "===", "!==", "<", ">", "<=", ">="}
+
+# Python does arithmetic on bools as ints
+INTEGERS = {"int", "bool"}
+NUMBERS = {"int", "bool", "float"}
+
+# Operands which a conversion can be taken off without any brackets
+ATOMIC = {"VAR", "INT", "FLOAT", "STRING", "BOOL", "NONE", "TUPLE", "CALL", "INDEX", "CONCAT"}
+
+
+def return_types(*classes) -> Dict[str, str]:
+    """ The types the methods of classes are annotated as returning, by name
+
+    The annotations are taken as proof of the type, so a builtin which could give anything else, such as false when
+    something is missing, is annotated with a Union and left out.
+
+    """
+    types = {}
+    for c in classes:
+        for name in dir(c):
+            annotations = getattr(getattr(c, name), "__annotations__", {})
+            if name.startswith("_") or "return" not in annotations:
+                continue
+            try:
+                t = ANNOTATION_TYPES.get(annotations["return"])
+            except TypeError:
+                # Unhashable, so nothing in ANNOTATION_TYPES
+                t = None
+            if t is not None:
+                types[name] = t
+    return types
+
+
+RETURN_TYPES = return_types(Functions, Specials)
+
+
+def infer(root: RootNode):
+    """ Work out the types in every function and method, and take out the conversions they prove aren't needed
+
+    Has to run after scopes.analyse, which decides which variables are python locals.
+
+    """
+    def pre(node, depth):
+        if node.kind in ("FUNCTION", "METHOD", "CLASSMETHOD"):
+            infer_function(node)
+
+    visitor.walk(root, pre=pre)
+
+
+def infer_function(function: FunctionNode):
+    env = {}
+    for a in function.args:
+        if a.kind == "ASSIGNMENT" and a.lhs.kind == "VAR":
+            # A default of some other type, such as null, could be used instead
+            env[a.lhs.value] = merge_types(a.lhs.type, infer_expression(a.rhs, {}, False).type)
+        elif a.kind == "VAR":
+            env[a.value] = a.type
+    infer_block(function.body.children, env, True)
+
+
+def merge_types(*types: str) -> str:
+    return types[0] if all(t == types[0] for t in types) else UNKNOWN
+
+
+def merge(*envs: dict) -> dict:
+    """ The types locals have after any of envs
+
+    """
+    names = set()
+    for env in envs:
+        names.update(env)
+    return {n: merge_types(*[env.get(n, UNKNOWN) for env in envs]) for n in names}
+
+
+def forget(env: dict, names: Iterable[str]) -> dict:
+    forgotten = dict(env)
+    for n in names:
+        forgotten[n] = UNKNOWN
+    return forgotten
+
+
+def infer_block(statements: List[StatementNode], env: dict, specialise: bool) -> dict:
+    """ Type the statements in order, returning the types of the locals after them
+
+    Conversions are only taken out if specialise is set, since the types found while a loop is still being worked
+    out don't hold for every run of it.
+
+    """
+    for s in statements:
+        env = infer_statement(s, env, specialise)
+    return env
+
+
+def infer_statement(statement: StatementNode, env: dict, specialise: bool) -> dict:
+    kind = statement.kind
+    if isinstance(statement, ExpressionStatement):
+        if statement.child is not None:
+            statement.child = infer_expression(statement.child, env, specialise)
+        return env
+    if kind == "IF":
+        statement.condition = infer_expression(statement.condition, env, specialise)
+        ends = [infer_block(statement.block.children, dict(env), specialise)]
+        for e in statement.elses:
+            branch = dict(env)
+            if e.kind == "ELIF":
+                e.condition = infer_expression(e.condition, branch, specialise)
+            ends.append(infer_block(e.block.children, branch, specialise))
+        if len(statement.elses) == 0 or statement.elses[-1].kind != "ELSE":
+            ends.append(env)
+        return merge(*ends)
+    if kind in ("WHILE", "FOR"):
+        return infer_loop(statement, env, specialise)
+    if kind == "TRY":
+        return infer_try(statement, env, specialise)
+    if kind == "GLOBAL":
+        return forget(env, [v.value for v in statement.variables])
+    if kind in ("HTML", "CONSTANTS", "NOOP", "COMMENT", "FUNCTION", "CLASS"):
+        return env
+    # Anything else is left untyped, but could still change the locals
+    return forget(env, assigned_names(statement))
+
+
+def infer_loop(loop: BlockStatement, env: dict, specialise: bool) -> dict:
+    """ Type a loop, from the types its locals could have at the start of any run of it
+
+    Each pass through the body can only make more locals Unknown, so this settles after a pass or two.
+
+    """
+    thing_type = UNKNOWN
+    if loop.kind == "FOR":
+        # The items are only worked out once, before the first run
+        loop.items = infer_expression(loop.items, env, specialise)
+        if loop.items.kind == "CALL" and loop.items.callee.kind == "IDENT" and loop.items.callee.value == "range":
+            thing_type = "int"
+    entry = env
+    while True:
+        inside = start_run(loop, entry, thing_type, False)
+        end = infer_block(loop.block.children, inside, False)
+        widened = merge(env, end)
+        if widened == entry:
+            break
+        entry = widened
+    if specialise:
+        infer_block(loop.block.children, start_run(loop, entry, thing_type, True), True)
+    return entry
+
+
+def start_run(loop: BlockStatement, entry: dict, thing_type: str, specialise: bool) -> dict:
+    """ The types of the locals once the loop has checked whether to run again
+
+    """
+    inside = dict(entry)
+    if loop.kind == "WHILE":
+        loop.condition = infer_expression(loop.condition, inside, specialise)
+    elif loop.thing.kind == "VAR":
+        inside[loop.thing.value] = thing_type
+    else:
+        inside = forget(inside, assigned_names(loop.thing))
+    return inside
+
+
+def infer_try(statement: TryNode, env: dict, specialise: bool) -> dict:
+    ends = [infer_block(statement.block.children, dict(env), specialise)]
+    # An exception could come from anywhere in the try, so whatever it assigns could have either type
+    raised = forget(env, assigned_names(statement.block))
+    for c in statement.catches:
+        inside = dict(raised)
+        if c.exc_name is not None and c.exc_name.kind == "VAR":
+            inside[c.exc_name.value] = UNKNOWN
+        ends.append(infer_block(c.block.children, inside, specialise))
+    after = merge(*ends)
+    if statement.finally_ is not None:
+        # The finally runs after an exception too
+        after = forget(after, assigned_names(statement))
+        after = infer_block(statement.finally_.block.children, after, specialise)
+    return after
+
+
+def assigned_names(node: IntermediateNode) -> set:
+    """ The names of the locals anything under node could change
+
+    """
+    names = set()
+
+    def pre(n, depth):
+        if n.kind in ("FUNCTION", "METHOD", "CLASSMETHOD", "CLASS"):
+            return False
+        if n.kind == "ASSIGNMENT" or is_increment(n):
+            names.update(target_names(n.lhs))
+        elif n.kind == "FOR":
+            names.update(target_names(n.thing))
+        elif n.kind == "CATCH" and n.exc_name is not None:
+            names.update(target_names(n.exc_name))
+        elif is_del(n):
+            for a in n.args:
+                names.update(target_names(a))
+
+    visitor.walk(node, pre=pre)
+    return names
+
+
+def target_names(target: ExpressionNode) -> List[str]:
+    """ The locals whose type an assignment to target could change
+
+    """
+    if target.kind == "VAR":
+        return [target.value]
+    if target.kind == "INDEX":
+        return target_names(target.target)
+    if target.kind in ("TUPLE", "LIST", "COMMALIST"):
+        return [n for c in target.children for n in target_names(c)]
+    return []
+
+
+def is_increment(node: IntermediateNode) -> bool:
+    """ Whether node is a php ++ or --, which the transformer makes into a += 1 or -= 1
+
+    """
+    return (node.kind == "OPERATOR2" and node.parse_node is not None and node.parse_node.kind == "OPERATOR1" and
+            node.parse_node.value in ("++", "--"))
+
+
+def is_del(node: IntermediateNode) -> bool:
+    return node.kind == "CALL" and node.callee.kind == "IDENT" and node.callee.value == "del"
+
+
+def infer_expression(node: ExpressionNode, env: dict, specialise: bool) -> ExpressionNode:
+    """ Type node and everything under it, returning what node should be replaced with
+
+    env is updated with any assignments node makes. An assignment in a branch of a ?:, or on the right of a && or ||,
+    might not run, so leaves what it assigns Unknown.
+
+    """
+    replacements = {}
+    # The names after a python ., which aren't variables
+    attributes = set()
+    # The operands which might not run, and how many of them the walk is inside
+    conditional = set()
+    inside = [0]
+
+    def pre(n, depth):
+        if id(n) in conditional:
+            inside[0] += 1
+        if n.kind == "OPERATOR2" and n.value == "." and not folding.is_php_operator(n):
+            attributes.add(id(n.rhs))
+        elif n.kind == "OPERATOR3":
+            conditional.update((id(n.true_res), id(n.false_res)))
+        elif n.kind == "OPERATOR2" and folding.is_php_operator(n) and n.parse_node.value in ("&&", "||", "and", "or"):
+            conditional.add(id(n.rhs))
+
+    def post(n, results):
+        n.replace_children(lambda c: replacements.pop(id(c), c))
+        n.type = UNKNOWN if id(n) in attributes else expression_type(n, env)
+        if specialise:
+            specialised = specialise_conversion(n)
+            if specialised is not n:
+                replacements[id(n)] = specialised
+        if inside[0] > 0:
+            if n.kind == "ASSIGNMENT" or is_increment(n):
+                env.update(forget(env, target_names(n.lhs)))
         else:
-            return None
+            assign(n, env)
+        if id(n) in conditional:
+            inside[0] -= 1
+
+    visitor.walk(node, pre=pre, post=post)
+    return replacements.get(id(node), node)
+
+
+def expression_type(node: ExpressionNode, env: dict) -> str:
+    """ The type of node, whose children have been typed already
+
+    """
+    kind = node.kind
+    if kind in KIND_TYPES:
+        return KIND_TYPES[kind]
+    if kind == "IDENT" and node.value in ("True", "False"):
+        return "bool"
+    if kind == "VAR":
+        return env.get(node.value, UNKNOWN)
+    if kind == "TUPLE" and len(node.children) == 1:
+        return node.children[0].type
+    if kind == "ASSIGNMENT":
+        op = node.parse_node.value if folding.is_php_operator(node) else node.value
+        return node.rhs.type if op == "=" else binary_type(op[:-1], node.lhs.type, node.rhs.type)
+    if is_increment(node):
+        return binary_type(node.value[0], node.lhs.type, "int")
+    if kind == "OPERATOR2" and folding.is_php_operator(node):
+        return binary_type(node.parse_node.value, node.lhs.type, node.rhs.type)
+    if kind == "OPERATOR1" and folding.is_php_operator(node):
+        return unary_type(node.parse_node.value, node.child.type)
+    if kind == "OPERATOR3":
+        return merge_types(node.true_res.type, node.false_res.type)
+    if kind == "CALL":
+        return call_type(node)
+    return UNKNOWN
+
+
+def binary_type(op: str, a: str, b: str) -> str:
+    """ The type python gives for the php operator op on a and b, as compiled
+
+    """
+    if op == ".":
+        return "str"
+    if op in COMPARISONS:
+        return "bool"
+    if op in ("+", "-", "*"):
+        if a in INTEGERS and b in INTEGERS:
+            return "int"
+        if a in NUMBERS and b in NUMBERS:
+            return "float"
+    if op == "/" and a in NUMBERS and b in NUMBERS:
+        return "float"
+    if op in ("%", "&", "|", "^", "<<", ">>") and a == "int" and b == "int":
+        return "int"
+    if op in ("&&", "||", "and", "or") and a == "bool" and b == "bool":
+        return "bool"
+    return UNKNOWN
+
+
+def unary_type(op: str, a: str) -> str:
+    if op == "!":
+        return "bool"
+    if op in ("-", "+"):
+        return "int" if a in INTEGERS else a if a == "float" else UNKNOWN
+    if op == "~" and a == "int":
+        return "int"
+    return UNKNOWN
+
+
+def call_type(call: CallNode) -> str:
+    callee = call.callee
+    if callee.kind == "IDENT":
+        return PYTHON_CALLS.get(callee.value, UNKNOWN)
+    if callee.kind == "OPERATOR2" and callee.value == "." and callee.lhs.kind == "VAR" and \
+            callee.lhs.value == "_f_":
+        return RETURN_TYPES.get(callee.rhs.value, UNKNOWN)
+    return UNKNOWN
+
+
+def assign(node: ExpressionNode, env: dict):
+    """ Record the types of the locals node assigns to in env
+
+    """
+    if node.kind != "ASSIGNMENT" and not is_increment(node):
+        return
+    if node.lhs.kind == "VAR":
+        env[node.lhs.value] = node.type
+    elif node.lhs.kind == "INDEX":
+        # Setting an element of an array leaves it an array, but could make null or a string into something else
+        for name in target_names(node.lhs):
+            if env.get(name) != "array":
+                env[name] = UNKNOWN
+    else:
+        env.update(forget(env, target_names(node.lhs)))
+
+
+def specialise_conversion(node: ExpressionNode) -> ExpressionNode:
+    """ What to compile node to, given the types of its children
 
-def test(bob: str) -> int:
-    pass
+    A php conversion of something which already has its type is dropped, and one python does the same way becomes
+    the python type. The rhs of a .= is converted to a string unless it is one already.
 
-if __name__ == "__main__":
-    print(test)
-    print(test.__annotations__)
-    t = Typer()
-    import pprint
-    pprint.pprint(t.callables)
+    """
+    if node.kind == "ASSIGNMENT" and folding.is_php_operator(node) and node.parse_node.value == ".=" and \
+            node.rhs.type != "str":
+        node.rhs = ConcatNode("", [node.rhs])
+        return node
+    if node.kind != "CALL" or len(node.args) != 1:
+        return node
+    callee = node.callee
+    if not (callee.kind == "OPERATOR2" and callee.value == "." and callee.lhs.kind == "VAR" and
+            callee.lhs.value == "_f_" and callee.rhs.value in CONVERSIONS):
+        return node
+    python_type, same = CONVERSIONS[callee.rhs.value]
+    operand = node.args[0]
+    if operand.type == python_type:
+        if operand.kind in ATOMIC:
+            return operand
+        bracketed = TupleNode("", [operand])
+        bracketed.type = operand.type
+        return bracketed
+    if operand.type in same:
+        node.callee = IdentNode(python_type)
+    return node
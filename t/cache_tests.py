@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from php2py.clib import cache
+from php2py.compiler import Compiler
+from tlib.php2pytests import parse_string
+
+
+source = """<p>a</p><?php
+define("B", 2);
+function c($d, $e = array(1, 'f')) {
+    // g
+    return $d . $e[0] * -3;
+}
+?><p>h</p>
+"""
+
+
+class CacheTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        tree = parse_string(source).pt
+        loaded = cache.load(cache.dump(tree))
+        self.assertEqual(tree.root_node.to_list(), loaded.root_node.to_list())
+
+        def tokens(root_node):
+            return [(n.id_, n.line, n.col, n.value) for n in root_node.match("PHP/FUNCTION*")]
+        self.assertEqual(tokens(tree.root_node), tokens(loaded.root_node))
+
+    def test_same_compiled(self):
+        expected = str(Compiler(parse_string(source).get_tree()).compile())
+        loaded = cache.load(cache.dump(parse_string(source).pt))
+        self.assertEqual(expected, str(Compiler(loaded.root_node).compile()))
+
+    def test_get_and_put(self):
+        pc = cache.ParseCache(self.directory)
+        self.assertIsNone(pc.get(source))
+        pc.put(source, parse_string(source).pt)
+        self.assertIsNotNone(pc.get(source))
+        self.assertIsNone(pc.get(source + "\n"))
+
+    def test_bad_entry(self):
+        pc = cache.ParseCache(self.directory)
+        path = pc.path(cache.cache_key(source))
+        os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as f:
+            f.write(b"junk")
+        self.assertIsNone(pc.get(source))
@@ -1,3 +1,4 @@
+from php2py.clib import visitor
 from tlib.php2pytests import *
 
 
@@ -10,8 +11,10 @@ class CompilerTests(Php2PyTestCase):
         """
         root_node = transformer.transform(root_node)
         print_tree(root_node)
-        sc = get_body(root_node).get("EX_STATEMENT").compile()
-        self.assertEqual('_f_.echo("Hello World")', sc[0])
+        sc = get_body(root_node).get("WRITE").compile()
+        self.assertEqual("_app_.write(_html_0)", sc[0])
+        # The html either side is joined on at compile time
+        self.assertEqual('_html_0 = " Simple echo\\n        Hello World\\n        "', root_node.constants.compile()[0])
 
     @parse_t
     def test_asign(self, root_node):
@@ -75,7 +78,7 @@ class CompilerTests(Php2PyTestCase):
         print("----------")
         print_tree(root_node)
         main = get_body(root_node).compile()
-        self.assertEqual("", main[2].strip())
+        self.assertEqual("", main[1].strip())
 
     @parse_t
     def test_class_compilation(self, root_node):
@@ -135,11 +138,11 @@ class CompilerTests(Php2PyTestCase):
     def test_compile_ternary(self, root_node):
         """ Compile a ternary operator
         <?php
-        $a = 1 ? "a" : "b";
+        $a = $b ? "a" : "b";
         """
         root_node = transformer.transform(root_node)
         statement = get_body(root_node)["EX_STATEMENT"].compile()
-        self.assertEqual('_g_.a = "a" if 1 else "b"', statement[0])
+        self.assertEqual('_g_.a = "a" if _g_.b else "b"', statement[0])
 
     @compile_body_t
     def test_compile_foreach(self, lines):
@@ -218,6 +221,19 @@ class CompilerTests(Php2PyTestCase):
             "_f_.b()"
         ], lines)
 
+    @parse_t
+    def test_constructor_parse_node(self, root_node):
+        """ Renaming php's magic methods leaves the parse tree as it was
+        <?php
+        class A {
+            function __construct() {
+            }
+        }
+        """
+        transformed = transformer.transform(root_node)
+        self.assertEqual("_php_construct", transformed.match("CLASS|A/BLOCK/METHOD").value)
+        self.assertEqual("__construct", root_node.match("PHP/CLASS|A/BLOCK/FUNCTION").value)
+
     @compile_class_t
     def test_self_attr_access(self, lines):
         """ A class that plays with itself
@@ -295,18 +311,18 @@ class CompilerTests(Php2PyTestCase):
     def test_if_else(self, lines):
         """ If with an elseif and an else
         <?php
-        if (1) {
+        if ($a) {
             2;
-        } elseif (2) {
+        } elseif ($b) {
             4;
         } else {
             6;
         }
         """
         self.assertSequenceEqual([
-            "if 1:",
+            "if _g_.a:",
             "2",
-            "elif 2:",
+            "elif _g_.b:",
             "4",
             "else:",
             "6",
@@ -326,3 +342,688 @@ class CompilerTests(Php2PyTestCase):
             "",
         ])
 
+    @compile_body_t
+    def test_brackets(self, lines):
+        """ Brackets are kept
+        <?php
+        $a = ($b + 1) * 2;
+        """
+        self.assertEqual("_g_.a = (_g_.b + 1) * 2", lines[0])
+
+    @parse_t
+    def test_function_locals(self, root_node):
+        """ Locals which could be read before they're set start off as None
+        <?php
+        function f($a) {
+            global $g;
+            if ($a) {
+                $b = 1;
+            }
+            $c = $a;
+            $g = $b . $c;
+        }
+        """
+        root_node = transformer.transform(root_node)
+        lines = [l for l, i in root_node.match("FUNCTION|f").compile()]
+        self.assertSequenceEqual([
+            "def f(a):",
+            "b = None",
+            "# global g",
+            "if a:",
+            "b = 1",
+            "c = a",
+            # $b could be null or an int, and $c anything, so both are converted
+            '_g_.g = f"{_f_.strval(b)}{_f_.strval(c)}"',
+        ], lines)
+
+    @parse_t
+    def test_hoist_globals(self, root_node):
+        """ Globals used often are held in locals, and stored back however the function exits
+        <?php
+        function f($n) {
+            global $total;
+            while ($n > 0) {
+                $total = $total + $n;
+                $n = $n - 1;
+            }
+            return $total;
+        }
+        """
+        root_node = transformer.transform(root_node)
+        lines = [l for l, i in root_node.match("FUNCTION|f").compile()]
+        self.assertSequenceEqual([
+            "def f(n):",
+            "_g_total = _g_.total",
+            "try:",
+            "# global total",
+            "while n > 0:",
+            "_g_total = _g_total + n",
+            "n = n - 1",
+            "return _g_total",
+            "finally:",
+            "_g_.total = _g_total",
+        ], lines)
+
+    @parse_t
+    def test_hoist_globals_not_past_calls(self, root_node):
+        """ A function which calls others might have them use the globals, so nothing is hoisted
+        <?php
+        function f() {
+            global $a;
+            $a = $a + $a + 1;
+            g();
+        }
+        function h() {
+            global $a;
+            $a = $a + $a + strlen("x");
+        }
+        """
+        transformed = transformer.transform(root_node)
+        self.assertEqual("_g_.a = _g_.a + _g_.a + 1", transformed.match("FUNCTION|f").compile()[2])
+        self.assertEqual("_g_a = _g_.a", transformed.match("FUNCTION|h").compile()[1])
+        # Three references isn't more than three
+        transformed = transformer.transform(root_node, min_globals_refactor=3)
+        self.assertEqual("# global a", transformed.match("FUNCTION|h").compile()[1])
+
+    @parse_t
+    def test_counted_for(self, root_node):
+        """ Counted loops use range, and the loop variable ends up where php would leave it
+        <?php
+        function f($a) {
+            for ($i = 0; $i < count($a); $i++) {
+                echo $a[$i];
+            }
+            for ($j = 10; $j >= 0; $j -= 2) {
+                echo $j;
+            }
+            return $i;
+        }
+        """
+        root_node = transformer.transform(root_node)
+        lines = [l for l, i in root_node.match("FUNCTION|f").compile()]
+        self.assertSequenceEqual([
+            "def f(a):",
+            "for i in range(0, _f_.count(a)):",
+            "_app_.write(_f_.strval(a[i]))",
+            "i = max(0, _f_.count(a))",
+            "for j in range(10, -1, -2):",
+            "_app_.write(j)",
+            "return i",
+        ], lines)
+
+        # The later passes change nodes in place, so none can be shared
+        seen = set()
+
+        def pre(n, depth):
+            self.assertNotIn(id(n), seen)
+            seen.add(id(n))
+
+        visitor.walk(root_node.match("FUNCTION|f"), pre=pre)
+
+    @parse_t
+    def test_counted_for_global(self, root_node):
+        """ A counted loop over a global keeps its exit value
+        <?php
+        for ($i = 0; $i < 3; $i++) {
+            echo $i;
+        }
+        """
+        root_node = transformer.transform(root_node)
+        lines = [l for l, i in root_node.match("FUNCTION|body").compile()]
+        self.assertSequenceEqual(["for _g_i in range(0, 3):", "_app_.write(_g_i)", "_g_i = max(0, 3)"], lines[4:7])
+
+    @parse_t
+    def test_for_while(self, root_node):
+        """ Loops which might change their own bounds become while loops
+        <?php
+        function f($n) {
+            for ($i = 0, $j = 0; $i < $n; $i++) {
+                $j++;
+            }
+            for ($i = 0; $i < 10; $i++) {
+                $i++;
+            }
+        }
+        """
+        root_node = transformer.transform(root_node)
+        lines = [l for l, i in root_node.match("FUNCTION|f").compile()]
+        self.assertSequenceEqual([
+            "def f(n):",
+            "i = 0",
+            "j = 0",
+            "while i < n:",
+            "j += 1",
+            "i += 1",
+            "i = 0",
+            "while i < 10:",
+            "i += 1",
+            "i += 1",
+        ], lines)
+
+    @parse_t
+    def test_constant_folding(self, root_node):
+        """ Operators on literals are worked out as php would
+        <?php
+        $a = "a" . "b" . 1;
+        $b = 60 * 60 * 24;
+        $c = !true;
+        $d = 6 / 3;
+        $e = 7 / 2;
+        $f = -7 % 3;
+        $g = false && f();
+        $h = "1" == "01";
+        $i = NULL;
+        $j = 1 / 0;
+        """
+        root_node = transformer.transform(root_node)
+        lines = [l for l, i in root_node.match("FUNCTION|body").compile() if l.startswith("_g_.")]
+        self.assertSequenceEqual([
+            '_g_.a = "ab1"',
+            "_g_.b = 86400",
+            "_g_.c = False",
+            "_g_.d = 2",
+            "_g_.e = 3.5",
+            "_g_.f = -1",
+            "_g_.g = False",
+            '_g_.h = "1" == "01"',
+            "_g_.i = None",
+            "_g_.j = 1 / 0",
+        ], lines)
+
+    @parse_t
+    def test_define_propagation(self, root_node):
+        """ Constants defined once at the top level with a literal are replaced by it
+        <?php
+        echo DAY;
+        define("DAY", 60 * 60 * 24);
+        define("WEEK", DAY * 7);
+        if ($a) {
+            define("MAYBE", 1);
+        }
+        function f() {
+            return WEEK + MAYBE;
+        }
+        """
+        root_node = transformer.transform(root_node)
+        body = [l for l, i in root_node.match("FUNCTION|body").compile() if l.startswith(("_f_.", "_app_."))]
+        self.assertEqual('_app_.write(_f_.strval(_constants_.DAY))', body[1])
+        self.assertEqual('_f_.define("WEEK", 604800)', body[3])
+        self.assertEqual("return 604800 + _constants_.MAYBE", root_node.match("FUNCTION|f").compile()[1])
+
+    @parse_t
+    def test_unreachable(self, root_node):
+        """ Code after return, throw and exit, and branches which can never run, are dropped
+        <?php
+        function f($a) {
+            if ($a) {
+                throw new Exception("a");
+                echo 1;
+            } elseif (false) {
+                echo 2;
+            } elseif (true) {
+                return 3;
+            } else {
+                echo 4;
+            }
+            echo 5;
+        }
+        if (false) {
+            echo 6;
+        }
+        exit(0);
+        echo 7;
+        function g() {
+        }
+        """
+        with self.assertLogs(level="WARNING") as logs:
+            root_node = transformer.transform(root_node, warn_unreachable=True)
+        self.assertSequenceEqual([
+            "def f(a):",
+            "if a:",
+            'raise _c_.Exception("a")',
+            "else:",
+            "return 3",
+        ], [l for l, i in root_node.match("FUNCTION|f").compile()])
+        # g is declared before anything runs, so still needs registering after the exit
+        self.assertSequenceEqual(["_f_.f = f", "_f_.exit(0)", "_f_.g = g"],
+                                 [l for l, i in root_node.match("FUNCTION|body").compile() if l.startswith("_f_")])
+        self.assertEqual(6, len(logs.output))
+
+    @parse_t
+    def test_compound_assignment(self, root_node):
+        """ Compound assignments keep their operator, but .= converts what it appends to unless it's a string
+        <?php
+        function f($a, $b) {
+            $a += 2;
+            $b .= "x";
+            return $a;
+        }
+        """
+        root_node = transformer.transform(root_node)
+        lines = [l for l, i in root_node.match("FUNCTION|f").compile()]
+        self.assertEqual("a += 2", lines[1])
+        # Converted once, a local still grows in place
+        self.assertEqual("b = _f_.strval(b)", lines[2])
+        self.assertEqual('b += "x"', lines[3])
+
+    @parse_t
+    def test_string_building(self, root_node):
+        """ Globals and properties only appended to in a loop are built in a list and joined once
+        <?php
+        class A {
+            function f($xs) {
+                foreach ($xs as $x) {
+                    $this->out .= $x;
+                    for ($i = 0; $i < 2; $i++) {
+                        $this->out .= "-";
+                    }
+                }
+                $s = "";
+                foreach ($xs as $x) {
+                    $s .= $x;
+                }
+            }
+        }
+        foreach ($rows as $row) {
+            $html .= $row;
+            echo strlen($html);
+        }
+        foreach ($rows as $row) {
+            $html .= $row;
+        }
+        render($html);
+        """
+        root_node = transformer.transform(root_node)
+        lines = [l for l, i in root_node.match("CLASS|A/BLOCK/METHOD|f").compile()]
+        self.assertSequenceEqual([
+            "def f(this, xs):",
+            "x = i = None",
+            "_parts_this_out = [this.out]",
+            "try:",
+            "for x in xs:",
+            "_parts_this_out.append(_f_.strval(x))",
+            "for i in range(0, 2):",
+            '_parts_this_out.append("-")',
+            "finally:",
+            # Left as it was unless the loop appended to it
+            "if len(_parts_this_out) > 1:",
+            "_parts_this_out[0] = _f_.strval(_parts_this_out[0])",
+            'this.out = "".join(_parts_this_out)',
+            's = ""',
+            # Python grows a local in place already
+            "for x in xs:",
+            "s += _f_.strval(x)",
+        ], lines)
+        # The first loop reads $html, and render could, so it's left alone
+        lines = [l for l, i in root_node.match("FUNCTION|body").compile()]
+        self.assertSequenceEqual([
+            "for _g_.row in _g_.rows:",
+            # $html could be null, or anything else
+            '_g_.html = f"{_f_.strval(_g_.html)}{_f_.strval(_g_.row)}"',
+            "_app_.write(_f_.strlen(_g_.html))",
+            "_parts_g_html = [_g_.html]",
+            "try:",
+            "for _g_.row in _g_.rows:",
+            "_parts_g_html.append(_f_.strval(_g_.row))",
+            "finally:",
+            "if len(_parts_g_html) > 1:",
+            "_parts_g_html[0] = _f_.strval(_parts_g_html[0])",
+            '_g_.html = "".join(_parts_g_html)',
+            "_f_.render(_g_.html)",
+        ], lines[3:15])
+
+    @parse_t
+    def test_concat_chains(self, root_node):
+        """ Chains of . are built in one go, converting what isn't a string already
+        <?php
+        function f(string $a, string $b) {
+            $c = $a . $b;
+            $c = "<{" . $a . "}>";
+            $c = $a . f("x") . $b;
+            return $a . $b . f("x") . $c;
+        }
+        """
+        root_node = transformer.transform(root_node)
+        lines = [l for l, i in root_node.match("FUNCTION|f").compile()]
+        self.assertSequenceEqual([
+            # Php converts the arguments, after which they're known to be strings
+            "a = _f_.strval(a)",
+            "b = _f_.strval(b)",
+            "c = a + b",
+            'c = f"<{{{a}}}>"',
+            'c = a + _f_.strval(_f_.f("x")) + b',
+            'return "".join([a, b, _f_.strval(_f_.f("x")), c])',
+        ], lines[1:])
+
+    @parse_t
+    def test_type_inference(self, root_node):
+        """ Php's conversions are left out where the types prove python does the same
+        <?php
+        function f(int $n, string $t, $u) {
+            $s = "";
+            $c = (int)$u;
+            $d = (string)$n;
+            $e = (bool)$n;
+            for ($i = 0; $i < $n; $i++) {
+                $s .= $i;
+                $s .= $t . $u;
+            }
+            echo $s . $t;
+            if ($u) {
+                $s = 1;
+            }
+            return $s . $t;
+        }
+        """
+        root_node = transformer.transform(root_node)
+        lines = [l for l, i in root_node.match("FUNCTION|f").compile()]
+        self.assertSequenceEqual([
+            "def f(n, t, u):",
+            "n = _f_.intval(n)",
+            "t = _f_.strval(t)",
+            's = ""',
+            "c = _f_.intval(u)",
+            "d = str(n)",
+            "e = bool(n)",
+            "i = 0",
+            "while i < n:",
+            "s += str(i)",
+            's += f"{t}{_f_.strval(u)}"',
+            "i += 1",
+            "_app_.write(s + t)",
+            "if u:",
+            "s = 1",
+            # $s could be a string or an int after the if
+            'return f"{_f_.strval(s)}{t}"',
+        ], lines)
+
+    @parse_t
+    def test_builtin_return_types(self, root_node):
+        """ Only what builtins are sure to return is taken as their type
+        <?php
+        function f($s) {
+            $n = strlen($s);
+            $old = ini_set("x", "1");
+            return "old:" . $old . "|" . $n . str_replace("a", "b", $s);
+        }
+        """
+        root_node = transformer.transform(root_node)
+        lines = [l for l, i in root_node.match("FUNCTION|f").compile()]
+        # ini_set gives null if nothing was set, and str_replace an array for an array
+        self.assertEqual('return "".join(["old:", _f_.strval(old), "|", str(n), '
+                         '_f_.strval(_f_.str_replace("a", "b", s))])', lines[-1])
+
+    @parse_t
+    def test_conditional_assignment_types(self, root_node):
+        """ What an operand which might not run assigns could still have its old type
+        <?php
+        function f($c, $d) {
+            $x = "a";
+            $y = "b";
+            $z = "c";
+            $c ? ($x = 5) : 0;
+            $d && ($y = 6);
+            $w = $c || ($z = 7);
+            return $x . $y . $z;
+        }
+        """
+        root_node = transformer.transform(root_node)
+        lines = [l for l, i in root_node.match("FUNCTION|f").compile()]
+        self.assertEqual('return f"{_f_.strval(x)}{_f_.strval(y)}{_f_.strval(z)}"', lines[-1])
+
+    @parse_t
+    def test_coalesce_output(self, root_node):
+        """ Html and echo statements next to each other are written together<?php
+        for ($i = 0; $i < 3; $i++) {
+            echo "<td>", $i, "</td>";
+            echo 1, true, null;
+            echo f($i);
+            echo $i;
+        }
+        try {
+            echo $i;
+            echo $i;
+        } catch (Exception $e) {
+        }
+        ?><p>Done</p>
+        """
+        root_node = transformer.transform(root_node)
+        lines = [l for l, i in root_node.match("FUNCTION|body").compile()]
+        self.assertSequenceEqual([
+            "_app_.write(_html_0)",
+            "_g_.i = 0",
+            "while _g_.i < 3:",
+            # Anything which could raise is written on its own, after what comes before it
+            '_app_.write("<td>")',
+            '_app_.write(f"{_f_.strval(_g_.i)}</td>11")',
+            '_app_.write(_f_.strval(_f_.f(_g_.i)))',
+            '_app_.write(_f_.strval(_g_.i))',
+            "_g_.i += 1",
+            "try:",
+            "_app_.write(_f_.strval(_g_.i))",
+            "_app_.write(_f_.strval(_g_.i))",
+            "except Exception as _g_.e:",
+            "pass",
+            "_app_.write(_html_1)",
+        ], lines[1:])
+        self.assertSequenceEqual([
+            '_html_0 = " Html and echo statements next to each other are written together"',
+            '_html_1 = "<p>Done</p>\\n        "',
+        ], [l for l, i in root_node.constants.compile()])
+
+    @parse_t
+    def test_coalesce_caught(self, root_node):
+        """ What a function writes before raising stays written when its caller catches<?php
+        function render($a) {
+            ?><h1>Title</h1><?php echo $a->name;
+        }
+        function row(string $s) {
+            $n = 1;
+            echo "<td>", $s, "</td>", $n;
+        }
+        function page() {
+            try {
+                render(null);
+            } catch (Exception $e) {
+                echo "|caught";
+            }
+        }
+        """
+        root_node = transformer.transform(root_node)
+        # Locals which are known to be strings and ints can't raise, so are written together with the rest
+        self.assertEqual('_app_.write(f"<td>{s}</td>{n}")', root_node.match("FUNCTION|row").compile()[3])
+
+        class App:
+            def write(self, s):
+                written.append(s)
+        written = []
+        module = {}
+        exec(Compiler(parse_string(self.test_coalesce_caught.__doc__).get_tree()).compile(), module)
+        module["_app_"] = App()
+        # Declares the functions
+        module["body"]()
+        written.clear()
+        module["page"]()
+        self.assertEqual("<h1>Title</h1>|caught", "".join(written))
+
+    @parse_t
+    def test_bind_builtins(self, root_node):
+        """ Builtins are called through names bound at the top of the module<?php
+        function strtoupper($s) {
+            return $s;
+        }
+        function f($words) {
+            foreach ($words as $w) {
+                echo str_replace("a", "b", $w) . strlen($w) . $w;
+            }
+            return strtoupper(g($words));
+        }
+        """
+        root_node = transformer.transform(root_node, bind_builtins=True)
+        lines = [l for l, i in root_node.match("FUNCTION|f").compile()]
+        self.assertSequenceEqual([
+            "def f(words):",
+            "w = None",
+            "for w in words:",
+            '_app_.write(_f_strval(_f_str_replace("a", "b", w)) + str(_f_strlen(w)) + _f_strval(w))',
+            # Functions the file defines, and ones which aren't builtins, are still looked up through _f_
+            "return _f_.strtoupper(_f_.g(words))",
+        ], lines)
+        self.assertSequenceEqual([
+            '_html_0 = " Builtins are called through names bound at the top of the module"',
+            "_f_str_replace = _f_.str_replace",
+            "_f_strlen = _f_.strlen",
+            "_f_strval = _f_.strval",
+        ], [l for l, i in root_node.constants.compile()])
+
+    @parse_t
+    def test_switch_dispatch(self, root_node):
+        """ A switch whose cases are all literals looks its branch up in a table<?php
+        function f($x) {
+            switch ($x) {
+                case 1:
+                case 2:
+                    echo "a";
+                    break;
+                case "b":
+                    echo "b";
+                case 3:
+                    echo "c";
+                    break;
+                case 1:
+                    echo "e";
+                    break;
+                default:
+                    echo "d";
+            }
+        }
+        """
+        root_node = transformer.transform(root_node)
+        lines = [l for l, i in root_node.match("FUNCTION|f").compile()]
+        self.assertSequenceEqual([
+            "def f(x):",
+            "_switch_branch = _cases_0.get(x, 4)",
+            "if _switch_branch < 2:",
+            "if _switch_branch < 1:",
+            '_app_.write("a")',
+            "else:",
+            # Falls through into the case after
+            '_app_.write("bc")',
+            "elif _switch_branch < 3:",
+            '_app_.write("c")',
+            "elif _switch_branch < 4:",
+            '_app_.write("e")',
+            "else:",
+            '_app_.write("d")',
+        ], lines)
+        self.assertSequenceEqual([
+            # The first case which matches is taken
+            '_cases_0 = {1: 0, 2: 0, "b": 1, 3: 2}',
+            '_html_0 = " A switch whose cases are all literals looks its branch up in a table"',
+        ], [l for l, i in root_node.constants.compile()])
+
+    @parse_t
+    def test_switch_chain(self, root_node):
+        """ A switch with cases which aren't literals is an if for each branch<?php
+        function f($x, $y) {
+            switch ($x) {
+                default:
+                    echo "d";
+                    break;
+                case $y:
+                case 2:
+                    echo "b";
+                case 3:
+                    echo "c";
+            }
+        }
+        """
+        root_node = transformer.transform(root_node)
+        lines = [l for l, i in root_node.match("FUNCTION|f").compile()]
+        self.assertSequenceEqual([
+            "def f(x, y):",
+            "_switch_choice = x",
+            "if _switch_choice == y or _switch_choice == 2:",
+            '_app_.write("bc")',
+            "elif _switch_choice == 3:",
+            '_app_.write("c")',
+            "else:",
+            '_app_.write("d")',
+        ], lines)
+
+    @parse_t
+    def test_typed_parameters(self, root_node):
+        """ Without strict_types, php converts arguments to the types of the parameters<?php
+        function s(string $x) {
+            return $x . "!";
+        }
+        function n(int $x, int $y = null) {
+            return intval($x);
+        }
+        """
+        module = {}
+        exec(Compiler(root_node).compile(), module)
+        self.assertEqual("5!", module["s"](5))
+        self.assertEqual(5, module["n"]("5"))
+
+    @parse_t
+    def test_strict_types(self, root_node):
+        """ Under strict_types, the types of the parameters are taken as given<?php
+        declare(strict_types=1);
+        function n(int $x) {
+            return intval($x) . "a";
+        }
+        """
+        root_node = transformer.transform(root_node)
+        lines = [l for l, i in root_node.match("FUNCTION|n").compile()]
+        self.assertSequenceEqual([
+            "def n(x):",
+            'return f"{x}a"',
+        ], lines)
+
+    @parse_t
+    def test_append_conversion(self, root_node):
+        """ What .= appends to is converted to a string unless it's known to be one<?php
+        function f($xs) {
+            foreach ($xs as $x) {
+                $s .= $x;
+            }
+            return $s;
+        }
+        function g() {
+            $n = 5;
+            $n .= "x";
+            $t = "a";
+            $t .= 1;
+            return $n . $t;
+        }
+        """
+        module = {}
+        exec(Compiler(root_node).compile(), module)
+        self.assertEqual("ab", module["f"](["a", "b"]))
+        self.assertEqual("5xa1", module["g"]())
+
+    @parse_t
+    def test_unappended_targets(self, root_node):
+        """ What a loop never appends to is left as it was<?php
+        $built = 5;
+        foreach ($built_rows as $row) {
+            $built .= $row;
+            $built_unset .= $row;
+        }
+        """
+        class App:
+            def write(self, s):
+                pass
+        module = {}
+        exec(Compiler(root_node).compile(), module)
+        module["_app_"] = App()
+        g = module["_g_"]
+        g.built_rows = []
+        module["body"]()
+        self.assertEqual(5, g.built)
+        self.assertNotIn("built_unset", vars(g))
+        g.built_rows = ["a", 1]
+        module["body"]()
+        self.assertEqual("5a1", g.built)
+        self.assertEqual("a1", g.built_unset)
@@ -2,6 +2,8 @@ from __future__ import unicode_literals
 
 from tlib.php2pytests import *
 from php2py.clib.parsetree import print_tree
+from php2py import tokeniser
+from php2py.parser import ParseError
 
 html = "<div>hello</div>"
 
@@ -191,6 +193,24 @@ class ParserTests(Php2PyTestCase):
         self.assertContainsNode(while_block, "HTML|lol")
         self.assertContainsNode(while_block, "STATEMENT/EXPRESSION/OPERATOR1|++")
 
+    @parse_t
+    def test_for(self, root_node):
+        """ For loops have three expression groups, any of which can be empty
+        <?php
+        for ($i = 0, $j = 1; $i < 10; $i++) {
+            echo $i;
+        }
+        for (;;) {
+        }
+        """
+        for_node, forever = root_node["PHP"].get_all("FOR")
+        init, conditions, steps = for_node.get_all("EXPRESSIONGROUP")
+        self.assertEqual(2, len(init))
+        self.assertContainsNode(conditions, "EXPRESSION/OPERATOR2|<")
+        self.assertContainsNode(steps, "EXPRESSION/OPERATOR1|++")
+        self.assertContainsNode(for_node, "BLOCK/STATEMENT")
+        self.assertEqual([0, 0, 0], [len(g) for g in forever.get_all("EXPRESSIONGROUP")])
+
     @parse_t
     def test_function_simple(self, root_node):
         """Simple function
@@ -208,6 +228,19 @@ class ParserTests(Php2PyTestCase):
         return_expression = return_statement.get("EXPRESSION")
         self.assertContainsNode(return_expression, "INT|0")
 
+    @parse_t
+    def test_typed_parameters(self, root_node):
+        """ Parameters with types
+        <?php
+        function foo(int $a, ?string $b, $c = 1) {
+        }"""
+        arg_list = root_node.match("PHP/FUNCTION|foo")[0]
+        self.assertEqual(3, len(arg_list.children))
+        self.assertEqual("int", arg_list[0].get("TYPE").value)
+        self.assertEqual("a", arg_list[0][0].value)
+        self.assertEqual("?string", arg_list[1].get("TYPE").value)
+        self.assertNotIn("TYPE", arg_list[2])
+
     def test_function(self):
         parsed = parse_string(function)
         res = parsed.get_tree()
@@ -609,6 +642,91 @@ class ParserTests(Php2PyTestCase):
         c_lookup = root_node.match("PHP/STATEMENT/EXPRESSION/ATTR|->")
         self.assertContainsNode(c_lookup, "CALL/ATTR|->/GLOBALVAR|a")
 
+    @parse_t
+    def test_postfix_chain(self, root_node):
+        """ Indexes, attributes and calls apply left to right
+        <?php
+        $a[1]->b["c"]();
+        """
+        self.assertContainsNode(root_node, "PHP/STATEMENT/EXPRESSION/CALL/INDEX/ATTR/INDEX/GLOBALVAR|a")
+
+    @parse_t
+    def test_brackets(self, root_node):
+        """ Brackets group an expression
+        <?php
+        $a = ($b + 1) * $c++;
+        """
+        mul = root_node.match("PHP/STATEMENT/EXPRESSION/ASSIGNMENT")[0]
+        self.assertEqual("OPERATOR1", mul[0].kind)
+        self.assertContainsNode(mul, "EXPRESSIONGROUP/EXPRESSION/OPERATOR2|+")
+
+    @parse_t
+    def test_ternary_associativity(self, root_node):
+        """ Php ternaries associate to the left
+        <?php
+        $a ? 1 : $b ? 2 : 3;
+        """
+        outer = root_node.match("PHP/STATEMENT/EXPRESSION/OPERATOR3")
+        self.assertEqual("INT", outer[1].kind)
+        self.assertContainsNode(outer, "OPERATOR3/GLOBALVAR|a")
+
+    def test_recover(self):
+        source = "<?php\n$a = 1 +;\nfunction b($c) {\n    $d = ;\n    return $c;\n}\n} $e = (1;\n$f = 2;\n"
+        parser = PhpParser(source, recover=True)
+        self.assertSequenceEqual([1, 3, 6, 6], [e.line for e in parser.errors])
+        php = parser.get_tree()["PHP"]
+        self.assertSequenceEqual(["ERROR", "FUNCTION", "ERROR", "ERROR", "STATEMENT"], [c.kind for c in php])
+        self.assertContainsNode(php, "FUNCTION|b/BLOCK/ERROR")
+        self.assertContainsNode(php, "FUNCTION|b/BLOCK/RETURN/EXPRESSION/VAR|c")
+        self.assertContainsNode(php, "STATEMENT/EXPRESSION/ASSIGNMENT/GLOBALVAR|f")
+        # Files which end part way through a statement
+        for source in ("<?php\n$a = foo(1", "<?php\nif (", "<?php\nfunction f(", "<?php\n$a = 1;\nb("):
+            parser = PhpParser(source, recover=True)
+            self.assertEqual(1, len(parser.errors))
+            self.assertEqual(source.count("\n") + 1, parser.errors[0].line)
+            self.assertEqual("ERROR", list(parser.get_tree()["PHP"])[-1].kind)
+
+    def test_no_recover(self):
+        with self.assertRaises(ParseError):
+            PhpParser("<?php $a = 1 +;")
+        with self.assertRaises(ParseError):
+            PhpParser("<?php if ($a) { $b;")
+
+    def test_parse_buffer(self):
+        source = "<p>\n</p><?php\nfunction a() {\n    return 'b\nc';\n}\n"
+        root_node = PhpParser(source).get_tree()
+        self.assertEqual("<p>\n</p>", root_node["HTML"].value)
+        self.assertContainsNode(root_node, "PHP/FUNCTION|a/BLOCK/RETURN/EXPRESSION/STRING")
+
+    def test_parse_token_reader(self):
+        s = "<?php\n$a = true;\nb(1);\n"
+        it = tokeniser.IncrementalTokens(s.splitlines(True))
+        for i in range(2):
+            root_node = PhpParser(it.reader()).get_tree()
+            self.assertEqual("True", root_node.match("PHP/STATEMENT/EXPRESSION/ASSIGNMENT/IDENT").value)
+
+    def test_ids_per_tree(self):
+        s = "<?php\n$a = 1 + 2;\nfunction f() { return 3; }\n"
+
+        def ids(root_node):
+            ids = []
+            stack = [root_node]
+            while stack:
+                n = stack.pop()
+                ids.append(n.id_)
+                stack.extend(n.children)
+            return ids
+        first = ids(PhpParser(s).get_tree())
+        self.assertEqual(first, ids(PhpParser(s).get_tree()))
+        self.assertEqual(sorted(first), list(range(len(first))))
+
+    def test_hash_cons(self):
+        s = "<?php\n$a = array('x' => $this->b, 'y' => $this->b);\n$c = $this->b;\n"
+        shared = PhpParser(s, hash_cons=True).get_tree()
+        self.assertEqual(PhpParser(s).get_tree().to_list(), shared.to_list())
+        b1, b2 = shared.match("PHP/STATEMENT/EXPRESSION/ASSIGNMENT/CALLSPECIAL/ARGSLIST/EXPRESSION*/OPERATOR2/ATTR")
+        self.assertIs(b1, b2)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -2,6 +2,7 @@ from __future__ import unicode_literals
 
 import unittest
 import php2py.parser as p
+import php2py.clib.parsetree as pt
 
 
 class ParserTests(unittest.TestCase):
@@ -16,3 +17,97 @@ class ParserTests(unittest.TestCase):
         self.assertTrue(self.simple_parser.scope_is("LOCAL"))
         self.simple_parser.pop_scope()
         self.assertTrue(self.simple_parser.scope_is("GLOBAL"))
+
+
+class ParseNodeTests(unittest.TestCase):
+    def setUp(self):
+        self.tree = pt.ParseTree("test")
+        self.root = self.tree.root_node
+        self.a = self.root.append(pt.ParseNode("A", None, "a"))
+        self.b = self.a.append(pt.ParseNode("B", None, "b"))
+
+    def test_slots(self):
+        self.assertFalse(hasattr(self.a, "__dict__"))
+        self.assertEqual(self.a.position, (-1, -1))
+
+    def test_parent_of(self):
+        self.assertIs(self.tree.parent_of(self.b), self.a)
+        self.assertIs(self.tree.parent_of(self.a), self.root)
+        self.assertIsNone(self.tree.parent_of(self.root))
+
+    def test_freeze(self):
+        self.tree.freeze()
+        self.assertIsInstance(self.a.children, tuple)
+        self.a.append(pt.ParseNode("C", None, "c"))
+        self.assertEqual(self.a.to_list(), ("A", "a", [("B", "b"), ("C", "c")]))
+
+    def test_setitem_by_kind(self):
+        self.a["B"] = pt.ParseNode("B", None, "new")
+        self.assertEqual(self.a.to_list(), ("A", "a", [("B", "new")]))
+
+    def test_compile_selector(self):
+        selector = pt.compile_selector("A*/B|b")
+        self.assertIs(selector, pt.compile_selector("A*/B|b"))
+        self.assertEqual(selector.steps, (("A", None, False), ("B", "b", True)))
+        self.assertEqual(self.root.match("A*/B|b"), [self.b])
+        self.assertRaises(pt.NoMatchesError, self.root.match, "A/B|c")
+
+    def test_kind_index(self):
+        for i in range(pt.INDEX_MIN_CHILDREN):
+            self.a.append(pt.ParseNode("C", None, str(i)))
+        self.assertIs(self.a.get("B"), self.b)
+        self.assertIsNotNone(self.a.index)
+        d = self.a.append(pt.ParseNode("D", None, "d"))
+        self.assertIs(self.a["D"], d)
+        self.assertEqual([c.value for c in self.a.get_all("C", "3")], ["3"])
+        del self.a[0]
+        self.assertNotIn("B", self.a)
+        self.assertEqual(len(self.a.match("C*")), pt.INDEX_MIN_CHILDREN)
+
+    def test_nodes_of_kind(self):
+        self.assertEqual(self.tree.nodes_of_kind("B"), [self.b])
+        c = self.a.append(pt.ParseNode("B", None, "c"))
+        self.assertEqual(self.tree.nodes_of_kind("B"), [self.b, c])
+        self.a[0] = pt.ParseNode("C", None, "c")
+        self.assertEqual(self.tree.nodes_of_kind("B"), [c])
+        self.assertEqual(len(self.tree.nodes_of_kind("C")), 1)
+        c.rename("D")
+        self.assertEqual(self.tree.nodes_of_kind("B"), [])
+        self.assertEqual(self.tree.nodes_of_kind("D"), [c])
+        del self.root[0]
+        self.assertEqual(self.tree.nodes_of_kind("A"), [])
+        self.assertEqual(self.tree.nodes_of_kind("D"), [])
+        self.assertIsNone(c.tree)
+
+    def test_nodes_of_kind_insert_and_trim(self):
+        self.tree.nodes_of_kind("A")
+        e = pt.ParseNode("E", None, "e")
+        e.append(pt.ParseNode("F", None, "f"))
+        self.a.insert_after(self.b, e)
+        self.assertEqual([n.value for n in self.tree.nodes_of_kind("F")], ["f"])
+        self.a.append(pt.ParseNode("G", None, "g"))
+        self.a.trim_childless_children("G")
+        self.assertEqual(self.tree.nodes_of_kind("G"), [])
+
+    def test_structural_hash(self):
+        other = pt.ParseNode("A", self.b, "a")
+        other.append(pt.ParseNode("B", None, "b"))
+        self.assertEqual(self.a.structural_hash(), other.structural_hash())
+        other.append(pt.ParseNode("C", None, "c"))
+        self.assertNotEqual(self.a.structural_hash(), other.structural_hash())
+
+    def test_intern_subtrees(self):
+        for i in range(3):
+            a = self.root.append(pt.ParseNode("A", None, "a"))
+            a.append(pt.ParseNode("B", None, "b"))
+        before = self.root.to_list()
+        self.assertEqual(6, self.tree.intern_subtrees())
+        self.assertEqual(before, self.root.to_list())
+        self.assertTrue(all(c is self.a for c in self.root))
+        self.assertEqual(1, len(self.tree.nodes_of_kind("B")))
+
+    def test_intern_subtrees_max_size(self):
+        self.root.append(pt.ParseNode("A", None, "a")).append(pt.ParseNode("B", None, "b"))
+        self.assertEqual(1, self.tree.intern_subtrees(max_size=1))
+        self.assertIsNot(self.root[0], self.root[1])
+        self.assertIs(self.root[0][0], self.root[1][0])
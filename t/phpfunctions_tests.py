@@ -33,6 +33,35 @@ class PhpFunctionsTests(unittest.TestCase):
         self.assertEqual(" lo", phpfunctions.trim(" lol", "l"))
         self.assertRaises(NotImplementedError, phpfunctions.trim, "lol", "a..g")
 
+    def test_strval(self):
+        self.assertEqual("", phpfunctions.strval(None))
+        self.assertEqual("1", phpfunctions.strval(True))
+        self.assertEqual("", phpfunctions.strval(False))
+        self.assertEqual("12", phpfunctions.strval(12))
+        self.assertEqual("0.3", phpfunctions.strval(0.1 + 0.2))
+        self.assertEqual("2", phpfunctions.strval(2.0))
+        self.assertEqual("1.0E+25", phpfunctions.strval(1e25))
+        self.assertEqual("1.0E-5", phpfunctions.strval(0.00001))
+
+    def test_intval(self):
+        self.assertEqual(12, phpfunctions.intval("12abc"))
+        self.assertEqual(1000, phpfunctions.intval(" 1e3"))
+        self.assertEqual(0, phpfunctions.intval("abc"))
+        self.assertEqual(-3, phpfunctions.intval(-3.9))
+        self.assertEqual(0, phpfunctions.intval(None))
+        self.assertEqual(26, phpfunctions.intval(" 0x1Ag", 16))
+        self.assertEqual(-26, phpfunctions.intval("-1a", 16))
+        self.assertEqual(34, phpfunctions.intval("42", 8))
+        self.assertEqual(26, phpfunctions.intval("0x1A", 0))
+        self.assertEqual(10, phpfunctions.intval("012", 0))
+        self.assertEqual(3, phpfunctions.intval("0b11", 0))
+        self.assertEqual(12, phpfunctions.intval("12.5", 0))
+        self.assertEqual(0, phpfunctions.intval("0x", 16))
+        self.assertEqual(0, phpfunctions.intval("z", 2))
+        self.assertEqual(1.5, phpfunctions.floatval("1.5kg"))
+        self.assertIs(False, phpfunctions.boolval("0"))
+        self.assertIs(True, phpfunctions.boolval("0.0"))
+
     def test_explode(self):
         self.assertSequenceEqual(["a", "b"], phpfunctions.explode(" ", "a b"))
         self.assertSequenceEqual(["a", "b", "c"], phpfunctions.explode(",", "a,b,c,d", -1))
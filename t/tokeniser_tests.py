@@ -0,0 +1,210 @@
+import unittest
+
+from php2py import tokeniser
+
+
+def tokenise(s: str):
+    return list(tokeniser.tokens(iter(s.splitlines(True))))
+
+
+class TokeniserTests(unittest.TestCase):
+    """ Test the tokeniser by itself
+
+    """
+    def assertKinds(self, s, expected):
+        got = [(t.val, t.kind) for t in tokenise(s)]
+        self.assertSequenceEqual(expected, got)
+
+    def test_simple_statement(self):
+        self.assertKinds("<?php $a = 1; ?>", [
+            ("<?php", "PHPSTART"),
+            ("$a", "VARIABLE"),
+            ("=", "ASSIGNMENT"),
+            ("1", "INT"),
+            (";", "ENDSTATEMENT"),
+            ("?>", "PHPEND"),
+            ("EOF", "PHPEND"),
+        ])
+
+    def test_keywords_are_case_sensitive(self):
+        self.assertKinds("<?php if IF", [
+            ("<?php", "PHPSTART"),
+            ("if", "IF"),
+            ("IF", "IDENT"),
+            ("EOF", "PHPEND"),
+        ])
+
+    def test_symbols(self):
+        self.assertKinds("<?php new (int)$a->{$b} <<= !== :: [", [
+            ("<?php", "PHPSTART"),
+            ("new", "IDENT"),
+            ("(int)", "UNKNOWN"),
+            ("$a", "VARIABLE"),
+            ("->{", "OPERATOR"),
+            ("$b", "VARIABLE"),
+            ("}", "ENDBRACE"),
+            ("<<=", "ASSIGNMENT"),
+            ("!==", "COMPARATOR"),
+            ("::", "OPERATOR"),
+            ("[", "INDEX"),
+            ("EOF", "PHPEND"),
+        ])
+
+    def test_numbers(self):
+        self.assertKinds("<?php 12 -3 1.5", [
+            ("<?php", "PHPSTART"),
+            ("12", "INT"),
+            ("-3", "INT"),
+            ("1.5", "UNKNOWN"),
+            ("EOF", "PHPEND"),
+        ])
+
+    def test_comments(self):
+        self.assertKinds("<?php /* a */ $a; // b  \n/* c\nd */", [
+            ("<?php", "PHPSTART"),
+            ("/* a */", "BLOCKCOMMENT"),
+            ("$a", "VARIABLE"),
+            (";", "ENDSTATEMENT"),
+            ("// b", "COMMENTLINE"),
+            ("/* c\n", "BLOCKCOMMENT"),
+            ("d */", "BLOCKCOMMENT"),
+            ("EOF", "PHPEND"),
+        ])
+
+    def test_kinds_match_lookup_kind(self):
+        """ The kind given by the master pattern should be the same as that given by lookup_kind """
+        s = "<?php\n$a = NEW B(1, 'c', \"d\") . e::F;\nfunction g($h) { return $h >= 0 || !$h; }\n"
+        for t in tokenise(s):
+            if t.kind not in ("PHPSTART", "PHPEND"):
+                self.assertEqual(tokeniser.lookup_kind(t.val), t.kind, t)
+
+    def test_columns(self):
+        toks = tokenise("<?php\n  $ab = 1;\n")
+        # Columns point at the end of the token
+        self.assertEqual((1, 5), (toks[1].line, toks[1].col))
+        self.assertEqual((1, 7), (toks[2].line, toks[2].col))
+
+
+class BufferTokeniserTests(unittest.TestCase):
+    """ Test the whole buffer tokeniser
+
+    """
+    def test_same_as_lines(self):
+        s = "<?php\n$a = array(1, 'b');\n\n  \nfunction c($d) { return $d->e(); } // f\n?><p>g</p>\n"
+        expected = [(t.line, t.col, t.val, t.kind) for t in tokenise(s)]
+        got = [(t.line, t.col, t.val, t.kind) for t in tokeniser.buffer_tokens(s)]
+        self.assertSequenceEqual(expected, got)
+
+    def test_html_over_lines(self):
+        toks = list(tokeniser.buffer_tokens("<p>\na\n</p><?php $b;"))
+        self.assertEqual(("HTML", "<p>\na\n</p>"), (toks[0].kind, toks[0].val))
+        self.assertEqual((2, 4), (toks[1].line, toks[1].col))
+
+    def test_multiline_string(self):
+        toks = list(tokeniser.buffer_tokens("<?php\n$a = 'b\nc';\n$d;"))
+        self.assertEqual(("STRING", "'b\nc'"), (toks[3].kind, toks[3].val))
+        self.assertEqual(("$d", 3), (toks[5].val, toks[5].line))
+
+    def test_block_comment_lines(self):
+        toks = list(tokeniser.buffer_tokens("<?php\n/* a\n\n b */ $c;"))
+        self.assertSequenceEqual(["/* a\n", "\n", " b */"], [t.val for t in toks if t.kind == "BLOCKCOMMENT"])
+        self.assertEqual(("$c", 3), (toks[4].val, toks[4].line))
+
+
+class TokenBufferTests(unittest.TestCase):
+    """ Test the compact token storage
+
+    """
+    def test_kind_codes(self):
+        t = tokeniser.Token(1, 2, "$a", "VARIABLE")
+        self.assertEqual(tokeniser.Kind.VARIABLE, t.code)
+        self.assertEqual("VARIABLE", t.kind)
+
+    def test_round_trip(self):
+        toks = tokenise("<?php\n$a = b(1, 'c');\n?>d")
+        tb = tokeniser.TokenBuffer(toks)
+        self.assertEqual(len(toks), len(tb))
+        self.assertSequenceEqual([(t.line, t.col, t.val, t.kind) for t in toks],
+                                 [(t.line, t.col, t.val, t.kind) for t in tb])
+
+    def test_values_interned(self):
+        tb = tokeniser.TokenBuffer(tokenise("<?php $abc; $abc;"))
+        self.assertIs(tb.vals[1], tb.vals[3])
+
+
+class IncrementalTokensTests(unittest.TestCase):
+    """ Test tokenizing again after edits
+
+    """
+    source = "<p>a</p>\n<?php\n$a = 1;\n/* b */\nfunction c($d) {\n    return $d;\n}\n?>\n<p>e</p>\n"
+
+    def assertSameAsFull(self, it):
+        expected = [(t.line, t.col, t.val, t.kind) for t in tokenise("".join(it.lines))]
+        got = [(t.line, t.col, t.val, t.kind) for t in it]
+        self.assertSequenceEqual(expected, got)
+
+    def test_checkpoints(self):
+        it = tokeniser.IncrementalTokens(self.source.splitlines(True))
+        self.assertSequenceEqual(["html", "html", "php", "php", "php", "php", "php", "php", "html"], it.checkpoints)
+        self.assertSameAsFull(it)
+
+    def test_edit_one_line(self):
+        it = tokeniser.IncrementalTokens(self.source.splitlines(True))
+        self.assertEqual((2, 3), it.edit(2, 3, ["$a = 2 + $f;\n"]))
+        self.assertSameAsFull(it)
+
+    def test_insert_and_delete_lines(self):
+        it = tokeniser.IncrementalTokens(self.source.splitlines(True))
+        it.edit(3, 3, ["$g;\n", "$h;\n"])
+        self.assertSameAsFull(it)
+        it.edit(0, 2, ["<?php\n"])
+        self.assertSameAsFull(it)
+
+    def test_state_change_runs_on(self):
+        """ Opening a block comment changes the state of the following lines, so they are tokenized again """
+        it = tokeniser.IncrementalTokens(self.source.splitlines(True))
+        self.assertEqual((2, 4), it.edit(2, 3, ["/* $a = 1;\n"]))
+        self.assertEqual("blockcomment", it.checkpoints[3])
+        self.assertSameAsFull(it)
+        # Closing it again straight away brings the rest back to how it was
+        lines = list(it.lines)
+        lines[3] = "*/\n"
+        self.assertEqual((3, 4), it.update(lines))
+        self.assertSameAsFull(it)
+
+    def test_update(self):
+        it = tokeniser.IncrementalTokens(self.source.splitlines(True))
+        new = self.source.replace("return $d;", "return $d * 2;\n    $i;")
+        self.assertEqual((5, 7), it.update(new.splitlines(True)))
+        self.assertSameAsFull(it)
+
+
+class ParallelTokeniserTests(unittest.TestCase):
+    """ Test tokenizing in chunks in several processes
+
+    """
+    def assertSameAsSerial(self, s, chunk_size):
+        expected = [(t.line, t.col, t.val, t.kind) for t in tokeniser.buffer_tokens(s)]
+        got = [(t.line, t.col, t.val, t.kind) for t in tokeniser.parallel_buffer_tokens(s, 2, chunk_size)]
+        self.assertSequenceEqual(expected, got)
+
+    def test_split_points(self):
+        self.assertSequenceEqual([8, 22], tokeniser.split_points("<?php ?>ab<?php $c; ?>d", 1))
+
+    def test_same_error_as_serial(self):
+        """ The end of the buffer can't be tokenized """
+        s = "<?php $a; ?>\n" * 4 + "<?php #"
+        with self.assertRaises(NotImplementedError) as serial:
+            list(tokeniser.buffer_tokens(s))
+        with self.assertRaises(NotImplementedError) as parallel:
+            tokeniser.parallel_buffer_tokens(s, 2, 1)
+        self.assertEqual(str(serial.exception), str(parallel.exception))
+
+    def test_same_as_serial(self):
+        s = "<p>a</p><?php $b = 1; ?>\n<?php\nfunction c($d) {\n    return $d;\n}\n?> <p>e</p> <?php $f; ?>g"
+        self.assertSameAsSerial(s, 1)
+
+    def test_false_splits(self):
+        """ ?> in strings, comments and html aren't places the tokenizer goes back into html """
+        s = "<p>?></p><?php $a = 'b ?> c';\n/* ?>\n */ $d = \"e\n?>\"; // ?>\n$f; ?><??><?php $g; ?>h"
+        self.assertSameAsSerial(s, 1)
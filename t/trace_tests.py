@@ -0,0 +1,41 @@
+import io
+import json
+import unittest
+
+from php2py.clib import trace
+from php2py import tokeniser
+from tlib.php2pytests import parse_string, transformer
+
+
+class TraceTests(unittest.TestCase):
+    def setUp(self):
+        self.stream = io.StringIO()
+        trace.enable(self.stream)
+
+    def tearDown(self):
+        trace.tracer = None
+
+    def events(self):
+        return [json.loads(l) for l in self.stream.getvalue().splitlines()]
+
+    def test_tokens(self):
+        list(tokeniser.tokens(iter(["<?php $a;"])))
+        events = self.events()
+        self.assertEqual({"event": "token", "line": 0, "col": 8, "val": "$a", "kind": "VARIABLE"}, events[1])
+
+    def test_parse_events(self):
+        root_node = parse_string("<?php $a = 1 + 2;").get_tree()
+        transformer.transform(root_node)
+        events = self.events()
+        kinds = set(e["event"] for e in events)
+        self.assertEqual({"token", "node", "enter", "leave", "reduce", "transform"}, kinds)
+        enters = [e for e in events if e["event"] == "enter"]
+        leaves = [e for e in events if e["event"] == "leave"]
+        self.assertEqual(len(enters), len(leaves))
+        reduce_values = [e["value"] for e in events if e["event"] == "reduce"]
+        self.assertSequenceEqual(["+", "="], reduce_values)
+
+    def test_disabled(self):
+        trace.tracer = None
+        parse_string("<?php $a = 1;")
+        self.assertEqual("", self.stream.getvalue())
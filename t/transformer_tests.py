@@ -1,4 +1,6 @@
 from tlib.php2pytests import *
+from php2py import scopes
+from php2py.clib import visitor
 
 
 class TransformerTests(Php2PyTestCase):
@@ -19,7 +21,7 @@ class TransformerTests(Php2PyTestCase):
         """ Simple echo
         <?php echo "Hello World"; ?>
         """
-        self.assertContainsNode(root_node, "FUNCTION|body/BLOCK/EX_STATEMENT")
+        self.assertContainsNode(root_node, "FUNCTION|body/BLOCK/WRITE")
 
     @transform_t
     def test_increment(self, root_node):
@@ -88,32 +90,51 @@ class TransformerTests(Php2PyTestCase):
         self.assertContainsNode(assign_statement, "ASSIGNMENT/OPERATOR2|./VAR|a")
         self.assertContainsNode(if_statement, "OPERATOR2|./VAR|a")
 
+    @transform_t
+    def test_variable_scopes(self, root_node):
+        """ Locals, globals and superglobals in a function
+        <?php
+        function f($a) {
+            global $g;
+            $b = $a . $g . $_GET["x"];
+            return $c;
+        }
+        """
+        f = root_node.match("FUNCTION|f")
+        self.assertEqual(["a", "b", "c"], f.locals)
+        found = {}
+        for statement in f.body:
+            visitor.walk(statement, post=lambda n, r: found.setdefault(n.value, n.scope)
+                         if scopes.is_php_variable(n) else None)
+        self.assertEqual({"a": "local", "b": "local", "c": "local", "g": "global", "_GET": "superglobal"}, found)
+        self.assertEqual("global", f.body["GLOBAL"].variables[0].scope)
+
     @transform_t
     def test_one_line_if(self, root_node):
         """ If on one line
         <?php
-        if (1) echo "hi";
+        if ($a) echo "hi";
         """
         if_node = get_body(root_node)["IF"]
-        self.assertContainsNode(if_node, "INT|1")
-        self.assertContainsNode(if_node, "BLOCK/EX_STATEMENT")
+        self.assertContainsNode(if_node, "OPERATOR2/VAR|a")
+        self.assertContainsNode(if_node, "BLOCK/WRITE")
 
     @transform_t
     def test_if_else(self, root_node):
         """ If with an elseif and an else
         <?php
-        if (1) {
+        if ($a) {
             2;
-        } elseif (2) {
+        } elseif ($b) {
             4;
         } else {
             6;
         }
         """
         if_node = get_body(root_node)["IF"]
-        self.assertContainsNode(if_node, "INT|1")
+        self.assertContainsNode(if_node, "OPERATOR2/VAR|a")
         self.assertContainsNode(if_node, "BLOCK/EX_STATEMENT/INT|2")
-        self.assertContainsNode(if_node, "ELIF/INT|2")
+        self.assertContainsNode(if_node, "ELIF/OPERATOR2/VAR|b")
         self.assertContainsNode(if_node, "ELIF/BLOCK/EX_STATEMENT/INT|4")
         self.assertContainsNode(if_node, "ELSE/BLOCK/EX_STATEMENT/INT|6")
 
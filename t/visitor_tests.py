@@ -0,0 +1,64 @@
+import sys
+import unittest
+
+from php2py.clib import visitor
+from php2py.clib.parsetree import ParseNode
+from tlib.php2pytests import parse_string, transformer
+
+
+def chain(depth):
+    root = node = ParseNode("A", None, 0)
+    for i in range(1, depth):
+        node = node.append(ParseNode("A", None, i))
+    return root
+
+
+class VisitorTests(unittest.TestCase):
+    def test_walk(self):
+        root = chain(3)
+        root.append(ParseNode("B", None, "b"))
+        seen = []
+
+        def pre(node, depth):
+            seen.append((node.value, depth))
+            return node.value != 1
+
+        self.assertEqual(3, visitor.walk(root, pre, lambda node, results: 1 + sum(results)))
+        self.assertEqual([(0, 0), (1, 1), ("b", 1)], seen)
+
+    def test_walk_deep(self):
+        depth = sys.getrecursionlimit() * 2
+        self.assertEqual(depth, visitor.walk(chain(depth), post=lambda node, results: 1 + sum(results)))
+
+    def test_run(self):
+        def depth(node):
+            if len(node) == 0:
+                return 1
+            return 1 + (yield depth(node[0]))
+        self.assertEqual(3, visitor.run(depth(chain(3))))
+        self.assertEqual(5000, visitor.run(depth(chain(5000))))
+
+    def test_run_exceptions(self):
+        def fails():
+            raise KeyError("a")
+            yield
+
+        def catches():
+            try:
+                yield fails()
+            except KeyError:
+                return "caught"
+        self.assertEqual("caught", visitor.run(catches()))
+        self.assertRaises(KeyError, visitor.run, fails())
+
+    def test_long_chain(self):
+        root_node = parse_string("<?php\n$a = " + " . ".join(["$b"] * 5000) + ";").get_tree()
+        self.assertEqual("ROOT", root_node.to_list()[0])
+        compiled = transformer.transform(root_node).functions[-1].compile()
+        # $b is used often enough to be held in a local
+        self.assertEqual("_g_b = _g_.b", compiled[1])
+        self.assertEqual('_g_.a = f"' + "{_f_.strval(_g_b)}" * 5000 + '"', compiled[3])
+
+
+if __name__ == "__main__":
+    unittest.main()